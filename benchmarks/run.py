@@ -0,0 +1,344 @@
+#!/usr/bin/python3
+
+# Times the snapshot manager's hot paths against in-memory fixtures of
+# increasing size. Results are written as JSON, which a later run can be
+# compared against to catch scaling regressions between commits.
+#
+#   python3 benchmarks/run.py --output before.json
+#   python3 benchmarks/run.py --compare before.json
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tests.fakes import *
+from btrfssnapshotmanager.manager import *
+
+import argparse
+import json
+import platform
+import statistics
+import subprocess
+import tempfile
+import time
+
+
+default_sizes = [100, 1000, 10000]
+default_repeat = 3
+default_threshold = 1.25
+
+subvolume_path = '/benchmark/subvolume'
+target_path = '/backups/subvolume'
+reference_entry = 'linux.conf'
+extra_reference_entries = ['linux-lts.conf', 'linux-fallback.conf', 'linux-zen.conf']
+startup_snapshots = 100
+retention = {
+    PERIOD_NAME_MAP['hourly']: 24,
+    PERIOD_NAME_MAP['daily']: 7,
+    PERIOD_NAME_MAP['weekly']: 4,
+    PERIOD_NAME_MAP['monthly']: 12,
+}
+
+
+class Benchmark():
+
+    # Each benchmark builds fresh fixtures in setup, which isn't timed, then
+    # times a single call of run
+
+    name = None
+    sized = True
+
+    def setup(self, size):
+        pass
+
+    def run(self):
+        raise Exception("Method must be overridden")
+
+    def teardown(self):
+        pass
+
+
+class LoadSnapshotsBenchmark(Benchmark):
+
+    name = 'load_snapshots'
+
+    def setup(self, size):
+        self.subvol = fixture_subvolume(install_fakes(), subvolume_path, size)
+
+    def run(self):
+        self.subvol.load_snapshots()
+
+
+class CleanupBenchmark(Benchmark):
+
+    name = 'cleanup'
+
+    def setup(self, size):
+        subvol = fixture_subvolume(install_fakes(), subvolume_path, size)
+        self.manager = SubvolumeManager(None, subvol, retention, [])
+        subvol.snapshots
+
+    def run(self):
+        self.manager.cleanup()
+
+
+class BackupPlanBenchmark(Benchmark):
+
+    # Planning a remote btrfs backup where the target is one snapshot behind
+
+    name = 'backup_plan'
+
+    def setup(self, size):
+        subvol = fixture_subvolume(install_fakes(), subvolume_path, size)
+        self.backup = RemoteBtrfsBackup(subvol, 'backup-host', None, None, target_path)
+        self.backup.retention = dict([(p, size) for p in retention])
+        subvol.retention.add_policy(self.backup, 'backup 0')
+        # Always plan against a fresh listing of the target
+        self.backup.inventory_max_age = None
+        FakeCommandProcess.remote.add_target(target_path, fixture_target_snapshots(subvol, subvol.snapshots.copy()[0:-1]))
+
+    def run(self):
+        self.backup.plan_sync()
+
+
+class SystemdBootEntriesBenchmark(Benchmark):
+
+    # Every snapshot has a loader entry, and all but the retained ones need
+    # deleting
+
+    name = 'systemdboot_entries'
+
+    def setup(self, size):
+        self.subvol = fixture_subvolume(install_fakes(), subvolume_path, size)
+        self.boot_tree = FakeBootTree()
+        self.boot_tree.create(self.subvol.snapshots.copy(), reference_entry, 24)
+        self.systemdboot_manager = SystemdBootManager()
+        self.systemdboot_manager.set_boot_path(self.boot_tree.path)
+        self.entry_manager = SystemdBootEntryManager(self.systemdboot_manager, self.subvol, reference_entry, retention)
+        self.subvol.retention.add_policy(self.entry_manager, "systemd-boot {0}".format(reference_entry))
+        self.systemdboot_manager.entry_managers.append(self.entry_manager)
+        self.subvol.systemdboot_manager = self.systemdboot_manager
+
+    def run(self):
+        self.entry_manager.run()
+
+    def teardown(self):
+        self.boot_tree.remove()
+
+
+class RemoveBootSnapshotsBenchmark(SystemdBootEntriesBenchmark):
+
+    name = 'remove_unused_boot_snapshots'
+
+    def setup(self, size):
+        super().setup(size)
+        self.systemdboot_manager.boot_snapshots
+
+    def run(self):
+        self.systemdboot_manager.remove_unused_boot_snapshots()
+
+
+class LoadEntriesBenchmark(Benchmark):
+
+    # Loading the entries of several reference entries, which all share the
+    # same entries directory
+
+    name = 'systemdboot_load_entries'
+
+    def setup(self, size):
+        self.subvol = fixture_subvolume(install_fakes(), subvolume_path, size)
+        self.boot_tree = FakeBootTree()
+        self.boot_tree.create(self.subvol.snapshots.copy(), [reference_entry] + extra_reference_entries, 24)
+        self.systemdboot_manager = SystemdBootManager()
+        self.systemdboot_manager.set_boot_path(self.boot_tree.path)
+        for entry in [reference_entry] + extra_reference_entries:
+            self.systemdboot_manager.entry_managers.append(SystemdBootEntryManager(self.systemdboot_manager, self.subvol, entry, retention))
+
+    def run(self):
+        self.systemdboot_manager.load_entries_for_subvol(self.subvol)
+
+    def teardown(self):
+        self.boot_tree.remove()
+
+
+class BootSnapshotNeededBenchmark(Benchmark):
+
+    # Checking whether the init files have changed since the last boot
+    # snapshot, when they haven't, as every snapshot creation does
+
+    name = 'boot_snapshot_needed'
+    sized = False
+
+    def setup(self, size):
+        install_fakes()
+        self.boot_tree = FakeBootTree()
+        self.boot_tree.create([], reference_entry, 1)
+        self.systemdboot_manager = SystemdBootManager()
+        self.systemdboot_manager.set_boot_path(self.boot_tree.path)
+        self.systemdboot_manager.create_boot_snapshot_if_needed()
+
+    def run(self):
+        self.systemdboot_manager.create_boot_snapshot_if_needed()
+
+    def teardown(self):
+        self.boot_tree.remove()
+
+
+class CliStartupBenchmark(Benchmark):
+
+    # Time to start the command line tool and print its help, in a fresh
+    # interpreter
+
+    name = 'cli_startup'
+    sized = False
+
+    def run(self):
+        run_cli(['--help'])
+
+
+class CliSnapshotListBenchmark(Benchmark):
+
+    # Time to list a subvolume's snapshots in a fresh interpreter, as
+    # monitoring scripts do, with the config already cached by an earlier run
+
+    name = 'cli_snapshot_list'
+    sized = False
+
+    def setup(self, size):
+        self.temp_dir = tempfile.TemporaryDirectory(prefix='btrfs-snapshot-manager-benchmark-')
+        self.config_file = PosixPath(self.temp_dir.name, 'config.yml')
+        self.config_file.write_text(
+            "subvolumes:\n"
+            "  - path: {0}\n"
+            "    retention:\n"
+            "      hourly: 24\n"
+            "      daily: 7\n".format(subvolume_path))
+        self.run()
+
+    def run(self):
+        run_cli(['--socket', PosixPath(self.temp_dir.name, 'daemon.sock'), 'snapshot', 'list', subvolume_path],
+            "subvol = fixture_subvolume(install_fakes(), {0!r}, {1}); "
+            "cli.Config.config_file = PosixPath({2!r}); "
+            "cli.Config.config_cache_file = PosixPath({3!r}); ".format(
+                subvolume_path, startup_snapshots, str(self.config_file), str(PosixPath(self.temp_dir.name, 'config.cache'))))
+
+    def teardown(self):
+        self.temp_dir.cleanup()
+
+
+BENCHMARKS = [
+    LoadSnapshotsBenchmark,
+    CleanupBenchmark,
+    BackupPlanBenchmark,
+    SystemdBootEntriesBenchmark,
+    RemoveBootSnapshotsBenchmark,
+    LoadEntriesBenchmark,
+    BootSnapshotNeededBenchmark,
+    CliStartupBenchmark,
+    CliSnapshotListBenchmark,
+]
+BENCHMARK_NAME_MAP = dict([(b.name, b) for b in BENCHMARKS])
+
+
+def run_cli(argv, setup='install_fakes(); '):
+    # Run the command line tool in a fresh interpreter, against the fakes. A
+    # failed run would time as a speed-up, so fails the benchmark instead.
+    subprocess.run(
+        [sys.executable, '-c', 'import sys; from tests.fakes import *; from btrfssnapshotmanager import cli; {0}sys.argv = {1!r}; cli.main()'.format(
+            setup, ['btrfs-snapshot-manager'] + [str(a) for a in argv])],
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        stdout=subprocess.DEVNULL,
+        check=True)
+
+def time_benchmark(benchmark_class, size, repeat):
+    timings = []
+    for i in range(repeat):
+        benchmark = benchmark_class()
+        benchmark.setup(size)
+        try:
+            start = time.perf_counter()
+            benchmark.run()
+            timings.append(time.perf_counter() - start)
+        finally:
+            benchmark.teardown()
+    return {
+        'min': min(timings),
+        'median': statistics.median(timings),
+        'repeat': repeat,
+    }
+
+def run_benchmarks(names, sizes, repeat):
+    results = {}
+    for name in names:
+        benchmark_class = BENCHMARK_NAME_MAP[name]
+        results[name] = {}
+        for size in (sizes if benchmark_class.sized else [None]):
+            result = time_benchmark(benchmark_class, size, repeat)
+            results[name][str(size)] = result
+            print("{0:<30} {1:>8} {2:>10.4f}s".format(name, str(size or '-'), result['min']), file=sys.stderr, flush=True)
+    return results
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))).stdout.decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(baseline, results, threshold):
+    # Compare the fastest timing of each benchmark, so noise from a busy
+    # machine is less likely to show up as a regression
+    regressions = 0
+    print("{0:<30} {1:>8} {2:>10} {3:>10} {4:>7}".format('benchmark', 'size', 'baseline', 'current', 'ratio'))
+    for name, sizes in results.items():
+        for size, result in sizes.items():
+            if name not in baseline or size not in baseline[name]:
+                continue
+            before = baseline[name][size]['min']
+            after = result['min']
+            ratio = after / before if before > 0 else float('inf')
+            flag = ''
+            if ratio > threshold:
+                flag = ' REGRESSION'
+                regressions += 1
+            print("{0:<30} {1:>8} {2:>9.4f}s {3:>9.4f}s {4:>6.2f}x{5}".format(name, size, before, after, ratio, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='benchmarks/run.py')
+    parser.add_argument('--sizes', default=','.join([str(s) for s in default_sizes]), help='comma separated numbers of snapshots, up to 100000')
+    parser.add_argument('--repeat', type=int, default=default_repeat, help='number of times to run each benchmark')
+    parser.add_argument('--benchmark', action='append', choices=[b.name for b in BENCHMARKS], dest='benchmarks', help='benchmark to run, can be given more than once, defaults to all')
+    parser.add_argument('--output', help='file to write JSON results to')
+    parser.add_argument('--compare', help='JSON results from an earlier run to compare against')
+    parser.add_argument('--threshold', type=float, default=default_threshold, help='slowdown ratio counted as a regression')
+    args = parser.parse_args()
+
+    LOG_CONFIG['level'] = 4
+    sizes = [int(s) for s in args.sizes.split(',')]
+    names = args.benchmarks or [b.name for b in BENCHMARKS]
+
+    results = run_benchmarks(names, sizes, args.repeat)
+    output = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'results': results,
+    }
+    if args.output is not None:
+        with open(args.output, 'w') as fh:
+            json.dump(output, fh, indent=2)
+    else:
+        print(json.dumps(output, indent=2))
+
+    if args.compare is not None:
+        with open(args.compare, 'r') as fh:
+            baseline = json.load(fh)
+        if compare(baseline['results'], results, args.threshold) > 0:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
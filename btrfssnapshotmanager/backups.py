@@ -1,8 +1,51 @@
 #!/usr/bin/python3
 
+from btrfssnapshotmanager.btrfs import *
+from btrfssnapshotmanager.journal import *
 from btrfssnapshotmanager.snapshots import *
+from btrfssnapshotmanager.ssh import *
+from btrfssnapshotmanager.transfer import *
 
 from pathlib import PosixPath, PurePosixPath
+import hashlib
+import re
+import shlex
+import threading
+
+
+rsync_sent_regex = re.compile(r'^Total bytes sent: ([\d,]+)', re.MULTILINE)
+default_inventory_max_age = None
+
+
+class BackupLimiter():
+
+    def __init__(self, per_host=None, per_device=None):
+        self.limits = {
+            'host': per_host,
+            'device': per_device,
+        }
+        self.semaphores = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, key):
+        semaphore = self._semaphore(key)
+        if semaphore is not None:
+            debug("Waiting for backup slot on {0} {1}".format(key[0], key[1]))
+            semaphore.acquire()
+
+    def release(self, key):
+        semaphore = self._semaphore(key)
+        if semaphore is not None:
+            semaphore.release()
+
+    def _semaphore(self, key):
+        limit = self.limits[key[0]]
+        if limit is None:
+            return None
+        with self.lock:
+            if key not in self.semaphores:
+                self.semaphores[key] = threading.Semaphore(limit)
+            return self.semaphores[key]
 
 
 class Backup():
@@ -12,79 +55,392 @@ class Backup():
         self.retention = {}
         self.retention_minimum = 0
         self.last_sync_file = None
+        self.limiter = None
+        self.transfer_pipeline = None
+        self.clone_sources = 0
+        self.catch_up = None
+        self.transferred_bytes = 0
+        self.transfer_seconds = 0.0
+        self.inventory_max_age = default_inventory_max_age
+
+    def run(self, sync=None):
+        # Run the backup, holding a slot for the target host or device
+        self.transferred_bytes = 0
+        self.transfer_seconds = 0.0
+        limit_key = self.limit_key()
+        if self.limiter is not None:
+            self.limiter.acquire(limit_key)
+        try:
+            self.backup(sync)
+        finally:
+            if self.limiter is not None:
+                self.limiter.release(limit_key)
+
+    def backup(self, sync=None):
+        if sync is None:
+            sync = self.plan_sync()
+        self.apply_sync(sync)
+
+    def plan_sync(self, snapshots=None, preview=False):
+        # Work out everything needed to bring the target in line with the
+        # given snapshots, which default to the subvolume's current ones,
+        # without changing anything. Unless previewing, the target is created
+        # if it doesn't exist yet.
+        if snapshots is None:
+            snapshots = self.subvol.snapshots
+        sync = BackupSync(self)
 
-    def backup(self):
         # Get list of source snapshots that should be on the target
-        source_snapshots = set()
-        for period in self.retention:
-            if period is None:
-                continue
-            period_snapshots = self.subvol.search_snapshots(periods=[period])
-            if len(period_snapshots) > self.retention[period]:
-                period_snapshots = period_snapshots[len(period_snapshots) - self.retention[period]:]
-            for s in period_snapshots:
-                source_snapshots.add(s)
-        source_snapshots = sorted(list(source_snapshots), key=lambda s: s.name)
+        source_snapshots = sorted(self.subvol.retention.keep(snapshots, self), key=lambda s: s.name)
         source_snapshot_names = [s.name for s in source_snapshots]
+        sync.source_snapshot_names = source_snapshot_names
         debug("Identified the following {0} snapshots that should be on target {1}:".format(self.subvol.name, self.location()))
         for s in source_snapshot_names:
             debug("-", s)
 
+        # Nothing to do if the target was last synced with these exact
+        # snapshots, so don't list what's on it
+        if self.target_in_sync(source_snapshot_names):
+            sync.in_sync = True
+            return sync
+
         # Get list of snapshots that exist on the target
-        self.ensure_target_exists()
-        target_snapshot_names = self.get_target_snapshot_names()
+        if preview:
+            target_snapshots = {}
+            if self.target_exists():
+                target_snapshots = self.list_target_snapshots()
+        else:
+            self.ensure_target_exists()
+            target_snapshots = self.list_target_snapshots()
         debug("Found the following {0} snapshots that exist on target {1}:".format(self.subvol.name, self.location()))
-        for s in target_snapshot_names:
+        for s in target_snapshots:
             debug("-", s)
 
+        # Incomplete transfers are deleted before anything else
+        for target_name, details in list(target_snapshots.items()):
+            if details.readonly is False:
+                debug("Target snapshot {0} is not readonly, indicating it is an imcomplete transfer".format(target_name))
+                sync.incomplete.append(target_name)
+                del target_snapshots[target_name]
+        sync.target_snapshots = dict(target_snapshots)
+        target_snapshot_names = list(target_snapshots.keys())
+
+        # Clean up after interrupted transfers that won't be resumed
+        source_snapshot_name_set = set(source_snapshot_names)
+        for name, entry in self.transfer_journal_entries().items():
+            if name not in source_snapshot_name_set or name in target_snapshots:
+                sync.discard[name] = entry
+
         # Enforce minimum retention
-        target_snapshots_keep = []
+        target_snapshots_keep = set()
         if len(source_snapshot_names) < self.retention_minimum:
             debug("Number of snapshots to retain is less than minimum")
             for target_snapshot_name in sorted(target_snapshot_names, key=lambda t: snapshot_name_parse(t)['date'], reverse=True):
-                if target_snapshot_name not in source_snapshot_names:
+                if target_snapshot_name not in source_snapshot_name_set:
                     debug("- Retain: {}".format(target_snapshot_name))
-                    target_snapshots_keep.append(target_snapshot_name)
+                    target_snapshots_keep.add(target_snapshot_name)
                     if len(source_snapshot_names) + len(target_snapshots_keep) >= self.retention_minimum:
                         break
 
-        # Delete target snapshots not needed any more
-        for target_snapshot_name in target_snapshot_names:
-            if target_snapshot_name not in source_snapshot_names and target_snapshot_name not in target_snapshots_keep:
-                self.delete_target(target_snapshot_name)
-
-        # Upload source snapshots not found on target
-        for i, source_snapshot in enumerate(source_snapshots):
-            if source_snapshot.name not in target_snapshot_names:
-                if i > 0:
-                    self.transfer_source_delta(source_snapshots[i - 1], source_snapshot)
+        # Upload source snapshots not found on target, each as a delta from the
+        # closest snapshot that exists on both sides
+        missing_snapshots = [s for s in source_snapshots if s.name not in target_snapshots]
+        if self.catch_up is not None and len(missing_snapshots) >= self.catch_up:
+            sync.catch_up = missing_snapshots
+        else:
+            for source_snapshot in missing_snapshots:
+                common_snapshots = self.common_snapshots(source_snapshot, target_snapshots, self.clone_sources + 1, snapshots)
+                if len(common_snapshots) > 0:
+                    sync.transfers.append((source_snapshot, common_snapshots[0], common_snapshots[1:]))
                 else:
-                    self.transfer_source(source_snapshot)
+                    sync.transfers.append((source_snapshot, None, []))
+                target_snapshots[source_snapshot.name] = self.transferred_target_snapshot(source_snapshot)
+
+        # Delete target snapshots not needed any more. This is done after
+        # uploading, so they're still available as parents until then.
+        for target_snapshot_name in target_snapshot_names:
+            if target_snapshot_name not in source_snapshot_name_set and target_snapshot_name not in target_snapshots_keep:
+                sync.deletes.append(target_snapshot_name)
+
+        return sync
+
+    def apply_sync(self, sync):
+        if sync.in_sync:
+            # Nothing needs transferring, and the target isn't contacted
+            if not self.target_known_to_exist():
+                self.invalidate_target_state()
+                raise SnapshotException("Target {0} for {1} is not available".format(self.location(), self.subvol.name))
+            info("Target {0} is already in sync with {1}, skipping".format(self.location(), self.subvol.name))
+            self.touch_last_sync_file()
+            return
+
+        # The target is about to change, so its cached state can't be trusted
+        # again until the sync has succeeded
+        self.invalidate_target_state()
+
+        if len(sync.incomplete) > 0:
+            self.delete_targets(sync.incomplete)
+
+        for name, entry in sync.discard.items():
+            debug("Discarding interrupted transfer of {0} to target {1}".format(name, self.location()))
+            self.discard_transfer(name, entry)
+            transfer_journal.finish(self.subvol.name, self.location(), name)
+
+        target_snapshots = dict(sync.target_snapshots)
+        if sync.catch_up is not None:
+            self.catch_up_sources(sync.catch_up, target_snapshots)
+        for source_snapshot, previous_source, clone_sources in sync.transfers:
+            if previous_source is not None:
+                self.transfer_source_delta(previous_source, source_snapshot, clone_sources)
+            else:
+                self.transfer_source(source_snapshot)
+            target_snapshots[source_snapshot.name] = self.transferred_target_snapshot(source_snapshot)
+
+        if len(sync.deletes) > 0:
+            self.delete_targets(sync.deletes)
+            for target_snapshot_name in sync.deletes:
+                del target_snapshots[target_snapshot_name]
 
         # Declare successful sync
+        self.save_target_state(target_snapshots, sync.source_snapshot_names)
+        self.touch_last_sync_file()
+
+    def touch_last_sync_file(self):
         if self.last_sync_file is not None:
             last_sync_file = PosixPath(self.subvol.snapshots_dir, self.last_sync_file)
             info("Touching file {0} to indicate successful backup sync between {1} and {2}".format(last_sync_file, self.subvol.name, self.location()))
-            cmd("touch {0}".format(last_sync_file))
+            run_command(['touch', last_sync_file])
 
     def location(self):
         raise Exception("Method must be overridden")
 
+    def limit_key(self):
+        raise Exception("Method must be overridden")
+
+    def target_exists(self):
+        raise Exception("Method must be overridden")
+
+    def target_known_to_exist(self):
+        # Whether a target last synced within inventory-max-age can be taken
+        # to still be there, without a round trip to it
+        return True
+
     def ensure_target_exists(self):
         raise Exception("Method must be overridden")
 
-    def get_target_snapshot_names(self):
+    def list_target_snapshots(self):
         raise Exception("Method must be overridden")
 
+    def get_target_snapshots(self):
+        return self.list_target_snapshots()
+
+    def get_target_snapshot_names(self):
+        return list(self.get_target_snapshots().keys())
+
+    def cached_target_snapshots(self, refresh=False):
+        # Snapshots on the target as of the last sync or listing, only asking
+        # the target itself if that's missing or too old
+        state = None
+        if not refresh:
+            state = self.target_state()
+        if state is not None:
+            debug("Using cached list of snapshots on target {0} from {1}".format(self.location(), state['updated']))
+            return dict([(name, target_snapshot_from_state(name, details)) for name, details in state['inventory'].items()])
+        target_snapshots = self.get_target_snapshots()
+        self.save_target_state(target_snapshots)
+        return target_snapshots
+
+    def target_state(self):
+        if self.inventory_max_age is None:
+            return None
+        state = target_state_store.get(self.subvol.name, self.location())
+        if state is None:
+            return None
+        try:
+            updated = datetime.fromisoformat(state['updated'])
+        except (KeyError, TypeError, ValueError):
+            return None
+        if datetime.now() - updated > self.inventory_max_age or not isinstance(state.get('inventory'), dict):
+            return None
+        return state
+
+    def target_in_sync(self, source_snapshot_names):
+        state = self.target_state()
+        if state is None or state['synced'] != source_snapshot_names:
+            return False
+        # Interrupted transfers still need cleaning up
+        return len(self.transfer_journal_entries()) == 0
+
+    def save_target_state(self, target_snapshots, synced=None):
+        if self.inventory_max_age is None:
+            return
+        inventory = dict([(name, target_snapshot_state(details)) for name, details in target_snapshots.items()])
+        target_state_store.save(self.subvol.name, self.location(), inventory, synced)
+
+    def invalidate_target_state(self):
+        target_state_store.invalidate(self.subvol.name, self.location())
+
+    def common_snapshots(self, source, target_snapshots, count, snapshots=None):
+        # Find snapshots on both the source and target, closest in time to the
+        # given source snapshot first, preferring older ones on a tie
+        if snapshots is None:
+            snapshots = self.subvol.snapshots
+        candidates = [s for s in snapshots if s is not source and s.name in target_snapshots]
+        candidates.sort(key=lambda s: (abs((s.date - source.date).total_seconds()), s.date > source.date))
+        common = []
+        for candidate in candidates:
+            if self.is_common_snapshot(candidate, target_snapshots[candidate.name]):
+                common.append(candidate)
+                if len(common) >= count:
+                    break
+        return common
+
+    def is_common_snapshot(self, source, target_details):
+        return True
+
+    def catch_up_sources(self, sources, target_snapshots):
+        # Send all the missing snapshots in a single stream, rather than
+        # setting up a transfer for each one
+        info("Target {0} is missing {1} snapshots, catching up in a single transfer".format(self.location(), len(sources)))
+        attempt = 1
+        while True:
+            remaining = [s for s in sources if s.name not in target_snapshots]
+            if len(remaining) == 0:
+                return
+            common_snapshots = self.common_snapshots(remaining[0], target_snapshots, self.clone_sources + 1)
+            if len(common_snapshots) == 0:
+                # Nothing on the target to base the stream on, so the first
+                # snapshot has to be sent in full by itself
+                self.transfer_source(remaining[0])
+                target_snapshots[remaining[0].name] = self.transferred_target_snapshot(remaining[0])
+                continue
+
+            try:
+                self.transfer_source_chain(remaining, common_snapshots)
+            except CommandException:
+                # Snapshots fully received before the failure are readonly on
+                # the target, so are kept, and only the rest are sent again
+                received_snapshots = self.get_target_snapshots()
+                received = [s for s in remaining if s.name in received_snapshots]
+                for s in received:
+                    target_snapshots[s.name] = received_snapshots[s.name]
+                warn("Catch-up transfer to target {0} failed after receiving {1} of {2} snapshots".format(self.location(), len(received), len(remaining)))
+                if self.cmd_attempts is None or attempt >= self.cmd_attempts:
+                    raise
+                attempt += 1
+                time.sleep(self.cmd_fail_delay)
+                warn("Retrying...")
+                continue
+
+            for s in remaining:
+                target_snapshots[s.name] = self.transferred_target_snapshot(s)
+            return
+
+    def transferred_target_snapshot(self, source):
+        return SubvolumeInfo(source.name)
+
+    def transfer_journal_entries(self):
+        return transfer_journal.target_entries(self.subvol.name, self.location())
+
+    def start_transfer(self, source, stage=None, **details):
+        # An interrupted transfer is only resumed if it was of this very
+        # snapshot, sent the same way. A snapshot deleted and created again
+        # with the same name has a different UUID, so is sent from scratch.
+        details['mechanism'] = self.mechanism
+        details['source_uuid'] = None
+        if source.info is not None:
+            details['source_uuid'] = source.info.uuid
+        entry = transfer_journal.get(self.subvol.name, self.location(), source.name)
+        if entry is not None:
+            if all([entry.get(k) == v for k, v in details.items()]):
+                info("Resuming interrupted transfer of {0} to target {1}".format(source.name, self.location()))
+                return entry
+            debug("Interrupted transfer of {0} to target {1} was of a different snapshot or from a different parent, starting again".format(source.name, self.location()))
+            self.discard_transfer(source.name, entry)
+            transfer_journal.finish(self.subvol.name, self.location(), source.name)
+        if stage is not None:
+            details['stage'] = stage
+        return transfer_journal.start(self.subvol.name, self.location(), source.name, **details)
+
+    def update_transfer(self, source, **details):
+        return transfer_journal.update(self.subvol.name, self.location(), source.name, **details)
+
+    def finish_transfer(self, source):
+        transfer_journal.finish(self.subvol.name, self.location(), source.name)
+
+    def discard_transfer(self, target_name, entry):
+        pass
+
+    def run_transfer_pipeline(self, send_argv, receive_argv, attempts=None, fail_delay=None):
+        transfer_pipeline = self.transfer_pipeline
+        if transfer_pipeline is None:
+            transfer_pipeline = TransferPipeline()
+        stats = transfer_pipeline.run(send_argv, transfer_pipeline.receive_argvs(receive_argv), attempts=attempts, fail_delay=fail_delay)
+        self.add_transfer_stats(stats['bytes'], stats['seconds'])
+        return stats
+
+    def run_rsync(self, args, attempts=None, fail_delay=None):
+        result = run_command_result(['rsync', '--stats'] + args, attempts=attempts, fail_delay=fail_delay)
+        if result.code != 0:
+            raise CommandException(result.command, result.code, result.stderr)
+        sent_match = rsync_sent_regex.search(result.stdout)
+        if sent_match:
+            self.add_transfer_stats(int(sent_match.group(1).replace(',', '')), result.wall_time)
+        return result.stdout
+
+    def add_transfer_stats(self, transferred_bytes, seconds):
+        self.transferred_bytes += transferred_bytes
+        self.transfer_seconds += seconds
+
     def transfer_source(self, source):
         raise Exception("Method must be overridden")
 
-    def transfer_source_delta(self, previous_source, source):
+    def transfer_source_delta(self, previous_source, source, clone_sources=None):
+        raise Exception("Method must be overridden")
+
+    def transfer_source_chain(self, sources, clone_sources):
         raise Exception("Method must be overridden")
 
     def delete_target(self, target_name):
         raise Exception("Method must be overridden")
 
+    def delete_targets(self, target_names):
+        for target_name in target_names:
+            self.delete_target(target_name)
+
+
+class BackupSync():
+
+    # What a backup run will do to bring its target in line with the source
+
+    def __init__(self, backup):
+        self.backup = backup
+        self.in_sync = False
+        self.source_snapshot_names = []
+        self.target_snapshots = {}
+        self.incomplete = []
+        self.discard = {}
+        self.catch_up = None
+        self.transfers = []
+        self.deletes = []
+
+
+def target_snapshot_state(details):
+    return {
+        'readonly': details.readonly,
+        'uuid': details.uuid,
+        'received_uuid': details.received_uuid,
+        'generation': details.generation,
+    }
+
+def target_snapshot_from_state(name, state):
+    return SubvolumeInfo(
+        name,
+        readonly=state.get('readonly'),
+        uuid=state.get('uuid'),
+        received_uuid=state.get('received_uuid'),
+        generation=state.get('generation'))
+
 
 class LocalBackup(Backup):
 
@@ -92,26 +448,38 @@ class LocalBackup(Backup):
 
     def __init__(self, subvol, path):
         self.path = PosixPath(path)
+        self.cmd_attempts = None
+        self.cmd_fail_delay = None
         super().__init__(subvol)
 
     def location(self):
         return str(self.path)
 
+    def limit_key(self):
+        return ('device', filesystem_device(self.path))
+
+    def target_exists(self):
+        return self.path.is_dir()
+
+    def target_known_to_exist(self):
+        # Free to check, so an unmounted drive isn't recorded as synced
+        return self.target_exists()
+
     def ensure_target_exists(self):
-        if not self.path.is_dir():
+        if not self.target_exists():
             info("Target location doesn't exist, creating {0}".format(self.location()))
             self.path.mkdir(mode=0o700, parents=True)
 
-    def get_target_snapshot_names(self):
+    def list_target_snapshots(self):
         debug("Fetching list of snapshots on target {0}".format(self.location()))
-        names = []
+        snapshots = {}
         for child in self.path.iterdir():
             if child.is_dir():
                 snapshot_details = snapshot_name_parse(child.name)
                 if snapshot_details is not None:
-                    names.append(child.name)
+                    snapshots[child.name] = SubvolumeInfo(child.name)
 
-        return names
+        return snapshots
 
 
 class RemoteBackup(Backup):
@@ -130,35 +498,46 @@ class RemoteBackup(Backup):
     def location(self):
         return "{0}:{1}".format(self.host, self.path)
 
+    def limit_key(self):
+        return ('host', self.host)
+
+    def target_exists(self):
+        return self.remote_directory_exists(self.path)
+
+    def remote_directory_exists(self, path):
+        # Runs under whatever shell the remote user has, so only POSIX sh
+        exists = run_command(self._ssh_argv("if {0} ; then echo 'yes' ; fi".format(shlex.join(['test', '-d', str(path)]))),
+            attempts=self.cmd_attempts, fail_delay=self.cmd_fail_delay)
+        return exists == 'yes'
+
     def ensure_target_exists(self):
-        exists = cmd("{0} \"if [[ -d '{1}' ]] ; then echo 'yes' ; fi\"".format(self._ssh_command(), self.path), attempts=self.cmd_attempts, fail_delay=self.cmd_fail_delay)
-        if exists != 'yes':
+        if not self.target_exists():
             info("Target location doesn't exist, creating {0}".format(self.location()))
-            cmd("{0} \"sudo mkdir -p {1}\"".format(self._ssh_command(), self.path), attempts=self.cmd_attempts, fail_delay=self.cmd_fail_delay)
+            run_command(self._ssh_argv(shlex.join(['sudo', 'mkdir', '-p', str(self.path)])), attempts=self.cmd_attempts, fail_delay=self.cmd_fail_delay)
 
-    def get_target_snapshot_names(self):
+    def list_target_snapshots(self):
         debug("Fetching list of snapshots on target " + self.location())
-        out = cmd("{0} \"ls -1 {1}/\"".format(self._ssh_command(), self.path), attempts=self.cmd_attempts, fail_delay=self.cmd_fail_delay)
-        names = []
-        remote_files = [n.strip() for n in out.split("\n") if n.strip() != '']
-        for remote_file in remote_files:
+        snapshots = {}
+        for remote_file in stream_command(self._ssh_argv(shlex.join(['ls', '-1', "{0}/".format(self.path)])), attempts=self.cmd_attempts, fail_delay=self.cmd_fail_delay):
+            remote_file = remote_file.strip()
             snapshot_details = snapshot_name_parse(remote_file)
             if snapshot_details is not None:
-                names.append(remote_file)
-        return names
+                snapshots[remote_file] = SubvolumeInfo(remote_file)
+        return snapshots
 
-    def _ssh_command(self):
-        ssh_command = "ssh "
-        if self.ssh_options is not None:
-            ssh_command += self.ssh_options + " "
-        if self.user is not None:
-            ssh_command += self.user + "@"
-        ssh_command += self.host
-        return ssh_command
+    def _ssh_connection(self):
+        return ssh_connection_pool.get(self.host, self.user, self.ssh_options)
+
+    def _ssh_argv(self, remote_command):
+        ssh_argv = ['ssh'] + self._ssh_connection().ssh_argv()
+        ssh_argv.append(self._ssh_connection().destination())
+        ssh_argv.append(remote_command)
+        return ssh_argv
 
     def _ssh_options(self):
-        if self.ssh_options is not None:
-            return " " + self.ssh_options
+        ssh_options = self._ssh_connection().ssh_options()
+        if ssh_options != '':
+            return " " + ssh_options
         return ""
 
     def _user(self):
@@ -169,65 +548,223 @@ class RemoteBackup(Backup):
 
 # Btrfs
 
+def btrfs_send_argv(source, previous_source=None, clone_sources=None):
+    argv = ['btrfs', 'send']
+    if previous_source is not None:
+        argv += ['-p', str(previous_source.path)]
+    if clone_sources is not None:
+        for clone_source in clone_sources:
+            argv += ['-c', str(clone_source.path)]
+    return argv + [str(source.path)]
+
+def btrfs_send_chain_argv(sources, clone_sources):
+    # Each snapshot in the stream is sent relative to the best of the clone
+    # sources and the snapshots sent before it
+    argv = ['btrfs', 'send']
+    for clone_source in clone_sources:
+        argv += ['-c', str(clone_source.path)]
+    return argv + [str(s.path) for s in sources]
+
+def btrfs_is_common_snapshot(source, target_details):
+    # The target snapshot can only be used as a parent if it was received
+    # from this exact source snapshot
+    source_details = source.info
+    if source_details is None or source_details.uuid is None:
+        return False
+    return target_details.received_uuid == source_details.uuid
+
+def btrfs_transferred_target_snapshot(source):
+    source_details = source.info
+    received_uuid = None
+    if source_details is not None:
+        received_uuid = source_details.uuid
+    return SubvolumeInfo(source.name, readonly=True, received_uuid=received_uuid)
+
+def delete_incomplete_snapshots(backup, snapshots):
+    for target_name, details in list(snapshots.items()):
+        if not details.readonly:
+            debug("Target snapshot {0} is not readonly, indicating it is an imcomplete transfer. Deleting it.".format(target_name))
+            backup.delete_target(target_name)
+            del snapshots[target_name]
+    return snapshots
+
 class LocalBtrfsBackup(LocalBackup):
 
     mechanism = 'btrfs'
 
-    def get_target_snapshot_names(self):
-        names = super().get_target_snapshot_names()
-        for target_name in names.copy():
-            flags = cmd("sudo btrfs subvolume show {0} | grep -E \"^\\s*Flags:\" | sed -e \"s/\\s*Flags:\\s*//\"".format(PosixPath(self.path, target_name))).split()
-            debug("Snapshot {0} flags: '{1}'".format(target_name, ','.join(flags)))
-            if 'readonly' not in flags:
-                debug("Target snapshot {0} is not readonly, indicating it is an imcomplete transfer. Deleting it.".format(target_name))
-                self.delete_target(target_name)
-                names.remove(target_name)
+    def get_target_snapshots(self):
+        return delete_incomplete_snapshots(self, self.list_target_snapshots())
 
-        return names
+    def list_target_snapshots(self):
+        snapshots = super().list_target_snapshots()
+        for target_name in list(snapshots.keys()):
+            details = get_btrfs_backend().subvolume_show(PosixPath(self.path, target_name))
+            if details is None:
+                details = SubvolumeInfo(target_name, readonly=False)
+            debug("Target snapshot {0} readonly: {1}, received UUID: {2}, generation: {3}".format(
+                target_name, details.readonly, details.received_uuid, details.generation))
+            snapshots[target_name] = details
+        return snapshots
 
     def transfer_source(self, source):
         info("Transferring via btrfs snapshot {0} to target {1}".format(source.path, self.location()))
-        cmd("btrfs send {0} | btrfs receive {1}".format(source.path, self.path, source.name))
+        self.transfer(source)
 
-    def transfer_source_delta(self, previous_source, source):
+    def transfer_source_delta(self, previous_source, source, clone_sources=None):
         info("Transferring via btrfs snapshot {0} (as delta from {1}) to target {2}".format(source.path, previous_source.path, self.location()))
-        cmd("btrfs send -p {0} {1} | btrfs receive {2}".format(previous_source.path, source.path, self.path))
+        self.transfer(source, previous_source, clone_sources)
+
+    def is_common_snapshot(self, source, target_details):
+        return btrfs_is_common_snapshot(source, target_details)
+
+    def transferred_target_snapshot(self, source):
+        return btrfs_transferred_target_snapshot(source)
+
+    def transfer_source_chain(self, sources, clone_sources):
+        info("Transferring via btrfs snapshots {0} to {1} (as deltas from {2}) to target {3}".format(sources[0].path, sources[-1].name, clone_sources[0].path, self.location()))
+        self.receive(btrfs_send_chain_argv(sources, clone_sources))
+
+    def transfer(self, source, previous_source=None, clone_sources=None):
+        self.receive(btrfs_send_argv(source, previous_source, clone_sources))
+
+    def receive(self, send_argv):
+        self.run_transfer_pipeline(send_argv, ['btrfs', 'receive', str(self.path)])
 
     def delete_target(self, target_name):
-        info("Deleting via btrfs snapshot {0} on target {1}".format(target_name, self.location()))
-        cmd("btrfs subvolume delete --commit-each {0}".format(PosixPath(self.path, target_name)))
+        self.delete_targets([target_name])
+
+    def delete_targets(self, target_names):
+        for target_name in target_names:
+            info("Deleting via btrfs snapshot {0} on target {1}".format(target_name, self.location()))
+        get_btrfs_backend().subvolume_delete([PosixPath(self.path, t) for t in target_names])
 
 
 class RemoteBtrfsBackup(RemoteBackup):
 
     mechanism = 'btrfs'
 
-    def get_target_snapshot_names(self):
-        names = super().get_target_snapshot_names()
-        for target_name in names.copy():
-            flags = cmd("{0} \"sudo btrfs subvolume show {1} | grep -E \\\"^\\s*Flags:\\\" | sed -e \\\"s/\\s*Flags:\\s*//\\\"\"".format(
-                self._ssh_command(), PurePosixPath(self.path, target_name))).split()
-            debug("Target snapshot {0} flags: '{1}'".format(target_name, ','.join(flags)))
-            if 'readonly' not in flags:
-                debug("Target snapshot {0} is not readonly, indicating it is an imcomplete transfer. Deleting it.".format(target_name))
-                self.delete_target(target_name)
-                names.remove(target_name)
-
-        return names
+    def __init__(self, subvol, host, user, ssh_options, path):
+        self.spool_path = None
+        super().__init__(subvol, host, user, ssh_options, path)
+
+    def get_target_snapshots(self):
+        return delete_incomplete_snapshots(self, self.list_target_snapshots())
+
+    def list_target_snapshots(self):
+        # Fetch details of every snapshot on the target in a single remote command
+        debug("Fetching list of snapshots on target " + self.location())
+        marker = '@@@'
+        script = "cd {0} || exit 1 ; for d in * ; do if [ -d \"$d\" ] ; then echo \"{1} $d\" ; btrfs subvolume show \"$d\" 2>/dev/null ; fi ; done".format(
+            shlex.quote(str(self.path)), marker)
+        out = stream_command(self._ssh_argv("sudo sh -c " + shlex.quote(script)), attempts=self.cmd_attempts, fail_delay=self.cmd_fail_delay)
+        snapshots = {}
+        for name, details in subvolume_show_list_parse(out, marker).items():
+            if snapshot_name_parse(name) is not None:
+                debug("Target snapshot {0} readonly: {1}, received UUID: {2}, generation: {3}".format(
+                    name, details.readonly, details.received_uuid, details.generation))
+                snapshots[name] = details
+        return snapshots
 
     def transfer_source(self, source):
         info("Transferring via btrfs snapshot {0} to target {1}".format(source.path, self.location()))
-        cmd("btrfs send {0} | {1} \"sudo btrfs receive {2}\"".format(source.path, self._ssh_command(), self.path),
-            attempts=self.cmd_attempts, fail_delay=self.cmd_fail_delay)
+        self.transfer(source)
 
-    def transfer_source_delta(self, previous_source, source):
+    def transfer_source_delta(self, previous_source, source, clone_sources=None):
         info("Transferring via btrfs snapshot {0} (as delta from {1}) to target {2}".format(source.path, previous_source.path, self.location()))
-        cmd("btrfs send -p {0} {1} | {2} \"sudo btrfs receive {3}\"".format(previous_source.path, source.path, self._ssh_command(), self.path),
+        self.transfer(source, previous_source, clone_sources)
+
+    def is_common_snapshot(self, source, target_details):
+        return btrfs_is_common_snapshot(source, target_details)
+
+    def transferred_target_snapshot(self, source):
+        return btrfs_transferred_target_snapshot(source)
+
+    def transfer(self, source, previous_source=None, clone_sources=None):
+        if self.spool_path is not None:
+            self.transfer_spooled(source, previous_source, clone_sources)
+            return
+        self.receive(btrfs_send_argv(source, previous_source, clone_sources), self.cmd_attempts)
+
+    def transfer_source_chain(self, sources, clone_sources):
+        info("Transferring via btrfs snapshots {0} to {1} (as deltas from {2}) to target {3}".format(sources[0].path, sources[-1].name, clone_sources[0].path, self.location()))
+        # Not retried here, as snapshots already received would be sent again
+        self.receive(btrfs_send_chain_argv(sources, clone_sources), None)
+
+    def receive(self, send_argv, attempts):
+        # Any compression happens locally, decompression on the target
+        transfer_pipeline = self.transfer_pipeline
+        if transfer_pipeline is None:
+            transfer_pipeline = TransferPipeline()
+        receive_command = transfer_pipeline.receive_command_line(['sudo', 'btrfs', 'receive', str(self.path)])
+        stats = transfer_pipeline.run(send_argv, [self._ssh_argv(receive_command)], attempts=attempts, fail_delay=self.cmd_fail_delay)
+        self.add_transfer_stats(stats['bytes'], stats['seconds'])
+
+    def transfer_spooled(self, source, previous_source, clone_sources):
+        # Spool the send stream to a local file, then upload it with rsync,
+        # which picks up where an interrupted upload left off. Each stage is
+        # recorded in the transfer journal, so a later attempt resumes from
+        # the stage that failed.
+        parent = None
+        if previous_source is not None:
+            parent = previous_source.name
+        clones = [c.name for c in clone_sources or []]
+        spool_file = self.spool_file(source.name)
+        remote_spool_file = self.remote_spool_file(source.name)
+        entry = self.start_transfer(source, parent=parent, clone_sources=clones, compression=self.transfer_pipeline.compression,
+            spool=str(spool_file), stage='spooling')
+
+        # The upload appends to what's already on the target, which is only
+        # right if it's the start of this same spooled stream
+        if entry['stage'] == 'uploading' and not spool_file.is_file():
+            debug("Spooled btrfs snapshot {0} is missing, spooling it again".format(spool_file))
+            self.discard_transfer(source.name, entry)
+            entry = self.update_transfer(source, stage='spooling')
+
+        if entry['stage'] == 'spooling':
+            info("Spooling btrfs snapshot {0} to {1}".format(source.path, spool_file))
+            spool_file.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+            self.transfer_pipeline.run(btrfs_send_argv(source, previous_source, clone_sources), [['tee', str(spool_file)]])
+            entry = self.update_transfer(source, stage='uploading')
+
+        if entry['stage'] == 'uploading':
+            info("Uploading spooled btrfs snapshot {0} to target {1}".format(source.name, self.location()))
+            run_command(self._ssh_argv(shlex.join(['sudo', 'mkdir', '-p', str(remote_spool_file.parent)])),
+                attempts=self.cmd_attempts, fail_delay=self.cmd_fail_delay)
+            self.run_rsync(['--partial', '--append-verify', '--rsync-path=sudo rsync', '-e', "ssh{0}{1}".format(self._ssh_options(), self._user()),
+                    entry['spool'], "{0}:{1}/".format(self.host, remote_spool_file.parent)],
+                attempts=self.cmd_attempts, fail_delay=self.cmd_fail_delay)
+            entry = self.update_transfer(source, stage='receiving')
+
+        # Not retried here - a partially received snapshot isn't readonly, so
+        # it's deleted on the next run before receiving again
+        info("Receiving spooled btrfs snapshot {0} on target {1}".format(source.name, self.location()))
+        run_command(self._ssh_argv("{0} | {1}".format(
+            shlex.join(['sudo', 'cat', str(remote_spool_file)]), self.transfer_pipeline.receive_command_line(['sudo', 'btrfs', 'receive', str(self.path)]))))
+
+        self.discard_transfer(source.name, entry)
+        self.finish_transfer(source)
+
+    def spool_file(self, target_name):
+        target_key = hashlib.sha1("{0}\0{1}".format(self.subvol.name, self.location()).encode('utf-8')).hexdigest()[0:16]
+        return PosixPath(self.spool_path, target_key, target_name + '.btrfs')
+
+    def remote_spool_file(self, target_name):
+        return PurePosixPath(self.path, '.spool', target_name + '.btrfs')
+
+    def discard_transfer(self, target_name, entry):
+        if 'spool' in entry:
+            PosixPath(entry['spool']).unlink(missing_ok=True)
+        run_command(self._ssh_argv(shlex.join(['sudo', 'rm', '-f', str(self.remote_spool_file(target_name))])),
             attempts=self.cmd_attempts, fail_delay=self.cmd_fail_delay)
 
     def delete_target(self, target_name):
-        info("Deleting via btrfs snapshot {0} on target {1}".format(target_name, self.location()))
-        cmd("{0} \"sudo btrfs subvolume delete {1}/{2}\"".format(self._ssh_command(), self.path, target_name),
+        self.delete_targets([target_name])
+
+    def delete_targets(self, target_names):
+        # All in one remote command
+        for target_name in target_names:
+            info("Deleting via btrfs snapshot {0} on target {1}".format(target_name, self.location()))
+        run_command(self._ssh_argv(shlex.join(['sudo', 'btrfs', 'subvolume', 'delete'] + [str(PurePosixPath(self.path, t)) for t in target_names])),
             attempts=self.cmd_attempts, fail_delay=self.cmd_fail_delay)
 
 
@@ -251,23 +788,35 @@ class LocalRsyncBackup(LocalBackup):
 
     def transfer_source(self, source):
         info("Transferring via rsync snapshot {0} to target temp {1}".format(source.path, self.temp_location()))
-        cmd("rsync -a --delete {0} {1}/".format(source.path, self.temp_path()))
+        self.start_transfer(source)
+        self.run_rsync(['-a', '--partial', '--delete', source.path, "{0}/".format(self.temp_path())])
         self.move_target_snapshot_from_temp(source)
+        self.finish_transfer(source)
 
-    def transfer_source_delta(self, previous_source, source):
+    def transfer_source_delta(self, previous_source, source, clone_sources=None):
         info("Transferring via rsync snapshot {0} (as delta from {1}) to target temp {2}".format(source.path, previous_source.path, self.temp_location()))
-        cmd("rsync -a --delete --link-dest={4}/{2}/ {0}/ {1}/{3}".format(source.path, self.temp_path(), previous_source.name, source.name, self.path))
+        self.start_transfer(source)
+        self.run_rsync(['-a', '--partial', '--delete', "--link-dest={0}/{1}/".format(self.path, previous_source.name),
+            "{0}/".format(source.path), "{0}/{1}".format(self.temp_path(), source.name)])
         self.move_target_snapshot_from_temp(source)
+        self.finish_transfer(source)
 
     def delete_target(self, target_name):
-        info("Deleting via rsync snapshot {0} on target {1}".format(target_name, self.location()))
-        cmd("rm -rf {0}".format(PosixPath(self.path, target_name)))
+        self.delete_targets([target_name])
+
+    def delete_targets(self, target_names):
+        for target_name in target_names:
+            info("Deleting via rsync snapshot {0} on target {1}".format(target_name, self.location()))
+        run_command(['rm', '-rf'] + [PosixPath(self.path, t) for t in target_names])
+
+    def discard_transfer(self, target_name, entry):
+        run_command(['rm', '-rf', PosixPath(self.temp_path(), target_name)])
 
     def move_target_snapshot_from_temp(self, source):
         move_from = PosixPath(self.temp_path(), source.name)
         move_to = PosixPath(self.path, source.name)
         info("Moving via rsync target snapshot {0} to {1}".format(move_from, move_to))
-        cmd("mv {0} {1}".format(move_from, move_to))
+        run_command(['mv', move_from, move_to])
 
 
 class RemoteRsyncBackup(RemoteBackup):
@@ -282,32 +831,45 @@ class RemoteRsyncBackup(RemoteBackup):
 
     def ensure_target_exists(self):
         super().ensure_target_exists()
-        exists = cmd("{0} \"if [[ -d '{1}' ]] ; then echo 'yes' ; fi\"".format(self._ssh_command(), self.temp_path()), attempts=self.cmd_attempts, fail_delay=self.cmd_fail_delay)
-        if exists != 'yes':
+        if not self.remote_directory_exists(self.temp_path()):
             info("Target temp location doesn't exist, creating {0}".format(self.temp_location()))
-            cmd("{0} \"sudo mkdir -p {1}\"".format(self._ssh_command(), self.temp_path()), attempts=self.cmd_attempts, fail_delay=self.cmd_fail_delay)
+            run_command(self._ssh_argv(shlex.join(['sudo', 'mkdir', '-p', str(self.temp_path())])), attempts=self.cmd_attempts, fail_delay=self.cmd_fail_delay)
 
     def transfer_source(self, source):
         info("Transferring via rsync snapshot {0} to target temp {1}".format(source.path, self.temp_location()))
-        cmd("rsync -a --delete --rsync-path=\"sudo rsync\" -e \"ssh{0}{1}\" {3} {2}:{4}/".format(
-                self._ssh_options(), self._user(), self.host, source.path, self.temp_path()),
+        self.start_transfer(source)
+        self.run_rsync(['-a', '--partial', '--delete', '--rsync-path=sudo rsync', '-e', "ssh{0}{1}".format(self._ssh_options(), self._user()),
+                source.path, "{0}:{1}/".format(self.host, self.temp_path())],
             attempts=self.cmd_attempts, fail_delay=self.cmd_fail_delay)
         self.move_target_snapshot_from_temp(source)
+        self.finish_transfer(source)
 
-    def transfer_source_delta(self, previous_source, source):
+    def transfer_source_delta(self, previous_source, source, clone_sources=None):
         info("Transferring via rsync snapshot {0} (as delta from {1}) to target temp {2}".format(source.path, previous_source.path, self.temp_location()))
-        cmd("rsync -a --delete --link-dest={7}/{6}/ --rsync-path=\"sudo rsync\" -e \"ssh{0}{1}\" {3}/ {2}:{5}/{4}/".format(
-                self._ssh_options(), self._user(), self.host, source.path, source.name, self.temp_path(), previous_source.name, self.path),
+        self.start_transfer(source)
+        self.run_rsync(['-a', '--partial', '--delete', "--link-dest={0}/{1}/".format(self.path, previous_source.name), '--rsync-path=sudo rsync',
+                '-e', "ssh{0}{1}".format(self._ssh_options(), self._user()),
+                "{0}/".format(source.path), "{0}:{1}/{2}/".format(self.host, self.temp_path(), source.name)],
             attempts=self.cmd_attempts, fail_delay=self.cmd_fail_delay)
         self.move_target_snapshot_from_temp(source)
+        self.finish_transfer(source)
 
     def delete_target(self, target_name):
-        info("Deleting via rsync snapshot {0} on target {1}".format(target_name, self.location()))
-        cmd("{0} \"sudo rm -rf {1}/{2}\"".format(self._ssh_command(), self.path, target_name),
+        self.delete_targets([target_name])
+
+    def delete_targets(self, target_names):
+        # All in one remote command
+        for target_name in target_names:
+            info("Deleting via rsync snapshot {0} on target {1}".format(target_name, self.location()))
+        run_command(self._ssh_argv(shlex.join(['sudo', 'rm', '-rf'] + [str(PurePosixPath(self.path, t)) for t in target_names])),
+            attempts=self.cmd_attempts, fail_delay=self.cmd_fail_delay)
+
+    def discard_transfer(self, target_name, entry):
+        run_command(self._ssh_argv(shlex.join(['sudo', 'rm', '-rf', str(PurePosixPath(self.temp_path(), target_name))])),
             attempts=self.cmd_attempts, fail_delay=self.cmd_fail_delay)
 
     def move_target_snapshot_from_temp(self, source):
         move_from = PurePosixPath(self.temp_path(), source.name)
         move_to = PurePosixPath(self.path, source.name)
         info("Moving via rsync target snapshot {0} to {1}".format(move_from, move_to))
-        cmd("{0} \"sudo mv {1} {2}\"".format(self._ssh_command(), move_from, move_to))
+        run_command(self._ssh_argv(shlex.join(['sudo', 'mv', str(move_from), str(move_to)])))
@@ -0,0 +1,392 @@
+#!/usr/bin/python3
+
+from btrfssnapshotmanager.common import *
+
+from pathlib import PosixPath
+import errno
+import fcntl
+import itertools
+import struct
+import threading
+
+
+BTRFS_IOCTL_MAGIC = 0x94
+BTRFS_FIRST_FREE_OBJECTID = 256
+BTRFS_ROOT_SUBVOL_RDONLY = 1 << 0
+BTRFS_SUBVOL_RDONLY = 1 << 1
+
+# struct btrfs_ioctl_vol_args
+btrfs_vol_args = struct.Struct('=q4088s')
+# struct btrfs_ioctl_vol_args_v2
+btrfs_vol_args_v2 = struct.Struct('=qQQ32s4040s')
+# struct btrfs_ioctl_get_subvol_info_args
+btrfs_get_subvol_info_args = struct.Struct('=Q256sQQQQ16s16s16sQQQQ' + 'QI4x' * 4 + '8Q')
+btrfs_transid = struct.Struct('=Q')
+
+def _ioc(direction, number, size):
+    return (direction << 30) | (size << 16) | (BTRFS_IOCTL_MAGIC << 8) | number
+
+BTRFS_IOC_SUBVOL_CREATE = _ioc(1, 14, btrfs_vol_args.size)
+BTRFS_IOC_SNAP_DESTROY = _ioc(1, 15, btrfs_vol_args.size)
+BTRFS_IOC_WAIT_SYNC = _ioc(1, 22, btrfs_transid.size)
+BTRFS_IOC_SNAP_CREATE_V2 = _ioc(1, 23, btrfs_vol_args_v2.size)
+BTRFS_IOC_START_SYNC = _ioc(2, 24, btrfs_transid.size)
+BTRFS_IOC_GET_SUBVOL_INFO = _ioc(2, 60, btrfs_get_subvol_info_args.size)
+
+# Errors meaning the kernel or filesystem doesn't support an ioctl
+btrfs_ioctl_unsupported_errors = (errno.ENOTTY, errno.EINVAL, errno.EOPNOTSUPP)
+
+
+class SubvolumeInfo():
+
+    def __init__(self, name, readonly=None, uuid=None, parent_uuid=None, received_uuid=None, generation=None, top_level_path=None):
+        self.name = name
+        self.readonly = readonly
+        self.uuid = uuid
+        self.parent_uuid = parent_uuid
+        self.received_uuid = received_uuid
+        self.generation = generation
+        self.top_level_path = top_level_path
+
+
+class BtrfsBackend():
+
+    name = None
+
+    def subvolume_show(self, path):
+        raise Exception("Method must be overridden")
+
+    def subvolume_top_level_path(self, path):
+        raise Exception("Method must be overridden")
+
+    def subvolume_list(self, path):
+        raise Exception("Method must be overridden")
+
+    def subvolume_create(self, path):
+        raise Exception("Method must be overridden")
+
+    def subvolume_snapshot(self, source, dest, readonly=True):
+        raise Exception("Method must be overridden")
+
+    def subvolume_delete(self, paths):
+        raise Exception("Method must be overridden")
+
+    def subvolume_sync(self, path):
+        raise Exception("Method must be overridden")
+
+    def directory_exists(self, path):
+        raise Exception("Method must be overridden")
+
+
+class CommandBtrfsBackend(BtrfsBackend):
+
+    # Runs the btrfs command line tool
+
+    name = 'command'
+
+    def subvolume_show(self, path):
+        try:
+            out = run_command(['btrfs', 'subvolume', 'show', path])
+        except CommandException:
+            return None
+        return subvolume_show_parse(PosixPath(path).name, out)
+
+    def subvolume_top_level_path(self, path):
+        details = CommandBtrfsBackend.subvolume_show(self, path)
+        if details is None:
+            raise SnapshotException("Path {0} is not a valid btrfs subvolume".format(path))
+        return details.top_level_path
+
+    def subvolume_list(self, path):
+        return [child.name for child in PosixPath(path).iterdir() if child.is_dir()]
+
+    def subvolume_create(self, path):
+        run_command(['btrfs', 'subvolume', 'create', path])
+
+    def subvolume_snapshot(self, source, dest, readonly=True):
+        if readonly:
+            run_command(['btrfs', 'subvolume', 'snapshot', '-r', source, dest])
+        else:
+            run_command(['btrfs', 'subvolume', 'snapshot', source, dest])
+
+    def subvolume_delete(self, paths):
+        run_command(['btrfs', 'subvolume', 'delete', '--commit-after'] + list(paths))
+
+    def subvolume_sync(self, path):
+        run_command(['btrfs', 'subvolume', 'sync', path])
+
+    def directory_exists(self, path):
+        return PosixPath(path).is_dir()
+
+
+class IoctlBtrfsBackend(CommandBtrfsBackend):
+
+    # Talks to the kernel directly with btrfs ioctls, saving a process per
+    # operation. Falls back to the btrfs command for anything the kernel or
+    # filesystem doesn't support.
+
+    name = 'ioctl'
+
+    def subvolume_show(self, path):
+        try:
+            fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+        try:
+            buffer = bytearray(btrfs_get_subvol_info_args.size)
+            fcntl.ioctl(fd, BTRFS_IOC_GET_SUBVOL_INFO, buffer)
+            inode = os.fstat(fd).st_ino
+        except OSError as e:
+            if e.errno not in btrfs_ioctl_unsupported_errors + (errno.EPERM,):
+                raise
+            debug("Could not read subvolume {0} details from kernel ({1}), falling back to btrfs command".format(path, e.strerror))
+            return super().subvolume_show(path)
+        finally:
+            os.close(fd)
+
+        # The ioctl describes the subvolume containing the path, so check the
+        # path is the subvolume itself
+        if inode != BTRFS_FIRST_FREE_OBJECTID:
+            return None
+
+        fields = btrfs_get_subvol_info_args.unpack(buffer)
+        return SubvolumeInfo(
+            PosixPath(path).name,
+            readonly=(fields[5] & BTRFS_ROOT_SUBVOL_RDONLY) != 0,
+            uuid=_uuid_bytes(fields[6]),
+            parent_uuid=_uuid_bytes(fields[7]),
+            received_uuid=_uuid_bytes(fields[8]),
+            generation=fields[4],
+        )
+
+    def subvolume_top_level_path(self, path):
+        # The path from the top level of a mounted btrfs filesystem is the
+        # mount's root, plus the path below the mount point
+        mount = mount_info(path)
+        if mount is None or mount['fstype'] != 'btrfs':
+            return super().subvolume_top_level_path(path)
+        relative_path = os.path.relpath(os.path.realpath(path), mount['mount_point'])
+        if relative_path == '.':
+            relative_path = ''
+        return str(PosixPath(mount['root'], relative_path)).strip('/') or '/'
+
+    def subvolume_list(self, path):
+        with os.scandir(path) as children:
+            return [child.name for child in children if child.is_dir()]
+
+    def subvolume_create(self, path):
+        path = PosixPath(path)
+        try:
+            self._ioctl_in_dir(path.parent, BTRFS_IOC_SUBVOL_CREATE, btrfs_vol_args.pack(0, self._name(path)))
+        except OSError as e:
+            if e.errno not in btrfs_ioctl_unsupported_errors:
+                raise SnapshotException("Could not create subvolume {0}: {1}".format(path, e.strerror))
+            super().subvolume_create(path)
+
+    def subvolume_snapshot(self, source, dest, readonly=True):
+        dest = PosixPath(dest)
+        source_fd = os.open(source, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            flags = BTRFS_SUBVOL_RDONLY if readonly else 0
+            self._ioctl_in_dir(dest.parent, BTRFS_IOC_SNAP_CREATE_V2, btrfs_vol_args_v2.pack(source_fd, 0, flags, bytes(32), self._name(dest)))
+        except OSError as e:
+            if e.errno not in btrfs_ioctl_unsupported_errors:
+                raise SnapshotException("Could not create snapshot {0} of {1}: {2}".format(dest, source, e.strerror))
+            super().subvolume_snapshot(source, dest, readonly=readonly)
+        finally:
+            os.close(source_fd)
+
+    def subvolume_delete(self, paths):
+        paths = [PosixPath(p) for p in paths]
+        if len(paths) == 0:
+            return
+        for i, path in enumerate(paths):
+            try:
+                self._ioctl_in_dir(path.parent, BTRFS_IOC_SNAP_DESTROY, btrfs_vol_args.pack(0, self._name(path)))
+            except OSError as e:
+                if e.errno not in btrfs_ioctl_unsupported_errors:
+                    raise SnapshotException("Could not delete subvolume {0}: {1}".format(path, e.strerror))
+                super().subvolume_delete(paths[i:])
+                return
+
+        # Commit the transaction once, after all the deletions
+        fd = os.open(paths[-1].parent, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            buffer = bytearray(btrfs_transid.size)
+            fcntl.ioctl(fd, BTRFS_IOC_START_SYNC, buffer)
+            fcntl.ioctl(fd, BTRFS_IOC_WAIT_SYNC, buffer)
+        finally:
+            os.close(fd)
+
+    def directory_exists(self, path):
+        return os.path.isdir(path)
+
+    def _ioctl_in_dir(self, directory, request, args):
+        fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            fcntl.ioctl(fd, request, bytearray(args))
+        finally:
+            os.close(fd)
+
+    def _name(self, path):
+        return os.fsencode(path.name)
+
+
+class FakeBtrfsBackend(BtrfsBackend):
+
+    # Keeps subvolumes in memory, so snapshot logic can be tested and
+    # benchmarked without a btrfs filesystem
+
+    name = 'fake'
+
+    def __init__(self):
+        self.subvolumes = {}
+        self.directories = set()
+        self.children = {}
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def add_directory(self, path):
+        path = str(path)
+        with self.lock:
+            self._add(path)
+            self.directories.add(path)
+
+    def add_subvolume(self, path, readonly=False, parent_uuid=None, received_uuid=None):
+        import uuid
+        path = str(path)
+        with self.lock:
+            self.generation += 1
+            self._add(path)
+            self.subvolumes[path] = SubvolumeInfo(
+                PosixPath(path).name,
+                readonly=readonly,
+                uuid=str(uuid.uuid4()),
+                parent_uuid=parent_uuid,
+                received_uuid=received_uuid,
+                generation=self.generation,
+                top_level_path=path.strip('/') or '/',
+            )
+            return self.subvolumes[path]
+
+    def subvolume_show(self, path):
+        return self.subvolumes.get(str(path))
+
+    def subvolume_top_level_path(self, path):
+        details = self.subvolume_show(path)
+        if details is None:
+            raise SnapshotException("Path {0} is not a valid btrfs subvolume".format(path))
+        return details.top_level_path
+
+    def subvolume_list(self, path):
+        path = str(path)
+        if not self.directory_exists(path):
+            raise FileNotFoundError(errno.ENOENT, "No such directory", path)
+        return list(self.children.get(path, []))
+
+    def subvolume_create(self, path):
+        self._check_new(path)
+        self.add_subvolume(path)
+
+    def subvolume_snapshot(self, source, dest, readonly=True):
+        self._check_new(dest)
+        source_details = self.subvolume_show(source)
+        if source_details is None:
+            raise SnapshotException("Path {0} is not a valid btrfs subvolume".format(source))
+        self.add_subvolume(dest, readonly=readonly, parent_uuid=source_details.uuid)
+
+    def subvolume_delete(self, paths):
+        with self.lock:
+            for path in paths:
+                path = str(path)
+                if path not in self.subvolumes:
+                    raise SnapshotException("Path {0} is not a valid btrfs subvolume".format(path))
+                del self.subvolumes[path]
+                self.children[str(PosixPath(path).parent)].discard(PosixPath(path).name)
+
+    def subvolume_sync(self, path):
+        pass
+
+    def directory_exists(self, path):
+        path = str(path)
+        return path in self.subvolumes or path in self.directories
+
+    def _check_new(self, path):
+        if self.directory_exists(path):
+            raise SnapshotException("Path {0} already exists".format(path))
+        if not self.directory_exists(PosixPath(path).parent):
+            raise SnapshotException("Directory {0} does not exist".format(PosixPath(path).parent))
+
+    def _add(self, path):
+        parent = str(PosixPath(path).parent)
+        if parent not in self.children:
+            self.children[parent] = set()
+        self.children[parent].add(PosixPath(path).name)
+
+
+BTRFS_BACKENDS = [IoctlBtrfsBackend, CommandBtrfsBackend, FakeBtrfsBackend]
+BTRFS_BACKEND_NAME_MAP = dict([(b.name, b) for b in BTRFS_BACKENDS])
+
+btrfs_backend = None
+
+def get_btrfs_backend():
+    global btrfs_backend
+    if btrfs_backend is None:
+        btrfs_backend = IoctlBtrfsBackend()
+    return btrfs_backend
+
+def set_btrfs_backend(backend):
+    global btrfs_backend
+    btrfs_backend = backend
+
+
+def subvolume_show_parse(name, output):
+    # Parse the output of `btrfs subvolume show`
+    details = SubvolumeInfo(name, readonly=False)
+    lines = output.split("\n")
+    if len(lines) > 0:
+        details.top_level_path = lines[0].strip()
+    for line in lines[1:]:
+        if ':' not in line:
+            continue
+        key, value = line.split(':', 1)
+        key = key.strip()
+        value = value.strip()
+        if key == 'Flags':
+            details.readonly = 'readonly' in value.split()
+        elif key == 'UUID':
+            details.uuid = _uuid_value(value)
+        elif key == 'Parent UUID':
+            details.parent_uuid = _uuid_value(value)
+        elif key == 'Received UUID':
+            details.received_uuid = _uuid_value(value)
+        elif key == 'Generation':
+            details.generation = int(value)
+    return details
+
+def subvolume_show_list_parse(output_lines, marker):
+    # Parse the output of `btrfs subvolume show` for a list of subvolumes,
+    # each preceded by a line with the marker and subvolume name
+    infos = {}
+    name = None
+    lines = []
+    for line in itertools.chain(output_lines, [marker + ' ']):
+        if line.startswith(marker + ' '):
+            if name is not None:
+                infos[name] = subvolume_show_parse(name, "\n".join(lines))
+            name = line[len(marker) + 1:]
+            lines = []
+        else:
+            lines.append(line)
+    return infos
+
+def _uuid_value(value):
+    if value == '-' or value == '':
+        return None
+    return value
+
+def _uuid_bytes(value):
+    if value == bytes(len(value)):
+        return None
+    import uuid
+    return str(uuid.UUID(bytes=value))
@@ -1,10 +1,9 @@
 #!/usr/bin/python3
 
-from btrfssnapshotmanager.manager import *
+from btrfssnapshotmanager.daemon import *
 
 import argparse
-import csv
-import json
+import os
 
 
 dateformat_human =  '%a %d %b %Y %H:%M:%S'
@@ -12,13 +11,14 @@ output_format = 'table'
 
 
 def main():
-    if cmd('whoami') != 'root':
+    if os.geteuid() != 0:
         fatal("Must run as root user")
 
     parser = argparse.ArgumentParser(prog='btrfs-snapshot-manager')
     parser.add_argument('--log-level', type=int, default=2, dest='loglevel', help='log level: 0=debug, 1=info, 2=warn 3=error 4=fatal')
     parser.add_argument('--csv', action='store_true', default=False, dest='csv', help='output tables in CSV format')
     parser.add_argument('--json', action='store_true', default=False, dest='json', help='output tables in JSON format')
+    parser.add_argument('--socket', default=default_daemon_socket, help='path to the daemon\'s socket')
     subparsers = parser.add_subparsers(title='subcommands', metavar='action', help='action to perform')
 
     # backup
@@ -34,6 +34,7 @@ def main():
     backup_list_parser = backup_subparsers.add_parser('list', help='list snapshots backups')
     backup_list_parser.add_argument('path', nargs='*', help='path to subvolume')
     backup_list_parser.add_argument('--id', nargs='*', type=int, help='only run backups with these ids')
+    backup_list_parser.add_argument('--refresh', action='store_true', default=False, help='fetch the list of snapshots from each target rather than using the cached list')
     backup_list_parser.set_defaults(func=backup_list)
 
     # backup run
@@ -50,6 +51,10 @@ def main():
     config_check_parser = config_subparsers.add_parser('check', help='validate config file')
     config_check_parser.set_defaults(func=config_check)
 
+    # daemon
+    daemon_parser = subparsers.add_parser('daemon', help='run scheduled snapshots continuously, answering list commands for other invocations')
+    daemon_parser.set_defaults(func=daemon)
+
     # snapshot
     snapshot_parser = subparsers.add_parser('snapshot', help='snapshot management commands')
     snapshot_subparsers = snapshot_parser.add_subparsers(title='subcommands', help='action to perform', metavar='action', required=True)
@@ -70,9 +75,9 @@ def main():
     snapshot_create_parser.set_defaults(func=snapshot_create)
 
     # snapshot delete
-    snapshot_delete_parser = snapshot_subparsers.add_parser('delete', help='delete snapshot')
+    snapshot_delete_parser = snapshot_subparsers.add_parser('delete', help='delete snapshots')
     snapshot_delete_parser.add_argument('path', help='path to subvolume')
-    snapshot_delete_parser.add_argument('name', help='snapshot name to delete')
+    snapshot_delete_parser.add_argument('name', nargs='+', help='snapshot names to delete')
     snapshot_delete_parser.set_defaults(func=snapshot_delete)
 
     # snapshot init
@@ -84,11 +89,14 @@ def main():
     snapshot_list_parser = snapshot_subparsers.add_parser('list', help='list snapshots')
     snapshot_list_parser.add_argument('path', nargs='?', help='path to subvolume')
     snapshot_list_parser.add_argument('--period', nargs='*', help='only list snapshots for this period')
+    snapshot_list_parser.add_argument('--why', action='store_true', default=False, help='show which retention policies keep each snapshot')
     snapshot_list_parser.set_defaults(func=snapshot_list)
 
     # snapshot run
     snapshot_run_parser = snapshot_subparsers.add_parser('run', help='execute scheduled snapshots')
     snapshot_run_parser.add_argument('path', nargs='*', help='path to subvolume')
+    snapshot_run_parser.add_argument('--workers', type=int, help='number of subvolumes to process in parallel')
+    snapshot_run_parser.add_argument('--plan', action='store_true', default=False, help='only show what would be done')
     snapshot_run_parser.set_defaults(func=snapshot_run)
 
     # systemdboot
@@ -160,7 +168,7 @@ def main():
 def backup_config(args):
     global_args(args)
     path = args.path
-    snapshot_manager = SnapshotManager()
+    snapshot_manager = get_snapshot_manager()
 
     if path is not None and path not in snapshot_manager.managers:
         fatal("Config not found for subvolume", path)
@@ -195,14 +203,22 @@ def backup_list(args):
     paths = args.path
     ids = args.id
 
-    snapshot_manager = SnapshotManager()
+    if ids is not None and len(ids) > 0 and len(paths) != 1:
+        fatal("Can only specify backup IDs to run when running a single backup")
+
+    query = {'path': paths, 'id': ids, 'refresh': args.refresh}
+    result = query_daemon('backup-list', query, args.socket)
+    if result is None:
+        result = backup_list_tables(get_snapshot_manager(), query)
+    output_tables(*result)
+
+def backup_list_tables(snapshot_manager, query):
+    paths = query['path']
+    ids = query['id']
 
     for path in paths:
         if path not in snapshot_manager.managers:
-            fatal("Config not found for subvolume", path)
-
-    if ids is not None and len(ids) > 0 and len(paths) != 1:
-        fatal("Can only specify backup IDs to run when running a single backup")
+            raise SnapshotException("Config not found for subvolume {0}".format(path))
 
     managers_to_run = snapshot_manager.managers
     if len(paths) > 0:
@@ -215,8 +231,8 @@ def backup_list(args):
         backups = manager.get_backups(ids)
         table = []
         for i, backup in sorted(backups.items(), key=lambda b: b[0]):
-            target_snapshot_names = backup.get_target_snapshot_names()
-            for target_snapshot_name in sorted(target_snapshot_names):
+            target_snapshots = backup.cached_target_snapshots(refresh=query['refresh'])
+            for target_snapshot_name in sorted(target_snapshots.keys()):
                 snapshot_details = snapshot_name_parse(target_snapshot_name)
                 table.append([
                     i,
@@ -228,14 +244,14 @@ def backup_list(args):
         labels.append([['SUBVOL', subvol]])
         tables.append(table)
 
-    output_tables(header, labels, tables)
+    return [header, labels, tables]
 
 def backup_run(args):
     global_args(args)
     paths = args.path
     ids = args.id
 
-    snapshot_manager = SnapshotManager()
+    snapshot_manager = get_snapshot_manager()
 
     for path in paths:
         if path not in snapshot_manager.managers:
@@ -251,7 +267,14 @@ def backup_run(args):
 
 def config_check(args):
     global_args(args)
-    snapshot_manager = SnapshotManager()
+    snapshot_manager = get_snapshot_manager()
+
+    # Subvolumes and systemd-boot entries are loaded lazily, so check them explicitly
+    for manager in snapshot_manager.managers.values():
+        manager.subvol.validate()
+    if snapshot_manager.systemdboot_manager is not None:
+        for entry_manager in snapshot_manager.systemdboot_manager.entry_managers:
+            entry_manager.ensure_entries_loaded()
 
     info("Config is valid.")
 
@@ -261,7 +284,7 @@ def config_check(args):
 def snapshot_cleanup(args):
     global_args(args)
     paths = args.path
-    snapshot_manager = SnapshotManager()
+    snapshot_manager = get_snapshot_manager()
     if paths is not None:
         for path in paths:
             if path not in snapshot_manager.managers:
@@ -272,7 +295,7 @@ def snapshot_cleanup(args):
 def snapshot_config(args):
     global_args(args)
     path = args.path
-    snapshot_manager = SnapshotManager()
+    snapshot_manager = get_snapshot_manager()
     if path is not None and path not in snapshot_manager.managers:
         fatal("Config not found for subvolume", path)
 
@@ -297,7 +320,9 @@ def snapshot_config(args):
                     row.append(last_run)
 
                     next_run = manager.next_run(period)
-                    if next_run is None:
+                    if manager.retention_config[period] <= 0:
+                        next_run = 'Never'
+                    elif next_run is None:
                         next_run = 'Immediately'
                     else:
                         next_run = next_run.strftime(dateformat_human)
@@ -318,12 +343,15 @@ def snapshot_create(args):
 def snapshot_delete(args):
     global_args(args)
     path = args.path
-    name = args.name
+    names = args.name
     subvol = get_subvol(path)
-    snapshot = subvol.find_snapshot(name)
-    if snapshot is None:
-        fatal("Could not find snapshot", name, "in subvolume", path)
-    snapshot.delete()
+    snapshots = []
+    for name in names:
+        snapshot = subvol.find_snapshot(name)
+        if snapshot is None:
+            fatal("Could not find snapshot", name, "in subvolume", path)
+        snapshots.append(snapshot)
+    subvol.delete_snapshots(snapshots)
 
 def snapshot_init(args):
     global_args(args)
@@ -333,55 +361,95 @@ def snapshot_init(args):
 
 def snapshot_list(args):
     global_args(args)
-    path = args.path
 
-    periods = args.period
+    query = {'path': args.path, 'period': args.period, 'why': args.why}
+    result = query_daemon('snapshot-list', query, args.socket)
+    if result is None:
+        result = snapshot_list_tables(get_snapshot_manager(), query)
+    output_tables(*result)
+
+def snapshot_list_tables(snapshot_manager, query):
+    path = query['path']
+
+    periods = query['period']
     if periods is not None:
         for p in periods:
             if p != 'none' and p not in PERIOD_NAME_MAP:
-                fatal("No such period:", p)
+                raise SnapshotException("No such period: {0}".format(p))
         periods = [(PERIOD_NAME_MAP[p] if p != 'none' else None) for p in periods]
 
-    snapshot_manager = SnapshotManager()
     if path is None:
         subvols = [m.subvol for m in snapshot_manager.managers.values()]
     else:
-        subvols = [get_subvol(path)]
+        subvols = [get_subvol(path, snapshot_manager)]
 
+    why = query.get('why', False)
     header = ['SNAPSHOT', 'DATE', 'PERIODS']
+    if why:
+        header.append('KEPT BY')
     labels = []
     tables = []
     for subvol in subvols:
         table = []
 
         if not subvol.has_snapshots():
-            fatal("Subvolume", subvol.path, "is not initialised for snapshots")
+            raise SnapshotException("Subvolume {0} is not initialised for snapshots".format(subvol.path))
 
+        retention = None
+        if why:
+            retention = subvol.retention.evaluate(subvol.snapshots)
         snapshots = subvol.search_snapshots(periods=periods)
         for snapshot in snapshots:
-            table.append([snapshot.name, snapshot.date.strftime(dateformat_human), [p.name for p in snapshot.get_periods()]])
+            row = [snapshot.name, snapshot.date.strftime(dateformat_human), [p.name for p in snapshot.get_periods()]]
+            if why:
+                row.append(["{0} {1} #{2}".format(name, period.name, position) for name, period, position in retention.why(snapshot)])
+            table.append(row)
         labels.append([['SUBVOL', subvol.name]])
         tables.append(table)
 
-    output_tables(header, labels, tables)
+    return [header, labels, tables]
 
 def snapshot_run(args):
     global_args(args)
     paths = args.path
-    snapshot_manager = SnapshotManager()
+    snapshot_manager = get_snapshot_manager()
     if paths is not None:
         for path in paths:
             if path not in snapshot_manager.managers:
                 fatal("Config not found for subvolume", path)
+    if args.workers is not None and args.workers < 1:
+        fatal("Number of workers must be at least 1")
 
-    snapshot_manager.execute(subvols=paths)
+    if args.plan:
+        header = ['OPERATION', 'TARGET', 'SNAPSHOT', 'DETAIL']
+        labels = []
+        tables = []
+        for plan in snapshot_manager.plan(subvols=paths):
+            labels.append([['SUBVOL', plan.manager.subvol.name]])
+            tables.append([o.row() for o in plan.operations()])
+        output_tables(header, labels, tables)
+        return
+
+    snapshot_manager.execute(subvols=paths, workers=args.workers)
+
+
+# Daemon
+
+DAEMON_QUERIES = {
+    'backup-list': backup_list_tables,
+    'snapshot-list': snapshot_list_tables,
+}
+
+def daemon(args):
+    global_args(args)
+    SnapshotDaemon(args.socket, DAEMON_QUERIES).run()
 
 
 # Systemd-Boot
 
 def systemdboot_config(args):
     global_args(args)
-    snapshot_manager = SnapshotManager()
+    snapshot_manager = get_snapshot_manager()
     systemdboot_manager = snapshot_manager.systemdboot_manager
     if systemdboot_manager is None:
         raise SnapshotException("No systemd-boot config enabled.")
@@ -407,7 +475,7 @@ def systemdboot_create(args):
     global_args(args)
     entry_name = args.entry
     snapshot_name = args.snapshot
-    snapshot_manager = SnapshotManager()
+    snapshot_manager = get_snapshot_manager()
     systemdboot_manager = snapshot_manager.systemdboot_manager
     if systemdboot_manager is None:
         raise SnapshotException("No systemd-boot config enabled.")
@@ -429,7 +497,7 @@ def systemdboot_create(args):
 def systemdboot_delete(args):
     global_args(args)
     entry_name = args.entry
-    snapshot_manager = SnapshotManager()
+    snapshot_manager = get_snapshot_manager()
     systemdboot_manager = snapshot_manager.systemdboot_manager
     if systemdboot_manager is None:
         raise SnapshotException("No systemd-boot config enabled.")
@@ -438,8 +506,10 @@ def systemdboot_delete(args):
     if entry_managers is None:
         fatal("No subvolumes configured for systemd-boot integration")
 
+    # Only entry managers for the entry's reference entry can have it
+    parsed = boot_entry_name_split(entry_name)
     for entry_manager in entry_managers:
-        if entry_name in [e.name for e in entry_manager.entries]:
+        if parsed is not None and parsed[1] == entry_manager.reference_entry and entry_name in [e.name for e in entry_manager.entries]:
             entry_manager.delete_entry(entry_name)
             break
     else:
@@ -447,7 +517,7 @@ def systemdboot_delete(args):
 
 def systemdboot_list(args):
     global_args(args)
-    snapshot_manager = SnapshotManager()
+    snapshot_manager = get_snapshot_manager()
     systemdboot_manager = snapshot_manager.systemdboot_manager
     if systemdboot_manager is None:
         raise SnapshotException("No systemd-boot config enabled.")
@@ -496,7 +566,7 @@ def systemdboot_list(args):
 
 def systemdboot_run(args):
     global_args(args)
-    snapshot_manager = SnapshotManager()
+    snapshot_manager = get_snapshot_manager()
     systemdboot_manager = snapshot_manager.systemdboot_manager
     if systemdboot_manager is None:
         raise SnapshotException("No systemd-boot config enabled.")
@@ -510,7 +580,7 @@ def systemdboot_run(args):
 
 def systemdboot_snapshot_create(args):
     global_args(args)
-    snapshot_manager = SnapshotManager()
+    snapshot_manager = get_snapshot_manager()
     systemdboot_manager = snapshot_manager.systemdboot_manager
     if systemdboot_manager is None:
         raise SnapshotException("No systemd-boot config enabled.")
@@ -519,7 +589,7 @@ def systemdboot_snapshot_create(args):
 
 def systemdboot_snapshot_createneeded(args):
     global_args(args)
-    snapshot_manager = SnapshotManager()
+    snapshot_manager = get_snapshot_manager()
     systemdboot_manager = snapshot_manager.systemdboot_manager
     if systemdboot_manager is None:
         raise SnapshotException("No systemd-boot config enabled.")
@@ -529,7 +599,7 @@ def systemdboot_snapshot_createneeded(args):
 def systemdboot_snapshot_delete(args):
     global_args(args)
     name = args.name
-    snapshot_manager = SnapshotManager()
+    snapshot_manager = get_snapshot_manager()
     systemdboot_manager = snapshot_manager.systemdboot_manager
     if systemdboot_manager is None:
         raise SnapshotException("No systemd-boot config enabled.")
@@ -538,7 +608,7 @@ def systemdboot_snapshot_delete(args):
 
 def systemdboot_snapshot_deleteunneeded(args):
     global_args(args)
-    snapshot_manager = SnapshotManager()
+    snapshot_manager = get_snapshot_manager()
     systemdboot_manager = snapshot_manager.systemdboot_manager
     if systemdboot_manager is None:
         raise SnapshotException("No systemd-boot config enabled.")
@@ -547,7 +617,7 @@ def systemdboot_snapshot_deleteunneeded(args):
 
 def systemdboot_snapshot_list(args):
     global_args(args)
-    snapshot_manager = SnapshotManager()
+    snapshot_manager = get_snapshot_manager()
     systemdboot_manager = snapshot_manager.systemdboot_manager
     if systemdboot_manager is None:
         raise SnapshotException("No systemd-boot config enabled.")
@@ -569,11 +639,14 @@ def global_args(args):
     elif args.json:
         output_format = 'json'
 
-def get_subvol(path):
-    snapshot_manager = SnapshotManager()
+def get_subvol(path, snapshot_manager=None):
+    if snapshot_manager is None:
+        snapshot_manager = get_snapshot_manager()
     if path in snapshot_manager.managers:
         return snapshot_manager.managers[path].subvol
-    return Subvolume(path)
+    subvol = Subvolume(path)
+    subvol.validate()
+    return subvol
 
 def out(*messages):
     print(' '.join([str(m) for m in messages]), flush=True)
@@ -589,6 +662,7 @@ def output_tables(header, labels, tables):
         _output_human(header, labels, tables)
 
 def _output_csv(header, labels, tables):
+        import csv
         csvwriter = csv.writer(sys.stdout)
 
         if len(tables) > 0:
@@ -607,6 +681,7 @@ def _output_csv(header, labels, tables):
             csvwriter.writerows(table)
 
 def _output_json(header, labels, tables):
+    import json
     jsn = {}
     lab_num = None
     if len(labels) > 0:
@@ -2,8 +2,13 @@
 
 from btrfssnapshotmanager.logging import *
 
+import collections
+import os
+import re
+import shlex
 import subprocess
 import sys
+import threading
 import time
 
 
@@ -23,26 +28,182 @@ class CommandException(Exception):
         super().__init__(self, "Command `{}` returned code {} - {}".format(command, code, error))
 
 
-def cmd(command, attempts=None, fail_delay=None, return_code=False):
+command_stderr_lines = 200
+
+
+class CommandResult():
+
+    def __init__(self, command, code, stdout, stderr, wall_time, cpu_time):
+        self.command = command
+        self.code = code
+        self.stdout = stdout
+        self.stderr = stderr
+        self.wall_time = wall_time
+        self.cpu_time = cpu_time
+
+
+class CommandStats():
+
+    # Totals across every command run, for reporting
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.count = 0
+        self.wall_time = 0.0
+        self.cpu_time = 0.0
+
+    def add(self, wall_time, cpu_time, count=1):
+        with self.lock:
+            self.count += count
+            self.wall_time += wall_time
+            self.cpu_time += cpu_time
+
+    def reset(self):
+        with self.lock:
+            self.count = 0
+            self.wall_time = 0.0
+            self.cpu_time = 0.0
+
+
+command_stats = CommandStats()
+
+
+class CommandProcess():
+
+    # A running command, started from an argument list without a shell. Stdout
+    # is read as a stream, and only the last lines of stderr are kept.
+
+    def __init__(self, argv):
+        self.argv = [str(a) for a in argv]
+        self.command = shlex.join(self.argv)
+        trace("CMD: {}".format(self.command))
+        self.stderr = collections.deque(maxlen=command_stderr_lines)
+        self.start_time = time.monotonic()
+        try:
+            self.process = subprocess.Popen(self.argv, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        except OSError as e:
+            # Fail the same way a shell would for a missing command
+            raise CommandException(self.command, 127, "{0}: {1}".format(self.argv[0], e.strerror))
+        self.stderr_reader = threading.Thread(target=self._read_stderr, daemon=True)
+        self.stderr_reader.start()
+
+    def lines(self):
+        for line in self.process.stdout:
+            yield line.decode('utf-8', errors='replace').rstrip("\n")
+
+    def wait(self, stdout=None):
+        self.process.stdout.close()
+        self.stderr_reader.join()
+        # Wait for the process directly, to get its resource usage
+        pid, status, rusage = os.wait4(self.process.pid, 0)
+        if os.WIFSIGNALED(status):
+            self.process.returncode = -os.WTERMSIG(status)
+        else:
+            self.process.returncode = os.WEXITSTATUS(status)
+        result = CommandResult(
+            self.command,
+            self.process.returncode,
+            stdout,
+            "\n".join(self.stderr),
+            time.monotonic() - self.start_time,
+            rusage.ru_utime + rusage.ru_stime)
+        command_stats.add(result.wall_time, result.cpu_time)
+        trace("... STDOUT: {}".format(stdout))
+        trace("... STDERR: {}".format(result.stderr))
+        trace("... TIME: {0:.3f}s wall, {1:.3f}s CPU".format(result.wall_time, result.cpu_time))
+        return result
+
+    def _read_stderr(self):
+        for line in self.process.stderr:
+            self.stderr.append(line.decode('utf-8', errors='replace').rstrip("\n"))
+        self.process.stderr.close()
+
+
+def run_command_result(argv, attempts=None, fail_delay=None):
     attempt = 1
     while True:
-        trace("CMD: {}".format(command))
-        result = subprocess.run(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        stdout = result.stdout.decode('utf-8').rstrip("\n")
-        stderr = result.stderr.decode('utf-8').rstrip("\n")
-        trace("... STDOUT: {}".format(stdout))
-        trace("... STDERR: {}".format(stderr))
-        if result.returncode != 0:
-            if attempts is not None and attempt < attempts:
-                attempt += 1
-                warn("Command failed, waiting before retrying...")
-                time.sleep(fail_delay)
-                warn("Retrying...")
-            else:
-                if return_code:
-                    return (stdout, stderr, result.returncode)
-                raise CommandException(command, result.returncode, stderr)
+        try:
+            process = CommandProcess(argv)
+        except CommandException as e:
+            result = CommandResult(e.command, e.code, '', e.error, 0.0, 0.0)
         else:
-            if return_code:
-                return (stdout, stderr, result.returncode)
-            return stdout
+            stdout = "\n".join(process.lines())
+            result = process.wait(stdout)
+        if result.code == 0 or attempts is None or attempt >= attempts:
+            return result
+        attempt += 1
+        warn("Command failed, waiting before retrying...")
+        time.sleep(fail_delay)
+        warn("Retrying...")
+
+def run_command(argv, attempts=None, fail_delay=None, return_code=False):
+    result = run_command_result(argv, attempts=attempts, fail_delay=fail_delay)
+    if return_code:
+        return (result.stdout, result.stderr, result.code)
+    if result.code != 0:
+        raise CommandException(result.command, result.code, result.stderr)
+    return result.stdout
+
+def stream_command(argv, attempts=None, fail_delay=None):
+    # Yield stdout a line at a time as the command produces it. A failed
+    # command is only retried if it hadn't produced any output yet.
+    attempt = 1
+    while True:
+        process = CommandProcess(argv)
+        produced = False
+        try:
+            for line in process.lines():
+                produced = True
+                yield line
+        finally:
+            result = process.wait()
+        if result.code == 0:
+            return
+        if produced or attempts is None or attempt >= attempts:
+            raise CommandException(result.command, result.code, result.stderr)
+        attempt += 1
+        warn("Command failed, waiting before retrying...")
+        time.sleep(fail_delay)
+        warn("Retrying...")
+
+
+def write_file_atomic(path, content, mode=0o600):
+    # Write to a temporary file first and move it into place, so readers never
+    # see a half-written file
+    path = str(path)
+    temp_path = path + '.tmp'
+    fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+    with os.fdopen(fd, 'wb' if isinstance(content, bytes) else 'w') as fh:
+        fh.write(content)
+        fh.flush()
+        os.fsync(fh.fileno())
+    os.replace(temp_path, path)
+
+
+def mount_info(path):
+    # Find the mount containing the given path, by longest matching mount point
+    path = os.path.realpath(path)
+    found = None
+    with open('/proc/self/mountinfo', 'r') as fh:
+        for line in fh:
+            fields = line.split()
+            separator = fields.index('-')
+            mount_point = _mountinfo_unescape(fields[4])
+            if path == mount_point or path.startswith(mount_point.rstrip('/') + '/'):
+                if found is None or len(mount_point) >= len(found['mount_point']):
+                    found = {
+                        'mount_point': mount_point,
+                        'root': _mountinfo_unescape(fields[3]),
+                        'fstype': fields[separator + 1],
+                        'source': _mountinfo_unescape(fields[separator + 2]),
+                    }
+    return found
+
+def filesystem_device(path):
+    mount = mount_info(path)
+    if mount is None:
+        return None
+    return mount['source']
+
+def _mountinfo_unescape(value):
+    return re.sub(r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)), value)
@@ -4,7 +4,9 @@ from btrfssnapshotmanager.backups import *
 from btrfssnapshotmanager.systemdboot import *
 
 from pathlib import PosixPath
-import yaml
+import hashlib
+import marshal
+import re
 
 
 class ConfigException(Exception):
@@ -78,12 +80,24 @@ class ConfigValidator:
 class Config():
 
     config_file = PosixPath('/etc/btrfs-snapshot-manager/config.yml')
+    config_cache_file = PosixPath('/var/cache/btrfs-snapshot-manager/config.cache')
 
     config_spec = {
+        ('periods', False): [
+            {
+                ('name', True): str,
+                ('tag', True): str,
+                ('minutes', True): int,
+            },
+        ],
         ('subvolumes', False): [
             {
                 ('path', True): str,
                 ('snapshots-path', False): str,
+                ('deletion', False): {
+                    ('batch-size', False): int,
+                    ('interval', False): int,
+                },
                 ('retention', True): {
                     ('hourly', (1, None, 'hourly', 'daily', 'weekly', 'monthly')): int,
                     ('daily', False): int,
@@ -94,6 +108,9 @@ class Config():
                     {
                         ('type', True): ('btrfs', 'rsync'),
                         ('last_sync_file', False): str,
+                        ('clone-sources', False): int,
+                        ('catch-up', False): int,
+                        ('inventory-max-age', False): int,
                         ('local', (1, 1, 'local', 'remote')): {
                             ('path', True): str,
                         },
@@ -110,6 +127,13 @@ class Config():
                             ('monthly', False): int,
                             ('minimum', False): int,
                         },
+                        ('transfer', False): {
+                            ('compression', False): ('zstd', 'lz4', 'none'),
+                            ('compression-level', False): int,
+                            ('buffer-size', False): int,
+                            ('resumable', False): bool,
+                            ('spool-path', False): str,
+                        },
                     },
                 ],
                 ('systemd-boot', False): [
@@ -130,27 +154,188 @@ class Config():
             ('init-files', False): [
                 str,
             ],
+            ('deduplicate', False): bool,
+        },
+        ('state-path', False): str,
+        ('metrics', False): {
+            ('prometheus', False): str,
+            ('json', False): str,
+        },
+        ('execution', False): {
+            ('workers', False): int,
+            ('workers-per-device', False): int,
+            ('backup-workers', False): int,
+            ('backups-per-host', False): int,
+            ('backups-per-device', False): int,
+            ('btrfs-backend', False): tuple([b.name for b in BTRFS_BACKENDS if b != FakeBtrfsBackend]),
         },
     }
 
     def __init__(self, snapshot_manager):
         self.snapshot_manager = snapshot_manager
-        self.load_config()
-        self.load_retention()
-        self.load_backups()
-        self.load_systemdboot()
+        # If the config can't be loaded, the periods of the config already
+        # loaded, if there is one, are put back
+        custom_periods = get_custom_periods()
+        try:
+            self.load_config()
+            self.load_state()
+            self.load_metrics()
+            self.load_execution()
+            self.load_retention()
+            self.load_backups()
+            self.load_systemdboot()
+        except ConfigException:
+            set_custom_periods(custom_periods)
+            raise
 
     def load_config(self):
-        if not self.config_file.is_file():
-            self.raw_config = {}
-        else:
-            with open(self.config_file, 'r') as fh:
-                config = yaml.load(fh, Loader=yaml.CLoader)
-            if config is None:
-                self.raw_config = {}
-            else:
+        self.raw_config = {}
+        cache_key = None
+        if self.config_file.is_file():
+            with open(self.config_file, 'rb') as fh:
+                content = fh.read()
+            cache_key = self.config_cache_key(content)
+            cached_config = self.load_config_cache(cache_key)
+            if cached_config is not None:
+                # Already validated before it was cached
+                self.raw_config = cached_config
+                self.load_periods()
+                return
+            # Parsing YAML is slow to start, and not needed if the cache is used
+            import yaml
+            config = yaml.load(content, Loader=yaml.CLoader)
+            if config is not None:
                 self.raw_config = config
-        ConfigValidator.validate_config(self.raw_config, self.config_spec, [], True)
+        self.load_periods()
+        ConfigValidator.validate_config(self.raw_config, self.get_config_spec(), [], True)
+        if cache_key is not None:
+            self.save_config_cache(cache_key)
+
+    def config_cache_key(self, content):
+        # The cache is only used for exactly the same config file, validated
+        # against exactly the same spec
+        key = hashlib.sha1()
+        key.update("{0}\0{1}\0{2}\0".format(marshal.version, self.config_file, repr(self.config_spec)).encode('utf-8'))
+        key.update(content)
+        return key.hexdigest()
+
+    def load_config_cache(self, cache_key):
+        if self.config_cache_file is None:
+            return None
+        try:
+            with open(self.config_cache_file, 'rb') as fh:
+                cache = marshal.load(fh)
+        except (OSError, EOFError, ValueError, TypeError):
+            return None
+        if not isinstance(cache, dict) or cache.get('key') != cache_key or not isinstance(cache.get('config'), dict):
+            return None
+        return cache['config']
+
+    def save_config_cache(self, cache_key):
+        if self.config_cache_file is None:
+            return
+        try:
+            self.config_cache_file.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+            write_file_atomic(self.config_cache_file, marshal.dumps({'key': cache_key, 'config': self.raw_config}))
+        except (OSError, ValueError) as e:
+            debug("Failed to cache config in {0}: {1}".format(self.config_cache_file, e))
+
+    def load_periods(self):
+        # Custom periods have to be known before the rest of the config can be
+        # validated, as they can be used in any retention section
+        periods_spec = {('periods', False): self.config_spec[('periods', False)]}
+        ConfigValidator.validate_config(self.raw_config, periods_spec, [], False)
+        custom_periods = []
+        names = set([p.name for p in BUILTIN_PERIODS] + ['minimum'])
+        tags = set([p.tag for p in BUILTIN_PERIODS])
+        for i, period_config in enumerate(self.raw_config.get('periods', [])):
+            if period_config['name'] in names:
+                raise ConfigException(['periods', str(i), 'name'], "\"{0}\" is already used".format(period_config['name']))
+            if re.fullmatch('[A-Z]', period_config['tag']) is None:
+                raise ConfigException(['periods', str(i), 'tag'], 'must be a single capital letter')
+            if period_config['tag'] in tags:
+                raise ConfigException(['periods', str(i), 'tag'], "\"{0}\" is already used".format(period_config['tag']))
+            if period_config['minutes'] < 1 or 1440 % period_config['minutes'] != 0:
+                raise ConfigException(['periods', str(i), 'minutes'], 'must divide evenly into a day')
+            names.add(period_config['name'])
+            tags.add(period_config['tag'])
+            custom_periods.append(PeriodMinutes(period_config['name'], period_config['tag'], period_config['minutes']))
+        set_custom_periods(custom_periods)
+
+    def get_config_spec(self):
+        custom_periods = get_custom_periods()
+        if len(custom_periods) == 0:
+            return self.config_spec
+        subvol_spec = dict(self.config_spec[('subvolumes', False)][0])
+        subvol_spec[('retention', True)] = self._retention_spec(subvol_spec[('retention', True)], custom_periods)
+        backup_spec = dict(subvol_spec[('backup', False)][0])
+        backup_spec[('retention', True)] = self._retention_spec(backup_spec[('retention', True)], custom_periods)
+        subvol_spec[('backup', False)] = [backup_spec]
+        systemdboot_spec = dict(subvol_spec[('systemd-boot', False)][0])
+        systemdboot_spec[('retention', True)] = self._retention_spec(systemdboot_spec[('retention', True)], custom_periods)
+        subvol_spec[('systemd-boot', False)] = [systemdboot_spec]
+        config_spec = dict(self.config_spec)
+        config_spec[('subvolumes', False)] = [subvol_spec]
+        return config_spec
+
+    def _retention_spec(self, retention_spec, custom_periods):
+        # At least one period is still required, which can be a custom one
+        spec = {}
+        for (name, required), value in retention_spec.items():
+            if type(required) == tuple:
+                required = required + tuple([p.name for p in custom_periods])
+            spec[(name, required)] = value
+        for period in custom_periods:
+            spec[(period.name, False)] = int
+        return spec
+
+    def load_state(self):
+        self.state_path = default_state_path
+        if 'state-path' in self.raw_config:
+            self.state_path = PosixPath(self.raw_config['state-path'])
+        transfer_journal.set_path(PosixPath(self.state_path, transfer_journal_file_name))
+        target_state_store.set_path(PosixPath(self.state_path, target_state_dir_name))
+
+    def load_metrics(self):
+        self.metrics_prometheus_path = None
+        self.metrics_json_path = None
+        if 'metrics' in self.raw_config:
+            metrics_config = self.raw_config['metrics']
+            if 'prometheus' in metrics_config:
+                # node_exporter's textfile collector ignores any other files
+                if not metrics_config['prometheus'].endswith('.prom'):
+                    raise ConfigException(['metrics', 'prometheus'], 'must end with .prom')
+                self.metrics_prometheus_path = PosixPath(metrics_config['prometheus'])
+            if 'json' in metrics_config:
+                self.metrics_json_path = PosixPath(metrics_config['json'])
+
+    def load_execution(self):
+        self.workers = 1
+        self.workers_per_device = None
+        self.backup_workers = 1
+        backups_per_host = None
+        backups_per_device = None
+        if 'execution' in self.raw_config:
+            execution_config = self.raw_config['execution']
+            if 'workers' in execution_config:
+                self.workers = self._positive_int(execution_config, 'workers')
+            if 'workers-per-device' in execution_config:
+                self.workers_per_device = self._positive_int(execution_config, 'workers-per-device')
+            if 'backup-workers' in execution_config:
+                self.backup_workers = self._positive_int(execution_config, 'backup-workers')
+            if 'backups-per-host' in execution_config:
+                backups_per_host = self._positive_int(execution_config, 'backups-per-host')
+            if 'backups-per-device' in execution_config:
+                backups_per_device = self._positive_int(execution_config, 'backups-per-device')
+        self.backup_limiter = BackupLimiter(backups_per_host, backups_per_device)
+        if 'execution' in self.raw_config and 'btrfs-backend' in self.raw_config['execution']:
+            set_btrfs_backend(BTRFS_BACKEND_NAME_MAP[self.raw_config['execution']['btrfs-backend']]())
+
+    def _positive_int(self, execution_config, name):
+        value = int(execution_config[name])
+        if value < 1:
+            raise ConfigException(['execution', name], 'must be at least 1')
+        return value
 
     def get_subvolume_config(self):
         config = {}
@@ -168,6 +353,16 @@ class Config():
             self.subvolumes[subvol] = Subvolume(subvol)
             if 'snapshots-path' in subvol_config:
                 self.subvolumes[subvol].set_snapshot_dir(subvol_config['snapshots-path'])
+            if 'deletion' in subvol_config:
+                deletion_config = subvol_config['deletion']
+                if 'batch-size' in deletion_config:
+                    if deletion_config['batch-size'] < 1:
+                        raise ConfigException(['subvolumes', subvol, 'deletion', 'batch-size'], 'must be at least 1')
+                    self.subvolumes[subvol].delete_batch_size = deletion_config['batch-size']
+                if 'interval' in deletion_config:
+                    if deletion_config['interval'] < 0:
+                        raise ConfigException(['subvolumes', subvol, 'deletion', 'interval'], 'must not be negative')
+                    self.subvolumes[subvol].delete_interval = deletion_config['interval']
 
             subvol_retention = {}
             for period in PERIODS:
@@ -183,7 +378,7 @@ class Config():
 
             self.backups[subvol] = []
             if 'backup' in subvol_config:
-                for backup_config in subvol_config['backup']:
+                for i, backup_config in enumerate(subvol_config['backup']):
 
                     backup_type = backup_config['type']
 
@@ -216,13 +411,64 @@ class Config():
                     for period in PERIODS:
                         if period.name in backup_config['retention']:
                             backup.retention[period] = int(backup_config['retention'][period.name])
+                    subvol_instance.retention.add_policy(backup, "backup {0}".format(i))
                     if 'minimum' in backup_config['retention']:
                         backup.retention_minimum = int(backup_config['retention']['minimum'])
                     if 'last_sync_file' in backup_config:
                         backup.last_sync_file = backup_config['last_sync_file']
+                    backup.limiter = self.backup_limiter
+                    if 'clone-sources' in backup_config:
+                        if backup_type != 'btrfs':
+                            raise ConfigException(['subvolumes', subvol, 'backup', str(i), 'clone-sources'], 'only supported for btrfs backups')
+                        if backup_config['clone-sources'] < 0:
+                            raise ConfigException(['subvolumes', subvol, 'backup', str(i), 'clone-sources'], 'must not be negative')
+                        backup.clone_sources = backup_config['clone-sources']
+                    if 'catch-up' in backup_config:
+                        if backup_type != 'btrfs':
+                            raise ConfigException(['subvolumes', subvol, 'backup', str(i), 'catch-up'], 'only supported for btrfs backups')
+                        if backup_config['catch-up'] < 2:
+                            raise ConfigException(['subvolumes', subvol, 'backup', str(i), 'catch-up'], 'must be at least 2')
+                        backup.catch_up = backup_config['catch-up']
+                    if 'inventory-max-age' in backup_config:
+                        if backup_config['inventory-max-age'] < 0:
+                            raise ConfigException(['subvolumes', subvol, 'backup', str(i), 'inventory-max-age'], 'must not be negative')
+                        backup.inventory_max_age = None
+                        if backup_config['inventory-max-age'] > 0:
+                            backup.inventory_max_age = timedelta(hours=backup_config['inventory-max-age'])
+                    if 'transfer' in backup_config:
+                        backup.transfer_pipeline = self.load_transfer_pipeline(subvol, i, backup_type, backup_config['transfer'])
+                        if backup_config['transfer'].get('resumable', False):
+                            if not isinstance(backup, RemoteBtrfsBackup):
+                                raise ConfigException(['subvolumes', subvol, 'backup', str(i), 'transfer', 'resumable'], 'only supported for remote btrfs backups')
+                            if backup.catch_up is not None:
+                                raise ConfigException(['subvolumes', subvol, 'backup', str(i), 'transfer', 'resumable'], 'can\'t be used with catch-up')
+                            backup.spool_path = PosixPath(self.state_path, 'spool')
+                            if 'spool-path' in backup_config['transfer']:
+                                backup.spool_path = PosixPath(backup_config['transfer']['spool-path'])
 
                     self.backups[subvol].append(backup)
 
+    def load_transfer_pipeline(self, subvol, i, backup_type, transfer_config):
+        parents = ['subvolumes', subvol, 'backup', str(i), 'transfer']
+        if backup_type != 'btrfs':
+            raise ConfigException(parents, 'only supported for btrfs backups')
+        compression = None
+        if 'compression' in transfer_config and transfer_config['compression'] != 'none':
+            compression = transfer_config['compression']
+        compression_level = None
+        if 'compression-level' in transfer_config:
+            if compression is None:
+                raise ConfigException(parents + ['compression-level'], 'requires compression')
+            compression_level = transfer_config['compression-level']
+            if compression_level < 1:
+                raise ConfigException(parents + ['compression-level'], 'must be at least 1')
+        buffer_size = None
+        if 'buffer-size' in transfer_config:
+            if transfer_config['buffer-size'] < 1:
+                raise ConfigException(parents + ['buffer-size'], 'must be at least 1')
+            buffer_size = transfer_config['buffer-size'] * 1024 * 1024
+        return TransferPipeline(compression, compression_level, buffer_size)
+
     def load_systemdboot(self):
         self.systemdboot_manager = None
 
@@ -234,6 +480,8 @@ class Config():
                 systemdboot_manager.set_boot_path(systemdboot_config['boot-path'])
             if 'init-files' in systemdboot_config:
                 systemdboot_manager.set_init_file_list(systemdboot_config['init-files'])
+            if 'deduplicate' in systemdboot_config:
+                systemdboot_manager.deduplicate = systemdboot_config['deduplicate']
 
         config = self.get_subvolume_config()
         for subvol, subvol_config in config.items():
@@ -258,6 +506,7 @@ class Config():
                             retention[period] = int(systemdboot_config_entry['retention'][period.name])
 
                     systemdbootentry = SystemdBootEntryManager(self.systemdboot_manager, subvol_instance, entry, retention)
+                    subvol_instance.retention.add_policy(systemdbootentry, "systemd-boot {0}".format(entry))
 
                     if 'boot-path' in systemdboot_config:
                         systemdbootentry.set_boot_path(systemdboot_config['boot-path'])
@@ -0,0 +1,285 @@
+#!/usr/bin/python3
+
+from btrfssnapshotmanager.manager import *
+from btrfssnapshotmanager.scheduler import *
+
+from pathlib import PosixPath
+import os
+import signal
+import socket
+import socketserver
+
+
+default_daemon_socket = '/run/btrfs-snapshot-manager/daemon.sock'
+daemon_retry_interval = 3600
+daemon_query_timeout = 30
+daemon_query_wait = 20
+
+
+def sd_notify(*messages):
+    # Tell systemd about the daemon's state, if it was started by systemd as a
+    # notify service
+    notify_socket = os.environ.get('NOTIFY_SOCKET')
+    if notify_socket is None or notify_socket == '':
+        return False
+    if notify_socket.startswith('@'):
+        notify_socket = "\0" + notify_socket[1:]
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM | socket.SOCK_CLOEXEC) as sock:
+            sock.connect(notify_socket)
+            sock.sendall("\n".join(messages).encode('utf-8'))
+    except OSError as e:
+        debug("Failed to notify systemd: {0}".format(e))
+        return False
+    return True
+
+def query_daemon(command, args, socket_path=None):
+    # Ask a running daemon to answer a query, returning None if there's no
+    # daemon to ask, so the caller can answer it itself
+    if socket_path is None:
+        socket_path = default_daemon_socket
+    if not os.path.exists(socket_path):
+        return None
+    import json
+    request = json.dumps({'command': command, 'args': args}) + "\n"
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(daemon_query_timeout)
+            sock.connect(socket_path)
+            sock.sendall(request.encode('utf-8'))
+            with sock.makefile('rb') as fh:
+                response = fh.readline()
+    except OSError as e:
+        debug("Daemon not available on {0}: {1}".format(socket_path, e))
+        return None
+    try:
+        response = json.loads(response)
+    except ValueError:
+        debug("Invalid response from daemon on {0}".format(socket_path))
+        return None
+    if response.get('busy'):
+        debug("Daemon on {0} is busy with a run".format(socket_path))
+        return None
+    if 'error' in response:
+        raise SnapshotException(response['error'])
+    return response['result']
+
+
+class DaemonBusyException(SnapshotException):
+
+    def __init__(self):
+        super().__init__("Daemon is busy")
+
+
+class DaemonRequestHandler(socketserver.StreamRequestHandler):
+
+    # One JSON request per connection, answered with one JSON response
+
+    def handle(self):
+        import json
+        try:
+            request = json.loads(self.rfile.readline())
+            response = {'result': self.server.daemon.query(request['command'], request.get('args', {}))}
+        except (ValueError, KeyError, TypeError) as e:
+            response = {'error': "Invalid request: {0}".format(e)}
+        except DaemonBusyException:
+            response = {'busy': True}
+        except (SnapshotException, CommandException, ConfigException) as e:
+            response = {'error': e.error}
+        try:
+            self.wfile.write((json.dumps(response) + "\n").encode('utf-8'))
+        except OSError as e:
+            debug("Failed to send response: {0}".format(e))
+
+
+class DaemonServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+
+    daemon_threads = True
+
+    def __init__(self, path, daemon):
+        self.daemon = daemon
+        super().__init__(str(path), DaemonRequestHandler)
+
+
+class SnapshotDaemon():
+
+    # Runs scheduled snapshots for as long as it's running, keeping subvolumes,
+    # snapshots and systemd-boot entries in memory between runs, and answers
+    # queries from the command line over a Unix socket
+
+    def __init__(self, socket_path=None, queries=None):
+        if socket_path is None:
+            socket_path = default_daemon_socket
+        self.socket_path = PosixPath(socket_path)
+        self.queries = queries
+        if self.queries is None:
+            self.queries = {}
+        self.snapshot_manager = None
+        self.scheduler = Scheduler()
+        self.server = None
+        self.wake = threading.Event()
+        self.stopping = False
+        self.reloading = False
+        self.state_lock = threading.Lock()
+        self.failures = {}
+        self.snapshots_dir_mtimes = {}
+
+    def run(self):
+        self.snapshot_manager = get_snapshot_manager()
+        self.remember_snapshots_dirs()
+        self.schedule_all()
+        self.start_server()
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        signal.signal(signal.SIGHUP, self._reload)
+        sd_notify('READY=1', 'STATUS=Started')
+        info("Daemon started, listening on {0}".format(self.socket_path))
+        try:
+            while not self.stopping:
+                self.wake.clear()
+                if self.reloading:
+                    self.reload()
+                now = datetime.now()
+                due = self.scheduler.pop_due(now)
+                if len(due) > 0:
+                    self.execute([s for s in self.snapshot_manager.managers if s in due], now)
+                    continue
+                self.sleep()
+        finally:
+            sd_notify('STOPPING=1')
+            self.stop_server()
+            info("Daemon stopped")
+
+    def sleep(self):
+        next_run = self.scheduler.next_due()
+        if next_run is None:
+            sd_notify('STATUS=Nothing scheduled')
+            debug("Nothing scheduled, waiting...")
+            self.wake.wait()
+            return
+        sd_notify("STATUS=Next run at {0}".format(next_run.strftime('%Y-%m-%d %H:%M:%S')))
+        debug("Waiting until next run at {0}".format(next_run))
+        # Wake at least once a minute, so a change to the clock or a resume
+        # from suspend doesn't delay a run for long
+        self.wake.wait(min(max((next_run - datetime.now()).total_seconds(), 0), 60))
+
+    def schedule_all(self):
+        self.scheduler.clear()
+        for subvol in self.snapshot_manager.managers:
+            self.schedule(subvol)
+
+    def schedule(self, subvol):
+        # When the subvolume next needs a run for each of its periods. After a
+        # failed run, it's tried again after a while rather than straight away.
+        manager = self.snapshot_manager.managers[subvol]
+        failure = self.failures.get(subvol)
+        due_times = []
+        for period, count in manager.retention_config.items():
+            if count <= 0:
+                continue
+            next_run = manager.next_run(period)
+            if next_run is None:
+                next_run = datetime.min
+            if failure is not None and next_run <= failure['at']:
+                next_run = failure['retry']
+            due_times.append((next_run, period))
+        if failure is not None:
+            due_times.append((failure['retry'], None))
+        self.scheduler.schedule(subvol, due_times)
+
+    def execute(self, subvols, now):
+        sd_notify("STATUS=Running {0}".format(', '.join(subvols)))
+        with self.state_lock:
+            self.refresh()
+            try:
+                self.snapshot_manager.execute(subvols=subvols)
+                for subvol in subvols:
+                    self.failures.pop(subvol, None)
+            except (SnapshotException, CommandException) as e:
+                error("Scheduled run failed: {0}".format(e.error))
+                retry = datetime.now() + timedelta(seconds=daemon_retry_interval)
+                for subvol in subvols:
+                    self.failures[subvol] = {'at': now, 'retry': retry}
+            self.remember_snapshots_dirs()
+            for subvol in subvols:
+                self.schedule(subvol)
+
+    def refresh(self):
+        # Snapshots created or deleted by something other than this daemon
+        # change the snapshots directory, so those subvolumes are reloaded
+        for subvol, manager in self.snapshot_manager.managers.items():
+            mtime = self._snapshots_dir_mtime(manager.subvol)
+            if subvol in self.snapshots_dir_mtimes and self.snapshots_dir_mtimes[subvol] != mtime:
+                debug("Snapshots of {0} changed outside the daemon, reloading them".format(subvol))
+                manager.subvol.unload_snapshots()
+                systemdboot_manager = self.snapshot_manager.systemdboot_manager
+                if systemdboot_manager is not None:
+                    for entry_manager in systemdboot_manager.entry_managers:
+                        if entry_manager.subvol is manager.subvol:
+                            entry_manager.unload_entries()
+                self.schedule(subvol)
+                self.wake.set()
+            self.snapshots_dir_mtimes[subvol] = mtime
+
+    def remember_snapshots_dirs(self):
+        for subvol, manager in self.snapshot_manager.managers.items():
+            self.snapshots_dir_mtimes[subvol] = self._snapshots_dir_mtime(manager.subvol)
+
+    def reload(self):
+        self.reloading = False
+        sd_notify('RELOADING=1')
+        info("Reloading config")
+        with self.state_lock:
+            try:
+                self.snapshot_manager = reload_snapshot_manager()
+                self.failures = {}
+                self.snapshots_dir_mtimes = {}
+                self.remember_snapshots_dirs()
+                self.schedule_all()
+            except (SnapshotException, CommandException, ConfigException) as e:
+                error("Failed to reload config, keeping the old config: {0}".format(e.error))
+        sd_notify('READY=1')
+
+    def query(self, command, args):
+        if command not in self.queries:
+            raise SnapshotException("Unknown query {0}".format(command))
+        # Snapshots are changed part way through a run, so wait for one in
+        # progress to finish, but not for longer than the command line waits
+        # for an answer. If it's still going, the command line answers the
+        # query itself.
+        if not self.state_lock.acquire(timeout=daemon_query_wait):
+            raise DaemonBusyException()
+        try:
+            self.refresh()
+            return self.queries[command](self.snapshot_manager, args)
+        finally:
+            self.state_lock.release()
+
+    def start_server(self):
+        self.socket_path.parent.mkdir(mode=0o755, parents=True, exist_ok=True)
+        if self.socket_path.exists():
+            self.socket_path.unlink()
+        self.server = DaemonServer(self.socket_path, self)
+        os.chmod(self.socket_path, 0o600)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop_server(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+            self.socket_path.unlink(missing_ok=True)
+
+    def _stop(self, signum, frame):
+        self.stopping = True
+        self.wake.set()
+
+    def _reload(self, signum, frame):
+        self.reloading = True
+        self.wake.set()
+
+    def _snapshots_dir_mtime(self, subvol):
+        try:
+            return os.stat(subvol.snapshots_dir).st_mtime_ns
+        except OSError:
+            return None
@@ -0,0 +1,169 @@
+#!/usr/bin/python3
+
+from btrfssnapshotmanager.common import *
+
+from datetime import *
+from pathlib import PosixPath
+import hashlib
+import threading
+
+
+default_state_path = PosixPath('/var/lib/btrfs-snapshot-manager')
+transfer_journal_file_name = 'transfers.json'
+target_state_dir_name = 'targets'
+
+
+class TransferJournal():
+
+    # Records transfers that are in flight for each subvolume's backup
+    # targets, so that an interrupted transfer can be resumed - or its
+    # leftovers cleaned up - on a later attempt
+
+    def __init__(self, path=None):
+        self.path = path
+        if self.path is None:
+            self.path = PosixPath(default_state_path, transfer_journal_file_name)
+        self.lock = threading.RLock()
+        self._entries = None
+
+    @property
+    def entries(self):
+        with self.lock:
+            if self._entries is None:
+                self.load()
+            return self._entries
+
+    def set_path(self, path):
+        with self.lock:
+            self.path = PosixPath(path)
+            self._entries = None
+
+    def load(self):
+        self._entries = {}
+        if not self.path.is_file():
+            return
+        import json
+        try:
+            with open(self.path, 'r') as fh:
+                entries = json.load(fh)
+        except ValueError as e:
+            warn("Transfer journal {0} is corrupt, ignoring it: {1}".format(self.path, e))
+            return
+        # Entries are kept by subvolume, then target, then snapshot
+        if not journal_entries_valid(entries, 4):
+            warn("Transfer journal {0} isn't in the expected format, ignoring it".format(self.path))
+            return
+        self._entries = entries
+
+    def save(self):
+        import json
+        self.path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+        write_file_atomic(self.path, json.dumps(self._entries, indent=2, sort_keys=True))
+
+    def get(self, subvol, target, snapshot):
+        with self.lock:
+            return self.entries.get(subvol, {}).get(target, {}).get(snapshot)
+
+    def target_entries(self, subvol, target):
+        with self.lock:
+            return dict(self.entries.get(subvol, {}).get(target, {}))
+
+    def start(self, subvol, target, snapshot, **details):
+        with self.lock:
+            entry = dict(details)
+            entry['started'] = datetime.now().isoformat(timespec='seconds')
+            self.entries.setdefault(subvol, {}).setdefault(target, {})[snapshot] = entry
+            self.save()
+            return entry
+
+    def update(self, subvol, target, snapshot, **details):
+        with self.lock:
+            entry = self.entries[subvol][target][snapshot]
+            entry.update(details)
+            self.save()
+            return entry
+
+    def finish(self, subvol, target, snapshot):
+        with self.lock:
+            subvol_entries = self.entries.get(subvol, {})
+            target_entries = subvol_entries.get(target, {})
+            if snapshot not in target_entries:
+                return
+            del target_entries[snapshot]
+            if len(target_entries) == 0:
+                del subvol_entries[target]
+            if len(subvol_entries) == 0:
+                del self.entries[subvol]
+            self.save()
+
+
+def journal_entries_valid(entries, depth):
+    if not isinstance(entries, dict):
+        return False
+    if depth == 1:
+        return True
+    return all([journal_entries_valid(e, depth - 1) for e in entries.values()])
+
+
+class TargetStateStore():
+
+    # Keeps a state file per backup target, holding what the target was last
+    # known to contain, and which source snapshots were synced to it at the
+    # time. A file is removed before the target is changed, and only written
+    # again once the change has succeeded, so a failed run can never leave a
+    # stale state behind.
+
+    def __init__(self, path=None):
+        self.path = path
+        if self.path is None:
+            self.path = PosixPath(default_state_path, target_state_dir_name)
+        self.lock = threading.Lock()
+
+    def set_path(self, path):
+        with self.lock:
+            self.path = PosixPath(path)
+
+    def state_file(self, subvol, target):
+        key = hashlib.sha1("{0}\0{1}".format(subvol, target).encode('utf-8')).hexdigest()[:16]
+        return PosixPath(self.path, key + '.json')
+
+    def get(self, subvol, target):
+        with self.lock:
+            state_file = self.state_file(subvol, target)
+            if not state_file.is_file():
+                return None
+            import json
+            try:
+                with open(state_file, 'r') as fh:
+                    state = json.load(fh)
+            except ValueError as e:
+                warn("Target state {0} is corrupt, ignoring it: {1}".format(state_file, e))
+                return None
+            if not isinstance(state, dict) or state.get('subvolume') != subvol or state.get('target') != target:
+                return None
+            return state
+
+    def save(self, subvol, target, inventory, synced=None):
+        import json
+        with self.lock:
+            state_file = self.state_file(subvol, target)
+            state_file.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+            state = {
+                'subvolume': subvol,
+                'target': target,
+                'updated': datetime.now().isoformat(timespec='seconds'),
+                'inventory': inventory,
+                'synced': synced,
+            }
+            write_file_atomic(state_file, json.dumps(state, indent=2, sort_keys=True))
+
+    def invalidate(self, subvol, target):
+        with self.lock:
+            state_file = self.state_file(subvol, target)
+            if state_file.exists():
+                debug("Invalidating cached state of target {0}".format(target))
+                state_file.unlink()
+
+
+transfer_journal = TransferJournal()
+target_state_store = TargetStateStore()
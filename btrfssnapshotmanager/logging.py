@@ -1,13 +1,25 @@
 #!/usr/bin/python3
 
 import sys
+import threading
+
+
+log_lock = threading.Lock()
+log_context = threading.local()
 
 
 def log_output(level, messages):
     if LOG_CONFIG['level'] <= level:
         log_config = LOG_CONFIG['levels'][level]
-        print(log_config['prefix']
-              + ' '.join([str(m) for m in messages]), file=log_config['output'], flush=True)
+        line = log_config['prefix'] + get_log_prefix() + ' '.join([str(m) for m in messages])
+        with log_lock:
+            print(line, file=log_config['output'], flush=True)
+
+def get_log_prefix():
+    return getattr(log_context, 'prefix', '')
+
+def set_log_prefix(prefix):
+    log_context.prefix = prefix
 
 def trace(*messages):
     log_output(0, messages)
@@ -1,6 +1,24 @@
 #!/usr/bin/python3
 
-from btrfssnapshotmanager.config import *
+from btrfssnapshotmanager.plan import *
+
+
+shared_snapshot_manager = None
+
+def get_snapshot_manager():
+    # One snapshot manager is shared by everything in this process, so config,
+    # subvolumes and snapshots are only ever loaded once
+    global shared_snapshot_manager
+    if shared_snapshot_manager is None:
+        shared_snapshot_manager = SnapshotManager()
+    return shared_snapshot_manager
+
+def reload_snapshot_manager():
+    # Replace the shared snapshot manager with one freshly loaded from config,
+    # keeping the old one if the config is now invalid
+    global shared_snapshot_manager
+    shared_snapshot_manager = SnapshotManager()
+    return shared_snapshot_manager
 
 
 class SnapshotManager():
@@ -17,41 +35,123 @@ class SnapshotManager():
             )
         self.systemdboot_manager = self.config.systemdboot_manager
 
-    def execute(self, subvols=None):
+    def execute(self, subvols=None, workers=None):
+        run_metrics.reset()
+        command_stats.reset()
+        start_time = time.time()
+        start = time.monotonic()
+        success = False
+        try:
+            self._execute(subvols, workers)
+            success = True
+        finally:
+            run_metrics.set('run_timestamp_seconds', start_time)
+            run_metrics.set('run_duration_seconds', time.monotonic() - start)
+            run_metrics.set('run_success', success)
+            run_metrics.set('subprocesses', command_stats.count)
+            run_metrics.set('subprocess_cpu_seconds', command_stats.cpu_time)
+            self.write_metrics()
+
+    def write_metrics(self):
+        if self.config.metrics_prometheus_path is None and self.config.metrics_json_path is None:
+            return
+        try:
+            run_metrics.write(self.config.metrics_prometheus_path, self.config.metrics_json_path)
+        except OSError as e:
+            error("Failed to write metrics: {0}".format(e))
+
+    def _execute(self, subvols, workers):
         managers_to_run = self.managers
         if subvols is not None and len(subvols) > 0:
             managers_to_run = dict([(s, m) for s, m in managers_to_run.items() if s in subvols])
 
         headings = self._make_headings([s for s in managers_to_run.keys()])
 
+        if workers is None:
+            workers = self.config.workers
+        if workers > 1 and len(managers_to_run) > 1:
+            failures = self._execute_parallel(managers_to_run, headings, workers)
+        else:
+            failures = []
+            for subvol, manager in managers_to_run.items():
+                info(headings[subvol])
+                if not self._execute_subvol_logged(subvol, manager):
+                    failures.append(subvol)
+
+        # One subvolume failing doesn't stop the others from running
+        if len(failures) > 0:
+            raise SnapshotException("Failed to run {0} subvolume(s): {1}".format(len(failures), ', '.join(failures)))
+
+    def _execute_parallel(self, managers_to_run, headings, workers):
+        # Group subvolumes by the device they're on, so subvolumes on the same
+        # filesystem can be limited while different filesystems run freely
+        pending = {}
         for subvol, manager in managers_to_run.items():
-            info(headings[subvol])
-
-            # Search for periods that require a new snapshot
-            periods = []
-            for period, count in manager.retention_config.items():
-                if manager.should_run(period):
-                    debug("Period reached:", period.name)
-                    periods.append(period)
-
-            # If required, create a new snapshot
-            if len(periods) > 0:
-                manager.create_snapshot(periods)
-            else:
-                debug("No periods reached")
-
-            # Delete unwanted snapshots
-            manager.cleanup()
-
-            # Sync backups
-            manager.backup()
+            device = filesystem_device(manager.subvol.path)
+            if device not in pending:
+                pending[device] = []
+            pending[device].append(subvol)
+        running = dict([(device, 0) for device in pending])
+        per_device = self.config.workers_per_device
 
-            # Sync systemd-boot entries
-            if self.systemdboot_manager is not None:
-                for entry_manager in self.systemdboot_manager.entry_managers:
-                    if entry_manager.subvol.name == subvol:
-                        entry_manager.run()
+        debug("Running {0} subvolumes across {1} devices with {2} workers".format(len(managers_to_run), len(pending), workers))
 
+        def run(subvol):
+            set_log_prefix("[{0}] ".format(subvol))
+            info(headings[subvol])
+            return self._execute_subvol_logged(subvol, managers_to_run[subvol])
+
+        from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+        failures = []
+        futures = {}
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            while True:
+                # Start subvolumes on devices with a free slot, taking devices
+                # in turn, so a worker is never left waiting for a device
+                # while another device has subvolumes to run
+                started = True
+                while started and len(futures) < workers:
+                    started = False
+                    for device, subvols in pending.items():
+                        if len(futures) >= workers:
+                            break
+                        if len(subvols) == 0 or (per_device is not None and running[device] >= per_device):
+                            continue
+                        subvol = subvols.pop(0)
+                        running[device] += 1
+                        futures[executor.submit(run, subvol)] = (subvol, device)
+                        started = True
+                if len(futures) == 0:
+                    break
+
+                done, not_done = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    subvol, device = futures.pop(future)
+                    running[device] -= 1
+                    if not future.result():
+                        failures.append(subvol)
+
+        return failures
+
+    def _execute_subvol_logged(self, subvol, manager):
+        # Returns whether the subvolume ran successfully
+        try:
+            self._execute_subvol(subvol, manager)
+        except (SnapshotException, CommandException) as e:
+            error("Failed to run subvolume {0}: {1}".format(subvol, e.error))
+            return False
+        return True
+
+    def _execute_subvol(self, subvol, manager):
+        # Work out everything to do first, then do it
+        plan = RunPlanner(self).plan_subvol(manager)
+        PlanExecutor(self).execute(plan)
+
+    def plan(self, subvols=None):
+        managers_to_run = self.managers
+        if subvols is not None and len(subvols) > 0:
+            managers_to_run = dict([(s, m) for s, m in managers_to_run.items() if s in subvols])
+        return RunPlanner(self, preview=True).plan(managers_to_run.values())
 
     def cleanup(self, subvols=None):
         managers_to_run = self.managers
@@ -92,15 +192,20 @@ class SubvolumeManager():
             self.subvol.init_snapshots()
         self.retention_config = retention_config
         self.backups = backup_config
+        self.subvol.retention.add_policy(self, 'snapshots')
+
+    @property
+    def retention(self):
+        return self.retention_config
 
     def last_run(self, period):
         if period not in self.retention_config:
             raise SnapshotException("No {0} snapshot schedule set for subvolume {1}".format(period.name, self.subvol.name))
-        snapshots = self.subvol.search_snapshots(periods=[period])
-        if len(snapshots) == 0:
+        snapshot = self.subvol.last_snapshot(period)
+        if snapshot is None:
             return None
         else:
-            return snapshots[-1].date
+            return snapshot.date
 
     def next_run(self, period):
         last_run = self.last_run(period)
@@ -119,35 +224,97 @@ class SubvolumeManager():
     def create_snapshot(self, periods):
         self.subvol.create_snapshot(periods=periods)
 
+    def periods_due(self):
+        # Periods that require a new snapshot. A period keeping no snapshots
+        # would have its snapshot deleted straight away, so is never due.
+        periods = []
+        for period, count in self.retention_config.items():
+            if count > 0 and self.should_run(period):
+                debug("Period reached:", period.name)
+                periods.append(period)
+        return periods
+
     def cleanup(self):
-        dont_delete = set()
-        for period in PERIODS:
-            max_snapshots = 0
-            if period in self.retention_config:
-                max_snapshots = self.retention_config[period]
-            snapshots = self.subvol.search_snapshots(periods=[period])
-            debug("cleanup - searched for snapshots with period {}".format(period))
-            for snapshot in snapshots[max(0, len(snapshots) - max_snapshots) : ]:
-                dont_delete.add(snapshot)
-                debug("- Don't delete: {}".format(snapshot.name))
-        snapshots = self.subvol.search_snapshots(periods=PERIODS)
-        count = 0
+        queue = SnapshotDeleteQueue(self.subvol)
+        for snapshot in self.plan_cleanup():
+            queue.add(snapshot)
+        return queue.run()
+
+    def plan_cleanup(self, snapshots=None):
+        # Snapshots that aren't retained for any period, out of the given
+        # snapshots, which default to the subvolume's current ones
+        if snapshots is None:
+            snapshots = self.subvol.snapshots
+        dont_delete = self.subvol.retention.keep(snapshots, self)
+        # Snapshots without any period weren't created by a schedule, so are
+        # left alone
+        to_delete = []
         for snapshot in snapshots:
+            if snapshot.periods is None or len(snapshot.periods) == 0:
+                continue
             if snapshot not in dont_delete:
                 debug("Deleting snapshot:", snapshot.name)
-                snapshot.delete()
+                to_delete.append(snapshot)
+            else:
+                debug("- Don't delete: {}".format(snapshot.name))
+        return to_delete
 
-    def backup(self, ids=None):
+    def backup(self, ids=None, syncs=None):
         if ids is not None and len(ids) > 0:
             for i in ids:
                 if i < 0 or i >= len(self.backups) or i != int(i):
                     raise SnapshotException("Invalid backup ID {0} for subvolume {1}".format(i, self.subvol.name))
 
         backups = self.get_backups(ids)
-        for i, backup in sorted(backups.items(), key=lambda b: b[0]):
-            if ids is not None and i not in ids:
-                continue
-            backup.backup()
+        backups = sorted(backups.items(), key=lambda b: b[0])
+        workers = self.snapshot_manager.config.backup_workers
+        if syncs is None:
+            syncs = {}
+
+        failures = []
+        if workers > 1 and len(backups) > 1:
+            log_prefix = get_log_prefix()
+
+            def run(i, backup):
+                set_log_prefix("{0}[backup {1}] ".format(log_prefix, i))
+                self.run_backup(backup, syncs.get(i))
+
+            from concurrent.futures import ThreadPoolExecutor, as_completed
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = dict([(executor.submit(run, i, backup), (i, backup)) for i, backup in backups])
+                for future in as_completed(futures):
+                    i, backup = futures[future]
+                    try:
+                        future.result()
+                    except (SnapshotException, CommandException) as e:
+                        error("Failed to sync backup {0} to {1}: {2}".format(i, backup.location(), e.error))
+                        failures.append(i)
+        else:
+            for i, backup in backups:
+                try:
+                    self.run_backup(backup, syncs.get(i))
+                except (SnapshotException, CommandException) as e:
+                    error("Failed to sync backup {0} to {1}: {2}".format(i, backup.location(), e.error))
+                    failures.append(i)
+
+        if len(failures) > 0:
+            raise SnapshotException("Failed to sync {0} backup(s) for subvolume {1}: {2}".format(
+                len(failures), self.subvol.name, ', '.join([str(i) for i in sorted(failures)])))
+
+    def run_backup(self, backup, sync=None):
+        labels = {'subvolume': self.subvol.name, 'target': backup.location()}
+        success = False
+        try:
+            with run_metrics.timer('backup_duration_seconds', **labels):
+                backup.run(sync)
+            success = True
+        finally:
+            run_metrics.set('backup_success', success, **labels)
+            run_metrics.set('backup_transferred_bytes', backup.transferred_bytes, **labels)
+            throughput = 0.0
+            if backup.transfer_seconds > 0:
+                throughput = backup.transferred_bytes / backup.transfer_seconds
+            run_metrics.set('backup_throughput_bytes_per_second', throughput, **labels)
 
     def get_backups(self, ids=None):
         if ids is not None and len(ids) > 0:
@@ -0,0 +1,97 @@
+#!/usr/bin/python3
+
+from btrfssnapshotmanager.common import *
+
+from contextlib import contextmanager
+import threading
+
+
+metrics_prefix = 'btrfs_snapshot_manager_'
+
+METRICS = {
+    'run_timestamp_seconds': "Time the last run started",
+    'run_duration_seconds': "Duration of the last run",
+    'run_success': "Whether the last run completed without errors",
+    'subprocesses': "Number of subprocesses spawned during the last run",
+    'subprocess_cpu_seconds': "CPU time used by subprocesses during the last run",
+    'snapshot_create_duration_seconds': "Time taken to create the snapshot",
+    'cleanup_deleted_snapshots': "Number of snapshots deleted by cleanup",
+    'cleanup_duration_seconds': "Time taken to clean up old snapshots",
+    'backup_duration_seconds': "Time taken to sync the backup",
+    'backup_transferred_bytes': "Bytes transferred to the backup target",
+    'backup_throughput_bytes_per_second': "Average transfer rate to the backup target",
+    'backup_success': "Whether the backup synced without errors",
+    'systemdboot_sync_duration_seconds': "Time taken to sync systemd-boot entries",
+}
+
+
+class RunMetrics():
+
+    # Metrics collected over a single run, keyed by name and labels
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def reset(self):
+        with self.lock:
+            self.values = {}
+
+    def set(self, name, value, **labels):
+        if name not in METRICS:
+            raise SnapshotException("Unknown metric {0}".format(name))
+        with self.lock:
+            self.values[(name, tuple(sorted(labels.items())))] = value
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.set(name, time.monotonic() - start, **labels)
+
+    def prometheus_text(self):
+        lines = []
+        with self.lock:
+            values = sorted(self.values.items())
+        last_name = None
+        for (name, labels), value in values:
+            if name != last_name:
+                lines.append("# HELP {0}{1} {2}".format(metrics_prefix, name, METRICS[name]))
+                lines.append("# TYPE {0}{1} gauge".format(metrics_prefix, name))
+                last_name = name
+            label_text = ''
+            if len(labels) > 0:
+                label_text = '{' + ','.join(['{0}="{1}"'.format(k, _prometheus_escape(v)) for k, v in labels]) + '}'
+            lines.append("{0}{1}{2} {3}".format(metrics_prefix, name, label_text, _prometheus_value(value)))
+        return "\n".join(lines) + "\n"
+
+    def json_text(self):
+        import json
+        with self.lock:
+            values = sorted(self.values.items())
+        metrics = [{'name': name, 'labels': dict(labels), 'value': value} for (name, labels), value in values]
+        return json.dumps({'metrics': metrics}, indent=2) + "\n"
+
+    def write(self, prometheus_path=None, json_path=None):
+        if prometheus_path is not None:
+            debug("Writing metrics to {0}".format(prometheus_path))
+            write_file_atomic(prometheus_path, self.prometheus_text(), mode=0o644)
+        if json_path is not None:
+            debug("Writing metrics to {0}".format(json_path))
+            write_file_atomic(json_path, self.json_text(), mode=0o644)
+
+
+def _prometheus_escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace("\n", '\\n')
+
+def _prometheus_value(value):
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+run_metrics = RunMetrics()
@@ -57,6 +57,49 @@ class PeriodMonth(Period):
         return last_period.replace(year=year, month=month, day=1, hour=0, minute=0, second=0, microsecond=0)
 
 
-PERIODS = [PeriodHour, PeriodDay, PeriodWeek, PeriodMonth]
-PERIOD_TAG_MAP = dict([(p.tag, p) for p in PERIODS])
-PERIOD_NAME_MAP = dict([(p.name, p) for p in PERIODS])
+class PeriodMinutes(Period):
+
+    # A period configured by the user, of a number of minutes that divides
+    # evenly into a day, so periods line up with midnight every day
+
+    def __init__(self, name, tag, minutes):
+        self.name = name
+        self.tag = tag
+        self.minutes = minutes
+        self.seconds = minutes * 60
+
+    def next_period(self, last_period):
+        midnight = last_period.replace(hour=0, minute=0, second=0, microsecond=0)
+        minutes = (last_period.hour * 60 + last_period.minute) // self.minutes * self.minutes
+        return midnight + timedelta(minutes=minutes + self.minutes)
+
+    # Periods are used as dict keys, so the same period loaded again from the
+    # config has to be interchangeable with the one it replaces
+
+    def __eq__(self, other):
+        return isinstance(other, PeriodMinutes) and (self.name, self.tag, self.minutes) == (other.name, other.tag, other.minutes)
+
+    def __hash__(self):
+        return hash((self.name, self.tag, self.minutes))
+
+    def __repr__(self):
+        return "PeriodMinutes({0}, {1}, {2})".format(self.name, self.tag, self.minutes)
+
+
+BUILTIN_PERIODS = [PeriodHour, PeriodDay, PeriodWeek, PeriodMonth]
+PERIODS = []
+PERIOD_TAG_MAP = {}
+PERIOD_NAME_MAP = {}
+
+def set_custom_periods(custom_periods):
+    # The period lists are changed in place, as they're imported everywhere
+    PERIODS[:] = sorted(BUILTIN_PERIODS + custom_periods, key=lambda p: p.seconds)
+    PERIOD_TAG_MAP.clear()
+    PERIOD_TAG_MAP.update([(p.tag, p) for p in PERIODS])
+    PERIOD_NAME_MAP.clear()
+    PERIOD_NAME_MAP.update([(p.name, p) for p in PERIODS])
+
+def get_custom_periods():
+    return [p for p in PERIODS if p not in BUILTIN_PERIODS]
+
+set_custom_periods([])
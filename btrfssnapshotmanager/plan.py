@@ -0,0 +1,197 @@
+#!/usr/bin/python3
+
+from btrfssnapshotmanager.config import *
+from btrfssnapshotmanager.metrics import *
+
+
+OPERATION_KINDS = (
+    'create',
+    'delete',
+    'boot-entry-remove',
+    'boot-entry-add',
+    'skip',
+    'delete-target',
+    'discard',
+    'transfer',
+    'error',
+)
+
+
+class Operation():
+
+    # A single change a run will make, for showing a plan
+
+    def __init__(self, kind, target, snapshot, detail=''):
+        if kind not in OPERATION_KINDS:
+            raise SnapshotException("Unknown operation {0}".format(kind))
+        self.kind = kind
+        self.target = target
+        self.snapshot = snapshot
+        self.detail = detail
+
+    def row(self):
+        return [self.kind, self.target, self.snapshot, self.detail]
+
+
+class SubvolumePlan():
+
+    # Everything a run will do to one subvolume, worked out before any of it
+    # is done. The snapshot to create, the snapshots to delete, and the
+    # systemd-boot entry and backup syncs are all worked out against the
+    # snapshots as they'll be once the ones before them have run. When the
+    # plan is going to be executed, backups are left to plan themselves when
+    # they run, alongside the other backups.
+
+    def __init__(self, manager):
+        self.manager = manager
+        self.snapshot = None
+        self.deletes = []
+        self.boot_syncs = []
+        self.backup_syncs = {}
+        self.backup_errors = {}
+
+    def operations(self):
+        operations = []
+        if self.snapshot is not None:
+            operations.append(Operation('create', '', self.snapshot.name, ', '.join([p.name for p in self.snapshot.get_periods()])))
+        for snapshot in self.deletes:
+            operations.append(Operation('delete', '', snapshot.name))
+
+        for sync in self.boot_syncs:
+            reference_entry = sync.entry_manager.reference_entry
+            for entry in sync.deletes:
+                snapshot_name = ''
+                if entry.snapshot is not None:
+                    snapshot_name = entry.snapshot.name
+                operations.append(Operation('boot-entry-remove', reference_entry, snapshot_name, entry.name))
+            for snapshot in sync.creates:
+                operations.append(Operation('boot-entry-add', reference_entry, snapshot.name, boot_entry_name_format(reference_entry, snapshot.name)))
+
+        for i, backup in enumerate(self.manager.backups):
+            location = backup.location()
+            if i in self.backup_errors:
+                operations.append(Operation('error', location, '', self.backup_errors[i]))
+                continue
+            if i not in self.backup_syncs:
+                continue
+            sync = self.backup_syncs[i]
+            if sync.in_sync:
+                operations.append(Operation('skip', location, '', 'already in sync'))
+                continue
+            for target_name in sync.incomplete:
+                operations.append(Operation('delete-target', location, target_name, 'incomplete transfer'))
+            for target_name in sorted(sync.discard.keys()):
+                operations.append(Operation('discard', location, target_name, 'interrupted transfer'))
+            if sync.catch_up is not None:
+                for source in sync.catch_up:
+                    operations.append(Operation('transfer', location, source.name, 'catch-up'))
+            for source, previous_source, clone_sources in sync.transfers:
+                detail = 'full'
+                if previous_source is not None:
+                    detail = "delta from {0}".format(previous_source.name)
+                    if len(clone_sources) > 0:
+                        detail += ", clone sources {0}".format(', '.join([c.name for c in clone_sources]))
+                operations.append(Operation('transfer', location, source.name, detail))
+            for target_name in sync.deletes:
+                operations.append(Operation('delete-target', location, target_name, 'not retained'))
+
+        return operations
+
+
+class RunPlanner():
+
+    def __init__(self, snapshot_manager, preview=False):
+        self.snapshot_manager = snapshot_manager
+        self.preview = preview
+
+    def plan(self, managers):
+        return [self.plan_subvol(manager) for manager in managers]
+
+    def plan_subvol(self, manager):
+        plan = SubvolumePlan(manager)
+        subvol = manager.subvol
+
+        # If required, a new snapshot
+        snapshots = subvol.snapshots.copy()
+        periods = manager.periods_due()
+        if len(periods) > 0:
+            plan.snapshot = subvol.new_snapshot(periods=periods)
+            snapshots.append(plan.snapshot)
+        else:
+            debug("No periods reached")
+        snapshots = SnapshotCollection(snapshots)
+
+        # Unwanted snapshots, including any the new snapshot makes unwanted
+        plan.deletes = manager.plan_cleanup(snapshots)
+        if len(plan.deletes) > 0:
+            deletes = set(plan.deletes)
+            snapshots = SnapshotCollection([s for s in snapshots if s not in deletes])
+
+        # Systemd-boot entries and backups
+        systemdboot_manager = self.snapshot_manager.systemdboot_manager
+        if systemdboot_manager is not None:
+            for entry_manager in systemdboot_manager.entry_managers:
+                if entry_manager.subvol is subvol:
+                    plan.boot_syncs.append(entry_manager.plan_sync(snapshots))
+        if self.preview:
+            self.plan_backups(plan, snapshots)
+
+        return plan
+
+    def plan_backups(self, plan, snapshots):
+        # Listing a target can be slow, so backups are planned at the same
+        # time, with as many at once as when they're run
+        backups = list(enumerate(plan.manager.backups))
+        plan.manager.subvol.retention.evaluate(snapshots)
+
+        def plan_backup(i, backup):
+            limit_key = backup.limit_key()
+            if backup.limiter is not None:
+                backup.limiter.acquire(limit_key)
+            try:
+                plan.backup_syncs[i] = backup.plan_sync(snapshots, preview=True)
+            except (SnapshotException, CommandException) as e:
+                plan.backup_errors[i] = e.error
+            finally:
+                if backup.limiter is not None:
+                    backup.limiter.release(limit_key)
+
+        workers = self.snapshot_manager.config.backup_workers
+        if workers > 1 and len(backups) > 1:
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                list(executor.map(lambda b: plan_backup(*b), backups))
+        else:
+            for i, backup in backups:
+                plan_backup(i, backup)
+
+
+class PlanExecutor():
+
+    def __init__(self, snapshot_manager):
+        self.snapshot_manager = snapshot_manager
+
+    def execute(self, plan):
+        manager = plan.manager
+        subvol = manager.subvol.name
+
+        if plan.snapshot is not None:
+            with run_metrics.timer('snapshot_create_duration_seconds', subvolume=subvol):
+                manager.subvol.create_snapshot(snapshot=plan.snapshot)
+
+        # All deletions go through one queue, so they're batched together
+        with run_metrics.timer('cleanup_duration_seconds', subvolume=subvol):
+            queue = SnapshotDeleteQueue(manager.subvol)
+            for snapshot in plan.deletes:
+                queue.add(snapshot)
+            deleted = queue.run()
+        run_metrics.set('cleanup_deleted_snapshots', deleted, subvolume=subvol)
+
+        # Systemd-boot entries only depend on local snapshots, so are synced
+        # before backups rather than waiting on them
+        if self.snapshot_manager.systemdboot_manager is not None:
+            with run_metrics.timer('systemdboot_sync_duration_seconds', subvolume=subvol):
+                for sync in plan.boot_syncs:
+                    sync.entry_manager.apply_sync(sync)
+
+        manager.backup(syncs=plan.backup_syncs)
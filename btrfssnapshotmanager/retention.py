@@ -0,0 +1,90 @@
+#!/usr/bin/python3
+
+from btrfssnapshotmanager.common import *
+from btrfssnapshotmanager.periods import *
+
+
+class RetentionEngine():
+
+    # Works out which snapshots each retention policy of a subvolume keeps -
+    # the subvolume's own, and those of its backups and systemd-boot entries -
+    # in a single pass over the snapshots, newest first. A policy's owner has
+    # a 'retention' dict of period to number of snapshots to keep. Results are
+    # remembered by the snapshot collection they were worked out for, until a
+    # snapshot is added to or removed from it.
+
+    def __init__(self):
+        self.policies = []
+        self.generation = 0
+
+    def add_policy(self, owner, name):
+        self.policies = [p for p in self.policies if p[0] is not owner] + [(owner, name)]
+        self.generation += 1
+
+    def remove_policy(self, owner):
+        self.policies = [p for p in self.policies if p[0] is not owner]
+        self.generation += 1
+
+    def keep(self, snapshots, owner):
+        if owner not in [p[0] for p in self.policies]:
+            raise SnapshotException("No retention policy registered for {0}".format(owner))
+        return self.evaluate(snapshots).keep(owner)
+
+    def evaluate(self, snapshots):
+        memo = snapshots.retention_memo.get(self)
+        if memo is not None and memo[0] == self.generation:
+            return memo[1]
+        result = self._evaluate(snapshots)
+        snapshots.retention_memo[self] = (self.generation, result)
+        return result
+
+    def _evaluate(self, snapshots):
+        # For each period, the policies still keeping snapshots of it, as
+        # [owner, name, number to keep, number kept so far]
+        counters = {}
+        remaining = 0
+        for owner, name in self.policies:
+            for period, count in owner.retention.items():
+                if period is None or count <= 0:
+                    continue
+                if period not in counters:
+                    counters[period] = []
+                counters[period].append([owner, name, count, 0])
+                remaining += count
+
+        result = RetentionResult([p[0] for p in self.policies])
+        for snapshot in reversed(snapshots):
+            if remaining == 0:
+                break
+            if snapshot.periods is None:
+                continue
+            for period in snapshot.periods:
+                for counter in counters.get(period, ()):
+                    if counter[3] < counter[2]:
+                        counter[3] += 1
+                        remaining -= 1
+                        result.add(counter[0], counter[1], snapshot, period, counter[3])
+        return result
+
+
+class RetentionResult():
+
+    # The snapshots each policy keeps, and why each snapshot is kept, as
+    # (policy name, period, position counting back from the newest snapshot
+    # of that period)
+
+    def __init__(self, owners):
+        self.kept = dict([(o, set()) for o in owners])
+        self.reasons = {}
+
+    def add(self, owner, name, snapshot, period, position):
+        self.kept[owner].add(snapshot)
+        if snapshot not in self.reasons:
+            self.reasons[snapshot] = []
+        self.reasons[snapshot].append((name, period, position))
+
+    def keep(self, owner):
+        return self.kept[owner]
+
+    def why(self, snapshot):
+        return self.reasons.get(snapshot, [])
@@ -0,0 +1,85 @@
+#!/usr/bin/python3
+
+from btrfssnapshotmanager.common import *
+
+import heapq
+import itertools
+import threading
+
+
+class Scheduler():
+
+    # A priority queue of when each subvolume is next due a run for each of
+    # its periods, so finding what's due only looks at the front of the queue.
+    # Rescheduling a subvolume leaves its old entries in the queue, and they're
+    # skipped when they reach the front, or dropped when there are too many.
+
+    def __init__(self):
+        self.queue = []
+        self.generations = {}
+        self.entry_counts = {}
+        self.stale_entries = 0
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+
+    def schedule(self, subvol, due_times):
+        # Replace when the subvolume is due, with a list of (date, period)
+        with self.lock:
+            self._unschedule(subvol)
+            generation = next(self.counter)
+            self.generations[subvol] = generation
+            self.entry_counts[subvol] = len(due_times)
+            for date, period in due_times:
+                heapq.heappush(self.queue, (date, next(self.counter), subvol, period, generation))
+            if self.stale_entries > len(self.queue) // 2:
+                self._compact()
+
+    def unschedule(self, subvol):
+        with self.lock:
+            self._unschedule(subvol)
+
+    def clear(self):
+        with self.lock:
+            self.queue = []
+            self.generations = {}
+            self.entry_counts = {}
+            self.stale_entries = 0
+
+    def next_due(self):
+        with self.lock:
+            self._discard_stale()
+            if len(self.queue) == 0:
+                return None
+            return self.queue[0][0]
+
+    def pop_due(self, now):
+        # Subvolumes due a run, with the periods each one is due for. Once
+        # popped, a subvolume isn't due again until it's rescheduled.
+        due = {}
+        with self.lock:
+            while True:
+                self._discard_stale()
+                if len(self.queue) == 0 or self.queue[0][0] > now:
+                    break
+                date, count, subvol, period, generation = heapq.heappop(self.queue)
+                self.entry_counts[subvol] -= 1
+                if subvol not in due:
+                    due[subvol] = []
+                if period is not None:
+                    due[subvol].append(period)
+        return due
+
+    def _unschedule(self, subvol):
+        if subvol in self.generations:
+            del self.generations[subvol]
+            self.stale_entries += self.entry_counts.pop(subvol)
+
+    def _discard_stale(self):
+        while len(self.queue) > 0 and self.generations.get(self.queue[0][2]) != self.queue[0][4]:
+            heapq.heappop(self.queue)
+            self.stale_entries -= 1
+
+    def _compact(self):
+        self.queue = [e for e in self.queue if self.generations.get(e[2]) == e[4]]
+        heapq.heapify(self.queue)
+        self.stale_entries = 0
@@ -1,15 +1,21 @@
 #!/usr/bin/python3
 
+from btrfssnapshotmanager.btrfs import *
 from btrfssnapshotmanager.common import *
 from btrfssnapshotmanager.periods import *
+from btrfssnapshotmanager.retention import *
 
 from datetime import *
 from pathlib import PosixPath
+import bisect
+import heapq
 import re
+import threading
+import time
 
 
 snapshots_dir_name = '.snapshots'
-snapshots_dir_regex = re.compile(r'(\d\d\d\d)-(\d\d)-(\d\d)_(\d\d)-(\d\d)-(\d\d)_?([HDWM]*)')
+snapshots_dir_regex = re.compile(r'(\d\d\d\d)-(\d\d)-(\d\d)_(\d\d)-(\d\d)-(\d\d)_?([A-Z]*)')
 snapshots_dir_date_format = '%Y-%m-%d_%H-%M-%S'
 
 def snapshot_name_parse(name):
@@ -23,11 +29,13 @@ def snapshot_name_parse(name):
             int(snapshots_dir_match.group(5)),
             int(snapshots_dir_match.group(6)))
 
-        tags = snapshots_dir_match.group(7)
+        # A tag that isn't a known period means it isn't a snapshot name
         periods = []
-        for t, p in PERIOD_TAG_MAP.items():
-            if t in tags:
-                periods.append(p)
+        for t in snapshots_dir_match.group(7):
+            if t not in PERIOD_TAG_MAP:
+                return None
+            if PERIOD_TAG_MAP[t] not in periods:
+                periods.append(PERIOD_TAG_MAP[t])
 
         return {'date': date, 'periods': periods}
     else:
@@ -45,92 +53,236 @@ class Subvolume():
     def __init__(self, path):
         self.name = path
         self.path = PosixPath(path)
-        if not self._check_path():
-            raise SnapshotException("Path {0} is not a valid btrfs subvolume".format(self.path))
+        self.valid = None
         self.snapshots_dir = PosixPath(path, snapshots_dir_name)
-        self.snapshots = None
-        if self.has_snapshots():
-            self.load_snapshots()
+        self.delete_batch_size = None
+        self.delete_interval = 0
+        self.retention = RetentionEngine()
+        self.lock = threading.Lock()
+        self._top_level_path = None
+        self._snapshots = None
 
         # systemd-boot
         self.systemdboot_manager = None
 
+    @property
+    def snapshots(self):
+        # Snapshots are only read from disk the first time they're needed
+        with self.lock:
+            if self._snapshots is None:
+                self.load_snapshots()
+            return self._snapshots
+
+    @property
+    def top_level_path(self):
+        self.validate()
+        if self._top_level_path is None:
+            self._top_level_path = get_btrfs_backend().subvolume_top_level_path(self.path)
+        return self._top_level_path
+
+    def validate(self):
+        if self.valid is None:
+            self.valid = self._check_path()
+        if not self.valid:
+            raise SnapshotException("Path {0} is not a valid btrfs subvolume".format(self.path))
+
+    def unload_snapshots(self):
+        # Snapshots are read from disk again the next time they're needed
+        with self.lock:
+            self._snapshots = None
+
     def set_snapshot_dir(self, path):
         self.snapshots_dir = PosixPath(self.path, path)
-        self.load_snapshots()
+        self._snapshots = None
 
     def has_snapshots(self):
-        return self.snapshots_dir.is_dir()
+        return get_btrfs_backend().directory_exists(self.snapshots_dir)
 
     def init_snapshots(self):
+        self.validate()
         if self.has_snapshots():
             raise SnapshotException("Subvolume {0} is already initialised for snapshots".format(self.path))
         info("Initialising subvolume", self.path, "for snapshots")
-        cmd("btrfs subvolume create {0}".format(self.snapshots_dir))
-        self.load_snapshots()
+        get_btrfs_backend().subvolume_create(self.snapshots_dir)
+        self._snapshots = None
 
     def load_snapshots(self):
         if not self.has_snapshots():
             raise SnapshotException("Subvolume {0} is not initialised for snapshots".format(self.path))
-        self.snapshots = []
-        for child in self.snapshots_dir.iterdir():
-            if child.is_dir():
-                snapshot_details = snapshot_name_parse(child.name)
-                if snapshot_details is not None:
-                    snapshot = Snapshot(self, child.name, snapshot_details['date'], snapshot_details['periods'])
-                    self.snapshots.append(snapshot)
-        self._sort_snapshots()
-
-    def create_snapshot(self, date=None, periods=None):
-        if not self.has_snapshots():
-            raise SnapshotException("Subvolume {0} is not initialised for snapshots".format(self.path))
+        snapshots = []
+        for name in get_btrfs_backend().subvolume_list(self.snapshots_dir):
+            snapshot_details = snapshot_name_parse(name)
+            if snapshot_details is not None:
+                snapshot = Snapshot(self, name, snapshot_details['date'], snapshot_details['periods'])
+                snapshots.append(snapshot)
+        self._snapshots = SnapshotCollection(snapshots)
+
+    def new_snapshot(self, date=None, periods=None):
+        # A snapshot that hasn't been created yet
         if date is None:
             date = datetime.now()
         if periods is None:
             periods = []
-        name = snapshot_name_format(date, periods)
-        snapshot = Snapshot(self, name, date, periods)
+        return Snapshot(self, snapshot_name_format(date, periods), date, periods)
+
+    def create_snapshot(self, date=None, periods=None, snapshot=None):
+        self.validate()
+        if not self.has_snapshots():
+            raise SnapshotException("Subvolume {0} is not initialised for snapshots".format(self.path))
+        if snapshot is None:
+            snapshot = self.new_snapshot(date, periods)
+
+        # Load existing snapshots first, so the new one isn't picked up twice
+        snapshots = self.snapshots
+
         info("Creating snapshot {0}".format(snapshot.path))
-        cmd("btrfs subvolume snapshot -r {0} {1}".format(self.path, snapshot.path))
-        self.snapshots.append(snapshot)
-        self._sort_snapshots()
+        get_btrfs_backend().subvolume_snapshot(self.path, snapshot.path)
+        snapshots.add(snapshot)
 
         # systemd-boot
         if self.systemdboot_manager is not None:
-            self.systemdboot_manager.create_boot_snapshot_if_needed(date=date)
+            self.systemdboot_manager.create_boot_snapshot_if_needed(date=snapshot.date)
 
         return snapshot
 
+    def delete_snapshots(self, snapshots):
+        queue = SnapshotDeleteQueue(self)
+        for snapshot in snapshots:
+            queue.add(snapshot)
+        queue.run()
+
     def find_snapshot(self, name):
         if not self.has_snapshots():
             raise SnapshotException("Subvolume {0} is not initialised for snapshots".format(self.path))
-        for s in self.snapshots:
-            if s.name == name:
-                return s
-        return None
+        return self.snapshots.find(name)
 
     def search_snapshots(self, periods=None):
+        return self.snapshots.search(periods)
+
+    def latest_snapshots(self, period, count):
+        return self.snapshots.latest(period, count)
+
+    def last_snapshot(self, period):
+        return self.snapshots.last(period)
+
+    def _check_path(self):
+        return get_btrfs_backend().subvolume_show(self.path) is not None
+
+
+class SnapshotCollection():
+
+    # Snapshots kept sorted by date, with an index per period and by name, so
+    # that lookups don't need to scan every snapshot. Retention worked out for
+    # the snapshots is remembered until they change.
+
+    def __init__(self, snapshots=None):
+        self.snapshots = []
+        self.keys = []
+        self.by_name = {}
+        self.by_period = {}
+        self.retention_memo = {}
+        if snapshots is not None:
+            for snapshot in sorted(snapshots, key=self._key):
+                key = self._key(snapshot)
+                self.snapshots.append(snapshot)
+                self.keys.append(key)
+                self.by_name[snapshot.name] = snapshot
+                for period in self._periods(snapshot):
+                    period_snapshots, period_keys = self._period_index(period)
+                    period_snapshots.append(snapshot)
+                    period_keys.append(key)
+
+    def __iter__(self):
+        return iter(self.snapshots)
+
+    def __reversed__(self):
+        return reversed(self.snapshots)
+
+    def __len__(self):
+        return len(self.snapshots)
+
+    def __getitem__(self, index):
+        return self.snapshots[index]
+
+    def __contains__(self, snapshot):
+        return self.by_name.get(snapshot.name) is snapshot
+
+    def copy(self):
+        return self.snapshots.copy()
+
+    def add(self, snapshot):
+        if snapshot.name in self.by_name:
+            raise SnapshotException("Snapshot {0} already exists".format(snapshot.name))
+        key = self._key(snapshot)
+        self._insert(self.snapshots, self.keys, snapshot, key)
+        self.by_name[snapshot.name] = snapshot
+        self.retention_memo = {}
+        for period in self._periods(snapshot):
+            snapshots, keys = self._period_index(period)
+            self._insert(snapshots, keys, snapshot, key)
+
+    def remove(self, snapshot):
+        if snapshot not in self:
+            raise ValueError("Snapshot {0} not in collection".format(snapshot.name))
+        key = self._key(snapshot)
+        self._delete(self.snapshots, self.keys, key)
+        del self.by_name[snapshot.name]
+        self.retention_memo = {}
+        for period in self._periods(snapshot):
+            snapshots, keys = self._period_index(period)
+            self._delete(snapshots, keys, key)
+
+    def find(self, name):
+        return self.by_name.get(name)
+
+    def search(self, periods=None):
+        if periods is None:
+            return self.snapshots.copy()
+        indexes = [self.by_period[p][0] for p in set(periods) if p in self.by_period]
+        if len(indexes) == 0:
+            return []
+        if len(indexes) == 1:
+            return indexes[0].copy()
+
+        # Merge the period indexes, dropping snapshots found under more than one period
         found_snapshots = []
-        for snapshot in self.snapshots:
-            if periods is not None:
-                if None in periods and (snapshot.periods is None or len(snapshot.periods) == 0):
-                    # This has no period, and we're allowing snapshots with no period
-                    pass
-                elif len([p for p in periods for t in snapshot.periods if p == t]) == 0:
-                    continue
-            found_snapshots.append(snapshot)
+        for snapshot in heapq.merge(*indexes, key=self._key):
+            if len(found_snapshots) == 0 or found_snapshots[-1] is not snapshot:
+                found_snapshots.append(snapshot)
         return found_snapshots
 
-    def _check_path(self):
-        try:
-            out = cmd("btrfs subvolume show {0}".format(self.path))
-            self.top_level_path = out.split("\n")[0].strip()
-        except CommandException:
-            return False
-        return True
+    def latest(self, period, count):
+        if count <= 0 or period not in self.by_period:
+            return []
+        return self.by_period[period][0][-count:]
 
-    def _sort_snapshots(self):
-        self.snapshots = sorted(self.snapshots, key=lambda s: s.date)
+    def last(self, period):
+        if period not in self.by_period or len(self.by_period[period][0]) == 0:
+            return None
+        return self.by_period[period][0][-1]
+
+    def _key(self, snapshot):
+        return (snapshot.date, snapshot.name)
+
+    def _periods(self, snapshot):
+        if snapshot.periods is None or len(snapshot.periods) == 0:
+            return [None]
+        return snapshot.periods
+
+    def _period_index(self, period):
+        if period not in self.by_period:
+            self.by_period[period] = ([], [])
+        return self.by_period[period]
+
+    def _insert(self, snapshots, keys, snapshot, key):
+        i = bisect.bisect_right(keys, key)
+        keys.insert(i, key)
+        snapshots.insert(i, snapshot)
+
+    def _delete(self, snapshots, keys, key):
+        i = bisect.bisect_left(keys, key)
+        del keys[i]
+        del snapshots[i]
 
 
 class Snapshot():
@@ -141,22 +293,92 @@ class Snapshot():
         self.path = PosixPath(subvol.snapshots_dir, name)
         self.date = date
         self.periods = periods
+        self._info = None
 
         # systemd-boot
         self.systemdboot = {}
 
+    @property
+    def info(self):
+        # Snapshots are readonly, so their btrfs details only need reading once
+        if self._info is None:
+            self._info = get_btrfs_backend().subvolume_show(self.path)
+        return self._info
+
     def delete(self):
-        info("Deleting snapshot {0}".format(self.path))
-        cmd("btrfs subvolume delete --commit-each {0}".format(self.path))
+        self.subvol.delete_snapshots([self])
+
+    def _deleted(self):
         self.subvol.snapshots.remove(self)
 
         # Delete systemd-boot entry
         for systemdboot, entry in self.systemdboot.copy().items():
             systemdboot.delete_entry(entry)
 
-        # Check if systemd-boot boot-snapshots can be deleted
-        if self.subvol.systemdboot_manager is not None:
-            self.subvol.systemdboot_manager.remove_unused_boot_snapshots()
-
     def get_periods(self):
         return [p for p in sorted(self.periods, key=lambda x: x.seconds)]
+
+
+class SnapshotDeleteQueue():
+
+    def __init__(self, subvol):
+        self.subvol = subvol
+        self.snapshots = []
+        self.names = set()
+
+    def add(self, snapshot):
+        if snapshot.subvol is not self.subvol:
+            raise SnapshotException("Snapshot {0} is not in subvolume {1}".format(snapshot.name, self.subvol.name))
+        if snapshot.name not in self.names:
+            self.names.add(snapshot.name)
+            self.snapshots.append(snapshot)
+
+    def run(self):
+        if len(self.snapshots) == 0:
+            return 0
+        remaining = sorted(self.snapshots, key=lambda s: s.date)
+        deleted = len(remaining)
+        self.snapshots = []
+        self.names = set()
+
+        # Make sure systemd-boot entries are linked to snapshots, so they're
+        # deleted along with them
+        if self.subvol.systemdboot_manager is not None:
+            self.subvol.systemdboot_manager.load_entries_for_subvol(self.subvol, remaining)
+
+        batch_size = self.subvol.delete_batch_size
+        if batch_size is None:
+            batch_size = len(remaining)
+        try:
+            while len(remaining) > 0:
+                batch = remaining[0:batch_size]
+                remaining = remaining[batch_size:]
+
+                for snapshot in batch:
+                    info("Deleting snapshot {0}".format(snapshot.path))
+                try:
+                    get_btrfs_backend().subvolume_delete([s.path for s in batch])
+                except (SnapshotException, CommandException):
+                    # Part of the batch may have gone before the failure, and
+                    # those snapshots mustn't be kept around in memory
+                    for snapshot in batch:
+                        if not get_btrfs_backend().directory_exists(snapshot.path):
+                            snapshot._deleted()
+                    raise
+                for snapshot in batch:
+                    snapshot._deleted()
+
+                # Let the btrfs cleaner catch up before deleting any more
+                if len(remaining) > 0:
+                    debug("Waiting for deleted snapshots to be cleaned up...")
+                    get_btrfs_backend().subvolume_sync(self.subvol.snapshots_dir)
+                    if self.subvol.delete_interval > 0:
+                        debug("Waiting {0} seconds before deleting next {1} snapshots".format(self.subvol.delete_interval, min(batch_size, len(remaining))))
+                        time.sleep(self.subvol.delete_interval)
+        finally:
+            # Check if systemd-boot boot-snapshots can be deleted, even if a
+            # batch failed, as earlier batches may have freed some
+            if self.subvol.systemdboot_manager is not None:
+                self.subvol.systemdboot_manager.remove_unused_boot_snapshots()
+
+        return deleted
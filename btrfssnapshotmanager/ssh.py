@@ -0,0 +1,128 @@
+#!/usr/bin/python3
+
+from btrfssnapshotmanager.common import *
+
+from pathlib import PosixPath
+import atexit
+import hashlib
+import shlex
+import threading
+
+
+ssh_control_persist = 300
+
+
+class SSHConnection():
+
+    def __init__(self, pool, host, user, options):
+        self.pool = pool
+        self.host = host
+        self.user = user
+        self.options = options
+        key = "{0}\0{1}\0{2}".format(host, user, options)
+        self.control_path = PosixPath(pool.control_dir(), hashlib.sha1(key.encode('utf-8')).hexdigest()[0:16])
+        self.master = False
+
+    def destination(self):
+        if self.user is not None:
+            return "{0}@{1}".format(self.user, self.host)
+        return self.host
+
+    def ssh_options(self):
+        return shlex.join(self.ssh_argv())
+
+    def ssh_argv(self):
+        ssh_argv = []
+        if self.master:
+            ssh_argv += ['-o', 'ControlMaster=no', '-o', "ControlPath={0}".format(self.control_path)]
+        if self.options is not None:
+            ssh_argv += shlex.split(self.options)
+        return ssh_argv
+
+    def start(self):
+        # Start a master connection in the background, which later ssh
+        # commands are multiplexed over. If it won't start, fall back to a new
+        # connection per command.
+        debug("Starting SSH master connection to {0}".format(self.destination()))
+        command = ['ssh', '-o', 'ControlMaster=yes', '-o', "ControlPersist={0}".format(ssh_control_persist), '-o', "ControlPath={0}".format(self.control_path)]
+        if self.options is not None:
+            command += shlex.split(self.options)
+        command += [self.destination(), 'true']
+        trace("CMD: {}".format(shlex.join(command)))
+
+        # The backgrounded master keeps its inherited output open, so it can't
+        # be captured through a pipe
+        import tempfile
+        with tempfile.TemporaryFile() as stderr:
+            start_time = time.monotonic()
+            process = subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=stderr)
+            # Wait for the process directly, to count it with the other commands
+            pid, status, rusage = os.wait4(process.pid, 0)
+            if os.WIFSIGNALED(status):
+                process.returncode = -os.WTERMSIG(status)
+            else:
+                process.returncode = os.WEXITSTATUS(status)
+            command_stats.add(time.monotonic() - start_time, rusage.ru_utime + rusage.ru_stime)
+            if process.returncode != 0:
+                stderr.seek(0)
+                warn("Could not start SSH master connection to {0}, not sharing connections: {1}".format(
+                    self.destination(), stderr.read().decode('utf-8').rstrip("\n")))
+                return
+        self.master = True
+
+    def stop(self):
+        if not self.master:
+            return
+        debug("Stopping SSH master connection to {0}".format(self.destination()))
+        run_command(['ssh', '-o', "ControlPath={0}".format(self.control_path), '-O', 'exit', self.destination()], return_code=True)
+        self.master = False
+
+
+class SSHConnectionPool():
+
+    def __init__(self):
+        self.connections = {}
+        self.start_locks = {}
+        self.lock = threading.Lock()
+        self._control_dir = None
+
+    def get(self, host, user, options):
+        # Starting a master connection can take as long as the host takes to
+        # answer, so only callers wanting the same connection wait for it
+        key = (host, user, options)
+        with self.lock:
+            if key in self.connections:
+                return self.connections[key]
+            if key not in self.start_locks:
+                self.start_locks[key] = threading.Lock()
+            start_lock = self.start_locks[key]
+            self.control_dir()
+        with start_lock:
+            with self.lock:
+                if key in self.connections:
+                    return self.connections[key]
+            connection = SSHConnection(self, host, user, options)
+            connection.start()
+            with self.lock:
+                self.connections[key] = connection
+            return connection
+
+    def control_dir(self):
+        if self._control_dir is None:
+            import tempfile
+            self._control_dir = tempfile.mkdtemp(prefix='btrfs-snapshot-manager-ssh-')
+            atexit.register(self.close)
+        return self._control_dir
+
+    def close(self):
+        with self.lock:
+            for connection in self.connections.values():
+                connection.stop()
+            self.connections = {}
+            if self._control_dir is not None:
+                import shutil
+                shutil.rmtree(self._control_dir, ignore_errors=True)
+                self._control_dir = None
+
+
+ssh_connection_pool = SSHConnectionPool()
@@ -1,23 +1,42 @@
 #!/usr/bin/python3
 
 from btrfssnapshotmanager.common import *
+from btrfssnapshotmanager.periods import *
 
 from datetime import *
 from pathlib import PosixPath, PurePosixPath
+import collections
+import errno
+import hashlib
+import os
 import re
+import threading
 
 
 systemdboot_default_boot_dir = '/boot'
 systemdboot_default_entries_dir = 'loader/entries'
 systemdboot_default_snapshots_dir = 'snapshots'
+systemdboot_objects_dir_name = 'objects'
 systemdboot_entry_line_regex = re.compile(r'(\S+)(\s*)(.*?)')
 systemdboot_snapshot_format = '%Y-%m-%d_%H-%M-%S'
+systemdboot_manifest_file_name = '.manifest.json'
+systemdboot_copy_chunk_size = 1024 * 1024 * 1024
+systemdboot_hash_chunk_size = 1024 * 1024
+
+systemdboot_object_name_regex = re.compile(r'[0-9a-f]{64}')
+systemdboot_entry_name_regex = re.compile(r'snapshot\-(\d\d\d\d-\d\d-\d\d_\d\d-\d\d-\d\d_?([A-Z]*))\-(.+)')
 
 def boot_entry_name_parse(entry, name):
-    file_regex = re.compile('snapshot\-(\d\d\d\d-\d\d-\d\d_\d\d-\d\d-\d\d_?[HDWM]*)\-' + entry)
-    file_match = file_regex.fullmatch(name)
-    if file_match:
-        return file_match.group(1)
+    parsed = boot_entry_name_split(name)
+    if parsed is not None and parsed[1] == entry:
+        return parsed[0]
+    return None
+
+def boot_entry_name_split(name):
+    # The snapshot name and reference entry of a snapshot's entry
+    file_match = systemdboot_entry_name_regex.fullmatch(name)
+    if file_match and all([t in PERIOD_TAG_MAP for t in file_match.group(2)]):
+        return (file_match.group(1), file_match.group(3))
     return None
 
 def boot_entry_name_format(entry, name):
@@ -29,6 +48,27 @@ def systemdboot_snapshot_name_parse(name):
 def systemdboot_snapshot_name_format(date):
     return date.strftime(systemdboot_snapshot_format)
 
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fh:
+        while chunk := fh.read(systemdboot_hash_chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def copy_file(source, dest):
+    # Copy within the kernel rather than through this process, using
+    # copy_file_range, or sendfile where that isn't supported
+    with open(source, 'rb') as fsrc, open(dest, 'wb') as fdst:
+        try:
+            while os.copy_file_range(fsrc.fileno(), fdst.fileno(), systemdboot_copy_chunk_size) > 0:
+                pass
+            return
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                raise
+    import shutil
+    shutil.copyfile(source, dest)
+
 
 class SystemdBootSnapshot():
 
@@ -36,6 +76,57 @@ class SystemdBootSnapshot():
         self.systemdboot_manager = systemdboot_manager
         self.name = name
         self.date = systemdboot_snapshot_name_parse(name)
+        self._manifest = None
+        self.manifest_readable = True
+
+    @property
+    def manifest(self):
+        # The size, modification time and hash of each init file copied into
+        # the boot snapshot, with the size and modification time being those
+        # of the original file when it was copied
+        if self._manifest is None:
+            self.load_manifest()
+        return self._manifest
+
+    def load_manifest(self):
+        # A boot snapshot whose init files are in the shared objects directory
+        # only has its manifest to say which ones it uses, so one that can't
+        # be read is never rebuilt, and is marked as unreadable instead
+        import json
+        manifest_path = PosixPath(self.path(), systemdboot_manifest_file_name)
+        init_files = [c for c in self.path().iterdir() if c.is_file() and c.name != systemdboot_manifest_file_name]
+        manifest = None
+        if manifest_path.is_file():
+            try:
+                with open(manifest_path, 'r') as fh:
+                    manifest = json.load(fh)
+            except (OSError, ValueError) as e:
+                warn("Boot snapshot manifest {0} can't be read: {1}".format(manifest_path, e))
+            if not isinstance(manifest, dict):
+                self.manifest_readable = False
+                manifest = {}
+        elif len(init_files) == 0:
+            warn("Boot snapshot {0} has no manifest or init files".format(self.path()))
+            self.manifest_readable = False
+            manifest = {}
+        else:
+            # Boot snapshots made before manifests existed are hashed once.
+            # Their original files' modification times aren't known, so those
+            # files are hashed again the next time they're compared.
+            debug("Creating manifest for systemd-boot boot snapshot {0}".format(self.name))
+            manifest = {}
+            for child in init_files:
+                manifest[child.name] = {'size': child.stat().st_size, 'mtime': None, 'hash': file_digest(child)}
+            self.save_manifest(manifest)
+        self._manifest = manifest
+
+    def save_manifest(self, manifest):
+        import json
+        self._manifest = manifest
+        try:
+            write_file_atomic(PosixPath(self.path(), systemdboot_manifest_file_name), json.dumps(manifest, indent=2, sort_keys=True), mode=0o644)
+        except OSError as e:
+            warn("Failed to write manifest for systemd-boot boot snapshot {0}: {1}".format(self.name, e))
 
     def path(self):
         return PosixPath(self.systemdboot_manager.snapshots_dir, self.name)
@@ -49,9 +140,21 @@ class SystemdBootSnapshot():
             ).relative_to(self.systemdboot_manager.boot_path)
         )
 
+    def file_path_for_bootloader(self, init_file):
+        # Init files not copied into the boot snapshot are in the shared
+        # objects directory
+        if not PosixPath(self.path(), init_file).is_file() and str(init_file) in self.manifest:
+            return PurePosixPath(self.systemdboot_manager.objects_path_for_bootloader(), self.manifest[str(init_file)]['hash'])
+        return PurePosixPath(self.path_for_bootloader(), init_file)
+
+    def object_hashes(self):
+        # Hashes of the init files this boot snapshot uses from the shared
+        # objects directory
+        return [d['hash'] for f, d in self.manifest.items() if not PosixPath(self.path(), f).is_file()]
+
     def delete(self):
         info("Deleting systemd-boot boot snapshot {0}".format(self.name))
-        cmd("rm -rf {0}".format(self.path()))
+        run_command(['rm', '-rf', self.path()])
         self.systemdboot_manager.boot_snapshots.remove(self)
         for entry_manager in self.systemdboot_manager.entry_managers:
             entry_manager.delete_using_nonexistent_boot_snapshot()
@@ -65,75 +168,219 @@ class SystemdBootManager():
     def __init__(self):
         self.entry_managers = []
         self.init_file_list = None
+        self.deduplicate = False
+        self.lock = threading.RLock()
+        self.started = datetime.now().timestamp()
         self.set_boot_path(systemdboot_default_boot_dir)
 
+    @property
+    def boot_snapshots(self):
+        # Boot snapshots and init files are only read from disk the first
+        # time they're needed
+        with self.lock:
+            if self._boot_snapshots is None:
+                self.load_boot_snapshots()
+            return self._boot_snapshots
+
+    @property
+    def entry_scan(self):
+        # All entry managers share one read of the entries directory, which
+        # is only read again if something else changes the directory
+        with self.lock:
+            if self._entry_scan is None or not self._entry_scan.is_current():
+                if not self.entries_dir.is_dir():
+                    raise SnapshotException("Systemd-boot entries path {0} does not exist".format(self.entries_dir))
+                self._entry_scan = SystemdBootEntryScan(self.entries_dir)
+                self._entry_scan.load()
+            return self._entry_scan
+
+    @property
+    def init_files(self):
+        with self.lock:
+            if self._init_files is None:
+                self.load_init_files()
+            return self._init_files
+
     def set_boot_path(self, boot_path):
         self.boot_path = boot_path
         self.snapshots_dir = PosixPath(boot_path, systemdboot_default_snapshots_dir)
-        self.load_boot_snapshots()
-        self.load_init_files()
+        self.objects_dir = PosixPath(self.snapshots_dir, systemdboot_objects_dir_name)
         self.entries_dir = PosixPath(self.boot_path, systemdboot_default_entries_dir)
+        self._boot_snapshots = None
+        self._init_files = None
+        self._entry_scan = None
+        self._entry_headers = {}
         for entry_manager in self.entry_managers:
-            entry_manager.load_entries()
+            entry_manager.unload_entries()
 
     def set_init_file_list(self, init_file_list):
         self.init_file_list = init_file_list
-        self.load_init_files()
+        self._init_files = None
 
     def load_boot_snapshots(self):
-        self.boot_snapshots = []
+        boot_snapshots = []
         if not self.snapshots_dir.is_dir():
             info("Creating boot snapshots directory: {0}".format(self.snapshots_dir))
             self.snapshots_dir.mkdir()
         for child in self.snapshots_dir.iterdir():
             if child.is_dir():
                 try:
-                    self.boot_snapshots.append(SystemdBootSnapshot(self, child.name))
+                    boot_snapshots.append(SystemdBootSnapshot(self, child.name))
                 except ValueError:
                     pass
-        self.boot_snapshots = sorted(self.boot_snapshots, key=lambda s: s.date)
+        self._boot_snapshots = sorted(boot_snapshots, key=lambda s: s.date)
 
     def load_init_files(self):
-        self.init_files = []
+        init_files = []
         for child in PosixPath(self.boot_path).iterdir():
             if child.is_file() and (self.init_file_list is None or child.name in self.init_file_list):
-                self.init_files.append(child.name)
-        self.init_files = sorted(self.init_files)
+                init_files.append(child.name)
+        self._init_files = sorted(init_files)
+
+    def load_entries_for_subvol(self, subvol, snapshots=None):
+        # If snapshots are given, only entry managers with entries for them
+        # need to load their entries
+        with self.lock:
+            if snapshots is not None:
+                references = set()
+                for snapshot in snapshots:
+                    references.update(self.entry_scan.by_snapshot.get(snapshot.name, {}).values())
+            for entry_manager in self.entry_managers:
+                if entry_manager.subvol is subvol and (snapshots is None or entry_manager.reference_entry in references):
+                    entry_manager.ensure_entries_loaded()
+
+    def entry_created(self, entry_name):
+        with self.lock:
+            if self._entry_scan is not None:
+                self._entry_scan.add(entry_name)
+                self._entry_scan.update_mtime()
+
+    def entry_deleted(self, entry_name):
+        with self.lock:
+            self._entry_headers.pop(entry_name, None)
+            if self._entry_scan is not None:
+                self._entry_scan.remove(entry_name)
+                self._entry_scan.update_mtime()
+
+    def entry_header(self, entry_name):
+        # The (key, space, value) lines of an entry up to the first blank
+        # line, which are only read again if the entry file changes
+        entry_file = PosixPath(self.entries_dir, entry_name)
+        stat = entry_file.stat()
+        file_key = (stat.st_mtime_ns, stat.st_size)
+        with self.lock:
+            cached = self._entry_headers.get(entry_name)
+            if cached is not None and cached[0] == file_key:
+                return cached[1]
+            lines = []
+            with open(entry_file, 'r') as fhin:
+                while line := fhin.readline().strip():
+                    entry_line_match = systemdboot_entry_line_regex.fullmatch(line)
+                    if entry_line_match:
+                        lines.append(entry_line_match.groups())
+            self._entry_headers[entry_name] = (file_key, lines)
+            return lines
 
-    def create_boot_snapshot(self, date=None):
+    def create_boot_snapshot(self, date=None, manifest=None):
         if date is None:
             date = datetime.now()
+        if manifest is None:
+            manifest = self.init_files_manifest()
+        # Loaded before the new boot snapshot exists, so it isn't loaded twice
+        boot_snapshots = self.boot_snapshots
         boot_snapshot_name = systemdboot_snapshot_name_format(date)
         info("Creating systemd-boot boot snapshot: {0}/{1}".format(self.snapshots_dir, boot_snapshot_name))
 
-        cmd("mkdir {0}/{1}".format(self.snapshots_dir, boot_snapshot_name))
-        for init_file in self.init_files:
-            cmd("cp {1}/{0} {2}/{3}/{0}".format(init_file, self.boot_path, self.snapshots_dir, boot_snapshot_name))
+        # Copied under a name that isn't a boot snapshot's, and renamed once
+        # complete, so an interrupted copy is never used
+        import json
+        temp_path = PosixPath(self.snapshots_dir, boot_snapshot_name + '.tmp')
+        try:
+            if temp_path.exists():
+                import shutil
+                shutil.rmtree(temp_path)
+            temp_path.mkdir()
+            for init_file in self.init_files:
+                if self.deduplicate:
+                    self.store_object(init_file, manifest[init_file]['hash'])
+                else:
+                    copy_file(PosixPath(self.boot_path, init_file), PosixPath(temp_path, init_file))
+            write_file_atomic(PosixPath(temp_path, systemdboot_manifest_file_name), json.dumps(manifest, indent=2, sort_keys=True), mode=0o644)
+            temp_path.rename(PosixPath(self.snapshots_dir, boot_snapshot_name))
+        except OSError as e:
+            raise SnapshotException("Failed to create systemd-boot boot snapshot {0}: {1}".format(boot_snapshot_name, e))
 
         boot_snapshot = SystemdBootSnapshot(self, boot_snapshot_name)
-        self.boot_snapshots.append(boot_snapshot)
+        boot_snapshot._manifest = manifest
+        boot_snapshots.append(boot_snapshot)
         return boot_snapshot
 
     def create_boot_snapshot_if_needed(self, date=None):
-        debug("Determining if new systemd-boot boot snapshot required...")
-        needed = False
-        if len(self.boot_snapshots) == 0:
-            needed = True
-            debug("- No systemd-boot boot snapshots found, new boot snapshot required")
-        else:
-            last_boot_snapshot = self.boot_snapshots[-1]
-            for init_file in self.init_files:
-                command = "diff {1}/{0} {2}/{3}/{0}".format(init_file, self.boot_path, self.snapshots_dir, last_boot_snapshot.name)
-                code = cmd(command, return_code=True)[2]
-                if code != 0:
-                    needed = True
-                    debug("- Init file {0} has changed, new systemd-boot boot snapshot required".format(init_file))
-                    break
-
-        if needed:
-            self.create_boot_snapshot(date=date)
-        else:
-            debug("New systemd-boot boot snapshot is not required")
+        with self.lock:
+            debug("Determining if new systemd-boot boot snapshot required...")
+            needed = False
+            manifest = None
+            if len(self.boot_snapshots) == 0:
+                needed = True
+                debug("- No systemd-boot boot snapshots found, new boot snapshot required")
+            else:
+                # Init files are only hashed if their size or modification
+                # time differs from when they were last compared
+                last_boot_snapshot = self.boot_snapshots[-1]
+                last_manifest = last_boot_snapshot.manifest
+                manifest = self.init_files_manifest(last_manifest)
+                for init_file, details in manifest.items():
+                    if init_file not in last_manifest or last_manifest[init_file]['hash'] != details['hash']:
+                        needed = True
+                        debug("- Init file {0} has changed, new systemd-boot boot snapshot required".format(init_file))
+                        break
+                else:
+                    # Files that were rehashed but haven't changed don't need
+                    # hashing next time
+                    if any([last_manifest[f] != d for f, d in manifest.items()]):
+                        updated_manifest = dict(last_manifest)
+                        updated_manifest.update(manifest)
+                        last_boot_snapshot.save_manifest(updated_manifest)
+
+            if needed:
+                self.create_boot_snapshot(date=date, manifest=manifest)
+            else:
+                debug("New systemd-boot boot snapshot is not required")
+
+    def store_object(self, init_file, digest):
+        # Each distinct init file is only stored once
+        object_path = PosixPath(self.objects_dir, digest)
+        if object_path.is_file():
+            debug("- Init file {0} is already stored as {1}".format(init_file, digest))
+            return
+        self.objects_dir.mkdir(exist_ok=True)
+        temp_path = PosixPath(self.objects_dir, digest + '.tmp')
+        copy_file(PosixPath(self.boot_path, init_file), temp_path)
+        temp_path.rename(object_path)
+
+    def objects_path_for_bootloader(self):
+        return PurePosixPath('/', self.objects_dir.relative_to(self.boot_path))
+
+    def init_files_manifest(self, previous_manifest=None):
+        # The size, modification time and hash of each init file, taking the
+        # hash from the previous manifest for files that haven't changed size
+        # or modification time since
+        if previous_manifest is None:
+            previous_manifest = {}
+        manifest = {}
+        for init_file in self.init_files:
+            path = PosixPath(self.boot_path, init_file)
+            try:
+                stat = path.stat()
+            except OSError as e:
+                raise SnapshotException("Failed to read init file {0}: {1}".format(path, e))
+            previous = previous_manifest.get(init_file)
+            if previous is not None and previous['size'] == stat.st_size and previous['mtime'] == stat.st_mtime_ns:
+                manifest[init_file] = previous
+            else:
+                debug("- Hashing init file {0}".format(init_file))
+                manifest[init_file] = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'hash': file_digest(path)}
+        return manifest
 
     def delete_boot_snapshot(self, boot_snapshot_name):
         boot_snapshot = [b for b in self.boot_snapshots if b.name == boot_snapshot_name]
@@ -149,17 +396,40 @@ class SystemdBootManager():
         return None
 
     def remove_unused_boot_snapshots(self):
-        debug("Checking if any systemd-boot boot snapshots can be deleted...")
-        boot_snapshots_to_delete = set(self.boot_snapshots)
-        for subvol in self._subvols():
-            debug("- Checking subvolume {0}".format(subvol.name))
-            for snapshot in subvol.snapshots:
-                boot_snapshot = self.get_boot_snapshot_for_snapshot(snapshot)
-                if boot_snapshot is not None and boot_snapshot in boot_snapshots_to_delete:
-                    boot_snapshots_to_delete.remove(boot_snapshot)
-        for boot_snapshot in boot_snapshots_to_delete:
-            debug("No longer need systemd-boot boot snapshot {0}".format(boot_snapshot.name))
-            boot_snapshot.delete()
+        with self.lock:
+            debug("Checking if any systemd-boot boot snapshots can be deleted...")
+            boot_snapshots_to_delete = set(self.boot_snapshots)
+            for subvol in self._subvols():
+                debug("- Checking subvolume {0}".format(subvol.name))
+                for snapshot in subvol.snapshots.copy():
+                    boot_snapshot = self.get_boot_snapshot_for_snapshot(snapshot)
+                    if boot_snapshot is not None and boot_snapshot in boot_snapshots_to_delete:
+                        boot_snapshots_to_delete.remove(boot_snapshot)
+            for boot_snapshot in boot_snapshots_to_delete:
+                debug("No longer need systemd-boot boot snapshot {0}".format(boot_snapshot.name))
+                boot_snapshot.delete()
+            self.remove_unused_objects()
+
+    def remove_unused_objects(self):
+        # Stored init files are deleted once no boot snapshot uses them. Files
+        # still being copied, and any stored since this manager started, may
+        # belong to a boot snapshot another run hasn't finished creating, so
+        # are left alone.
+        with self.lock:
+            if not self.objects_dir.is_dir():
+                return
+            references = collections.Counter()
+            for boot_snapshot in self.boot_snapshots:
+                references.update(boot_snapshot.object_hashes())
+                if not boot_snapshot.manifest_readable:
+                    warn("Not deleting unused systemd-boot init files, as it's not known which boot snapshot {0} uses".format(boot_snapshot.name))
+                    return
+            for child in self.objects_dir.iterdir():
+                if systemdboot_object_name_regex.fullmatch(child.name) is None:
+                    continue
+                if references[child.name] == 0 and child.stat().st_mtime < self.started:
+                    info("Deleting unused systemd-boot init file {0}".format(child.name))
+                    child.unlink()
 
     def _subvols(self):
         subvols = []
@@ -187,28 +457,79 @@ class SystemdBootEntry():
         info("Deleting systemd-boot entry {0}".format(self.name))
         entry_file = self.path()
         entry_file.unlink()
+        self.entry_manager.manager.entry_deleted(self.name)
         if self.snapshot is not None:
             del self.snapshot.systemdboot[self.entry_manager]
         self.entry_manager.entries.remove(self)
 
     def find_boot_snapshot(self):
-        entry_file = self.path()
-        with open(entry_file, 'r') as fhin:
-            while line := fhin.readline().strip():
-
-                entry_line_match = systemdboot_entry_line_regex.fullmatch(line)
-                if entry_line_match:
-                    key = entry_line_match.group(1)
-                    space = entry_line_match.group(2)
-                    value = entry_line_match.group(3)
-
-                if key in ('linux', 'initrd'):
-                    init_file_path = PurePosixPath(value)
-                    parent_dir = init_file_path.parts[-2]
-                    try:
-                        return SystemdBootSnapshot(self.entry_manager.manager, str(parent_dir))
-                    except ValueError:
+        for key, space, value in self.entry_manager.manager.entry_header(self.name):
+            if key in ('linux', 'initrd'):
+                init_file_path = PurePosixPath(value)
+                parent_dir = init_file_path.parts[-2]
+                if parent_dir == systemdboot_objects_dir_name:
+                    # Stored init files don't say which boot snapshot
+                    # they're from, but it's the one the snapshot uses
+                    if self.snapshot is None:
                         return None
+                    return self.entry_manager.manager.get_boot_snapshot_for_snapshot(self.snapshot)
+                try:
+                    return SystemdBootSnapshot(self.entry_manager.manager, str(parent_dir))
+                except ValueError:
+                    return None
+
+
+class SystemdBootEntryScan():
+
+    # The snapshot entries in the entries directory, by reference entry and
+    # by snapshot name, along with the directory's mtime when it was read
+
+    def __init__(self, entries_dir):
+        self.entries_dir = entries_dir
+        self.mtime = None
+        self.by_reference = {}
+        self.by_snapshot = {}
+
+    def load(self):
+        self.by_reference = {}
+        self.by_snapshot = {}
+        self.update_mtime()
+        with os.scandir(self.entries_dir) as it:
+            for child in it:
+                if child.is_file():
+                    self.add(child.name)
+
+    def is_current(self):
+        return self.mtime is not None and self.mtime == self._mtime()
+
+    def update_mtime(self):
+        self.mtime = self._mtime()
+
+    def add(self, entry_name):
+        parsed = boot_entry_name_split(entry_name)
+        if parsed is None:
+            return
+        snapshot_name, reference_entry = parsed
+        if reference_entry not in self.by_reference:
+            self.by_reference[reference_entry] = {}
+        self.by_reference[reference_entry][entry_name] = snapshot_name
+        if snapshot_name not in self.by_snapshot:
+            self.by_snapshot[snapshot_name] = {}
+        self.by_snapshot[snapshot_name][entry_name] = reference_entry
+
+    def remove(self, entry_name):
+        parsed = boot_entry_name_split(entry_name)
+        if parsed is None:
+            return
+        snapshot_name, reference_entry = parsed
+        self.by_reference.get(reference_entry, {}).pop(entry_name, None)
+        self.by_snapshot.get(snapshot_name, {}).pop(entry_name, None)
+
+    def _mtime(self):
+        try:
+            return os.stat(self.entries_dir).st_mtime_ns
+        except OSError:
+            return None
 
 
 class SystemdBootEntryManager():
@@ -218,24 +539,36 @@ class SystemdBootEntryManager():
         self.subvol = subvol
         self.reference_entry = entry
         self.retention = retention
-        self.load_entries()
+        self._entries = None
+
+    @property
+    def entries(self):
+        # Entries are only read from disk the first time they're needed
+        self.ensure_entries_loaded()
+        return self._entries
+
+    def ensure_entries_loaded(self):
+        with self.manager.lock:
+            if self._entries is None:
+                self.load_entries()
+
+    def unload_entries(self):
+        self._entries = None
 
     def load_entries(self):
-        self.entries = []
-        if not self.manager.entries_dir.is_dir():
-            raise SnapshotException("Systemd-boot entries path {0} does not exist".format(self.manager.entries_dir))
-        for child in self.manager.entries_dir.iterdir():
-            if child.is_file():
-                snapshot_name = boot_entry_name_parse(self.reference_entry, child.name)
-                if snapshot_name is not None:
-                    snapshot = self.subvol.find_snapshot(snapshot_name)
-                    boot_entry = SystemdBootEntry(self, child.name, snapshot)
-                    self.entries.append(boot_entry)
-                    if snapshot is not None:
-                        snapshot.systemdboot[self] = child.name
-        self.entries = sorted(self.entries, key=lambda e: e.name)
+        entries = []
+        scanned = self.manager.entry_scan.by_reference.get(self.reference_entry, {})
+        for entry_name, snapshot_name in scanned.items():
+            snapshot = self.subvol.find_snapshot(snapshot_name)
+            boot_entry = SystemdBootEntry(self, entry_name, snapshot)
+            entries.append(boot_entry)
+            if snapshot is not None:
+                snapshot.systemdboot[self] = entry_name
+        self._entries = sorted(entries, key=lambda e: e.name)
 
     def create_entry(self, snapshot):
+        # Load existing entries first, so the new one isn't read in with them
+        self.ensure_entries_loaded()
         entry_name = boot_entry_name_format(self.reference_entry, snapshot.name)
         ref_entry_path = PosixPath(self.manager.entries_dir, self.reference_entry)
         new_entry_filename = PosixPath(self.manager.entries_dir, entry_name)
@@ -271,7 +604,7 @@ class SystemdBootEntryManager():
 
                         elif key in ('linux', 'initrd') and boot_snapshot is not None:
                             # If there is a boot snapshot, use the linux / initrds in that
-                            value = str(PosixPath(boot_snapshot.path_for_bootloader(), PosixPath(value).relative_to('/')))
+                            value = str(boot_snapshot.file_path_for_bootloader(PosixPath(value).relative_to('/')))
 
                         elif key == 'options':
                             options = value.split()
@@ -292,17 +625,19 @@ class SystemdBootEntryManager():
                     debug(line)
                     print(line, file=fhout)
         debug("---")
+        self.manager.entry_created(entry_name)
 
         boot_entry = SystemdBootEntry(self, entry_name, snapshot, boot_snapshot)
         self.entries.append(boot_entry)
 
     def delete_entry(self, entry_name):
-        for entry in self.entries:
-            if entry.name == entry_name:
-                entry.delete()
-                break
-        else:
-            raise SnapshotException("No such systemd-boot entry: {}".format(entry_name))
+        with self.manager.lock:
+            for entry in self.entries:
+                if entry.name == entry_name:
+                    entry.delete()
+                    break
+            else:
+                raise SnapshotException("No such systemd-boot entry: {}".format(entry_name))
 
     def delete_using_nonexistent_snapshot(self):
         for entry in self.entries.copy():
@@ -317,32 +652,60 @@ class SystemdBootEntryManager():
                  entry.delete()
 
     def run(self):
-        snapshots_needed = set()
-        for period, count in self.retention.items():
-            snapshots = self.subvol.search_snapshots(periods=[period])
-            debug("systemdboot - searched for snapshots with period {}".format(period))
-            if len(snapshots) > count:
-                snapshots = snapshots[len(snapshots) - count :]
-            for s in snapshots:
-                snapshots_needed.add(s)
-                debug("- Snapshot: {}".format(s.name))
-        snapshots_needed = sorted(list(snapshots_needed), key=lambda s: s.name)
-        debug("Snapshots found that should have systemd-boot {0} entries:".format(self.reference_entry))
-        for s in snapshots_needed:
-            debug("-", s.name)
-
-        # Delete entries not required or broken
-        self.delete_using_nonexistent_snapshot()
-        self.delete_using_nonexistent_boot_snapshot()
-        for entry in self.entries.copy():
-            snapshot = entry.snapshot
-            if snapshot not in snapshots_needed:
-                debug("A systemd-boot {0} entry is not longer required for snapshot {1}".format(self.reference_entry, snapshot.name))
-                entry.delete()
-
-        # Create missing entries
-        entry_snapshots = [e.snapshot for e in self.entries]
-        for snapshot in snapshots_needed:
-            if snapshot not in entry_snapshots:
-                debug("A systemd-boot {0} entry is required for snapshot {1}".format(self.reference_entry, snapshot.name))
+        with self.manager.lock:
+            self.apply_sync(self.plan_sync())
+
+    def plan_sync(self, snapshots=None):
+        # Work out which entries to delete and which snapshots need entries,
+        # for the given snapshots, which default to the subvolume's current ones
+        if snapshots is None:
+            snapshots = self.subvol.snapshots
+        with self.manager.lock:
+            snapshots_needed = self.subvol.retention.keep(snapshots, self)
+            debug("Snapshots found that should have systemd-boot {0} entries:".format(self.reference_entry))
+            for s in sorted(snapshots_needed, key=lambda s: s.name):
+                debug("-", s.name)
+
+            # Delete entries not required or broken
+            sync = SystemdBootEntrySync(self)
+            entry_snapshots = set()
+            for entry in self.entries:
+                snapshot = entry.snapshot
+                if snapshot is None:
+                    debug("Systemd-boot entry {0} not associated with an existing snapshot".format(entry.name))
+                    sync.deletes.append(entry)
+                elif entry.boot_snapshot is not None and not entry.boot_snapshot.exists():
+                    debug("Systemd-boot entry {0} is using non-existent boot snapshot {1}".format(entry.name, entry.boot_snapshot.name))
+                    sync.deletes.append(entry)
+                elif snapshot not in snapshots_needed:
+                    debug("A systemd-boot {0} entry is not longer required for snapshot {1}".format(self.reference_entry, snapshot.name))
+                    sync.deletes.append(entry)
+                else:
+                    entry_snapshots.add(snapshot)
+
+            # Create missing entries
+            for snapshot in sorted(snapshots_needed, key=lambda s: s.name):
+                if snapshot not in entry_snapshots:
+                    debug("A systemd-boot {0} entry is required for snapshot {1}".format(self.reference_entry, snapshot.name))
+                    sync.creates.append(snapshot)
+            return sync
+
+    def apply_sync(self, sync):
+        with self.manager.lock:
+            # Entries of deleted snapshots may already have gone with them
+            entries = set(self.entries)
+            for entry in sync.deletes:
+                if entry in entries:
+                    entry.delete()
+            for snapshot in sync.creates:
                 self.create_entry(snapshot)
+
+
+class SystemdBootEntrySync():
+
+    # Entries to delete and snapshots to create entries for
+
+    def __init__(self, entry_manager):
+        self.entry_manager = entry_manager
+        self.deletes = []
+        self.creates = []
@@ -0,0 +1,180 @@
+#!/usr/bin/python3
+
+from btrfssnapshotmanager.common import *
+
+import contextlib
+import queue
+import shlex
+import threading
+
+
+transfer_chunk_size = 1024 * 1024
+
+TRANSFER_COMPRESSION = {
+    'zstd': {
+        'compress': ['zstd', '-c', '-q', '-T0', '-{0}'],
+        'decompress': ['zstd', '-d', '-c', '-q'],
+        'default-level': 3,
+    },
+    'lz4': {
+        'compress': ['lz4', '-c', '-q', '-{0}'],
+        'decompress': ['lz4', '-d', '-c', '-q'],
+        'default-level': 1,
+    },
+}
+
+
+class TransferPipeline():
+
+    # Streams data from a sending command to receiving commands, through an
+    # optional compression stage and an in-memory buffer, so a stall on one
+    # side doesn't immediately stop the other. Each command is an argv list,
+    # run without a shell.
+
+    def __init__(self, compression=None, compression_level=None, buffer_size=None):
+        if compression is not None and compression not in TRANSFER_COMPRESSION:
+            raise SnapshotException("Unknown transfer compression {0}".format(compression))
+        self.compression = compression
+        self.compression_level = compression_level
+        if self.compression is not None and self.compression_level is None:
+            self.compression_level = TRANSFER_COMPRESSION[self.compression]['default-level']
+        self.buffer_size = buffer_size
+        if self.buffer_size is None:
+            self.buffer_size = transfer_chunk_size * 16
+
+    def compress_argv(self):
+        if self.compression is None:
+            return None
+        return [a.format(self.compression_level) for a in TRANSFER_COMPRESSION[self.compression]['compress']]
+
+    def receive_argvs(self, receive_argv):
+        # The commands the stream is piped through to be received
+        if self.compression is None:
+            return [receive_argv]
+        return [TRANSFER_COMPRESSION[self.compression]['decompress'], receive_argv]
+
+    def receive_command_line(self, receive_argv):
+        # The same, as a command line for a remote shell
+        return ' | '.join([shlex.join([str(a) for a in argv]) for argv in self.receive_argvs(receive_argv)])
+
+    def run(self, send_argv, receive_argvs, attempts=None, fail_delay=None):
+        attempt = 1
+        while True:
+            try:
+                return self._run(send_argv, receive_argvs)
+            except CommandException:
+                if attempts is not None and attempt < attempts:
+                    attempt += 1
+                    warn("Transfer failed, waiting before retrying...")
+                    time.sleep(fail_delay)
+                    warn("Retrying...")
+                else:
+                    raise
+
+    def _run(self, send_argv, receive_argvs):
+        send_argvs = [send_argv]
+        compress_argv = self.compress_argv()
+        if compress_argv is not None:
+            send_argvs.append(compress_argv)
+        send_argvs = [[str(a) for a in argv] for argv in send_argvs]
+        receive_argvs = [[str(a) for a in argv] for argv in receive_argvs]
+        trace("CMD: {} | {}".format(' | '.join([shlex.join(a) for a in send_argvs]), ' | '.join([shlex.join(a) for a in receive_argvs])))
+        buffer = queue.Queue(maxsize=max(1, self.buffer_size // transfer_chunk_size))
+        stats = {'bytes': 0}
+        start = time.monotonic()
+
+        with contextlib.ExitStack() as stack:
+            # Each command runs as its own process rather than in a shell
+            # pipeline, so a failing send isn't hidden by another's exit code
+            senders = self._start(send_argvs, stack, None, subprocess.PIPE)
+            output = senders[-1][1].stdout
+            receivers = self._start(receive_argvs, stack, subprocess.PIPE, subprocess.DEVNULL)
+            receiver = receivers[0][1]
+
+            # Read from the sender into the buffer on a separate thread, so
+            # the sender keeps going while the receiver is busy
+            def read():
+                try:
+                    while chunk := output.read(transfer_chunk_size):
+                        buffer.put(chunk)
+                finally:
+                    buffer.put(None)
+
+            reader = threading.Thread(target=read, daemon=True)
+            reader.start()
+
+            receiver_failed = False
+            while (chunk := buffer.get()) is not None:
+                if receiver_failed:
+                    continue
+                try:
+                    receiver.stdin.write(chunk)
+                    stats['bytes'] += len(chunk)
+                except BrokenPipeError:
+                    # The receiver has gone, so stop the sender and compressor
+                    # rather than let them finish a stream nobody will read,
+                    # and drain what's left so the reader can exit
+                    receiver_failed = True
+                    for argv, process, stderr in senders:
+                        process.terminate()
+            try:
+                receiver.stdin.close()
+            except BrokenPipeError:
+                pass
+            reader.join()
+            output.close()
+            for argv, process, stderr in receivers:
+                process.wait()
+
+            command_stats.add(time.monotonic() - start, 0.0, count=len(senders) + len(receivers))
+
+            # If the receiver failed, the senders were stopped because of it,
+            # so its error is the one to report. Within each side, a failing
+            # command breaks the pipe of the one before it, so the last
+            # failure is the one that caused the others.
+            for argv, process, stderr in senders:
+                process.wait()
+            for argv, process, stderr in reversed(senders):
+                if process.returncode != 0 and not receiver_failed:
+                    self._raise(argv, process, stderr)
+            for argv, process, stderr in reversed(receivers):
+                if process.returncode != 0:
+                    self._raise(argv, process, stderr)
+            if receiver_failed:
+                self._raise(*receivers[0])
+
+        stats['seconds'] = time.monotonic() - start
+        stats['rate'] = stats['bytes'] / stats['seconds'] if stats['seconds'] > 0 else 0
+        info("Transferred {0} in {1:.1f}s ({2}/s{3})".format(
+            format_bytes(stats['bytes']),
+            stats['seconds'],
+            format_bytes(stats['rate']),
+            ", {0} compressed".format(self.compression) if self.compression is not None else ''))
+        return stats
+
+    def _start(self, argvs, stack, stdin, stdout):
+        # Start a pipeline of commands, returning (argv, process, stderr) for
+        # each. The first reads stdin, the last writes to stdout.
+        import tempfile
+        processes = []
+        for i, argv in enumerate(argvs):
+            stderr = stack.enter_context(tempfile.TemporaryFile())
+            if i > 0:
+                stdin = processes[-1][1].stdout
+            process = subprocess.Popen(argv, stdin=stdin, stdout=stdout if i == len(argvs) - 1 else subprocess.PIPE, stderr=stderr)
+            if i > 0:
+                processes[-1][1].stdout.close()
+            processes.append((argv, process, stderr))
+        return processes
+
+    def _raise(self, argv, process, stderr):
+        stderr.seek(0)
+        raise CommandException(shlex.join(argv), process.returncode, stderr.read().decode('utf-8').rstrip("\n"))
+
+
+def format_bytes(size):
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if size < 1024:
+            return "{0:.1f} {1}".format(size, unit)
+        size /= 1024
+    return "{0:.1f} TiB".format(size)
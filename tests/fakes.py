@@ -0,0 +1,200 @@
+#!/usr/bin/python3
+
+# In-memory stand-ins for the btrfs filesystem and the commands the snapshot
+# manager runs, so tests and benchmarks exercise the real code paths without
+# touching real subvolumes, hosts or bootloaders
+
+import btrfssnapshotmanager.btrfs as btrfs
+import btrfssnapshotmanager.common as common
+import btrfssnapshotmanager.ssh as ssh
+from btrfssnapshotmanager.btrfs import *
+from btrfssnapshotmanager.snapshots import *
+from btrfssnapshotmanager.systemdboot import *
+
+from datetime import *
+from pathlib import PosixPath
+from unittest import mock
+import os
+import shlex
+
+
+fixture_start_date = datetime(2020, 1, 1, 0, 0, 0)
+
+
+class FakeRemote():
+
+    # Backup targets on fake remote hosts, as directory -> {name: SubvolumeInfo}
+
+    def __init__(self):
+        self.targets = {}
+
+    def add_target(self, path, snapshots):
+        self.targets[str(path).rstrip('/')] = dict([(s.name, s) for s in snapshots])
+
+    def run(self, remote_command):
+        # Recognise the remote commands the backups send, by their shape
+        if remote_command.startswith('if test -d '):
+            return (['yes'], 0)
+        if remote_command.startswith('ls -1 '):
+            path = shlex.split(remote_command)[2].rstrip('/')
+            return (sorted(self.targets.get(path, {}).keys()), 0)
+        if remote_command.startswith('sudo sh -c '):
+            script = shlex.split(remote_command[len('sudo sh -c '):])[0]
+            path = shlex.split(script[len('cd '):])[0]
+            marker = script.split('echo "', 1)[1].split(' ', 1)[0]
+            return (self._subvolume_show_lines(path, marker), 0)
+        return ([], 0)
+
+    def _subvolume_show_lines(self, path, marker):
+        lines = []
+        for name, details in sorted(self.targets.get(path, {}).items()):
+            lines.append("{0} {1}".format(marker, name))
+            lines.append("backups/{0}".format(name))
+            lines.append("\tName: \t\t\t{0}".format(name))
+            lines.append("\tUUID: \t\t\t{0}".format(details.uuid or '-'))
+            lines.append("\tParent UUID: \t\t-")
+            lines.append("\tReceived UUID: \t\t{0}".format(details.received_uuid or '-'))
+            lines.append("\tGeneration: \t\t{0}".format(details.generation or 0))
+            lines.append("\tFlags: \t\t\t{0}".format('readonly' if details.readonly else '-'))
+        return lines
+
+
+class FakeCommandProcess():
+
+    # Replaces common.CommandProcess, answering commands from memory
+
+    remote = FakeRemote()
+    count = 0
+
+    def __init__(self, argv):
+        self.argv = [str(a) for a in argv]
+        self.command = shlex.join(self.argv)
+        FakeCommandProcess.count += 1
+        self.output, self.code = self._run()
+
+    def lines(self):
+        return iter(self.output)
+
+    def wait(self, stdout=None):
+        result = common.CommandResult(self.command, self.code, stdout, '', 0.0, 0.0)
+        common.command_stats.add(0.0, 0.0)
+        return result
+
+    def _run(self):
+        program = self.argv[0]
+        if program == 'ssh':
+            return self.remote.run(self.argv[-1])
+        # btrfs, rsync, rm etc. all succeed without output
+        return ([], 0)
+
+
+installed_fakes = []
+
+def install_fakes():
+    # Subvolume operations go to an in-memory btrfs, and every command is
+    # answered by the fake command runner. The command line tool runs as if
+    # by root, as it would for real. Tests undo this with uninstall_fakes.
+    uninstall_fakes()
+    backend = FakeBtrfsBackend()
+    FakeCommandProcess.remote = FakeRemote()
+    FakeCommandProcess.count = 0
+    for patch in (
+            mock.patch.object(btrfs, 'btrfs_backend', backend),
+            mock.patch.object(common, 'CommandProcess', FakeCommandProcess),
+            mock.patch.object(ssh.SSHConnection, 'start', lambda self: None),
+            mock.patch.object(os, 'geteuid', lambda: 0)):
+        patch.start()
+        installed_fakes.append(patch)
+    return backend
+
+def uninstall_fakes():
+    while installed_fakes:
+        installed_fakes.pop().stop()
+
+
+def fixture_snapshot_names(count):
+    # Hourly snapshots going back from a fixed date, tagged as the scheduled
+    # run would have tagged them
+    names = []
+    for i in range(count):
+        date = fixture_start_date + timedelta(hours=i)
+        periods = [PERIOD_NAME_MAP['hourly']]
+        if date.hour == 0:
+            periods.append(PERIOD_NAME_MAP['daily'])
+            if date.weekday() == 0:
+                periods.append(PERIOD_NAME_MAP['weekly'])
+            if date.day == 1:
+                periods.append(PERIOD_NAME_MAP['monthly'])
+        names.append(snapshot_name_format(date, periods))
+    return names
+
+def fixture_subvolume(backend, path, count):
+    backend.add_subvolume(path)
+    backend.add_subvolume(PosixPath(path, snapshots_dir_name))
+    for name in fixture_snapshot_names(count):
+        backend.add_subvolume(PosixPath(path, snapshots_dir_name, name), readonly=True)
+    return Subvolume(path)
+
+def fixture_target_snapshots(subvol, snapshots):
+    # What a backup target holding the given snapshots reports about them
+    target_snapshots = []
+    for snapshot in snapshots:
+        target_snapshots.append(SubvolumeInfo(
+            snapshot.name,
+            readonly=True,
+            uuid=None,
+            received_uuid=snapshot.info.uuid,
+            generation=snapshot.info.generation))
+    return target_snapshots
+
+
+class FakeBootTree():
+
+    # A boot partition in a temporary directory, with a reference loader
+    # entry, boot snapshots and one loader entry per snapshot
+
+    # Imported here rather than at the top, so benchmarks of the command line
+    # tool's startup don't import them for it
+
+    def __init__(self):
+        import tempfile
+        self.path = PosixPath(tempfile.mkdtemp(prefix='btrfs-snapshot-manager-benchmark-'))
+        self.entries_dir = PosixPath(self.path, systemdboot_default_entries_dir)
+        self.snapshots_dir = PosixPath(self.path, systemdboot_default_snapshots_dir)
+
+    def create(self, snapshots, reference_entries, boot_snapshot_interval):
+        import shutil
+        if isinstance(reference_entries, str):
+            reference_entries = [reference_entries]
+        if self.path.exists():
+            shutil.rmtree(self.path)
+        self.entries_dir.mkdir(parents=True)
+        self.snapshots_dir.mkdir(parents=True)
+        for init_file in ('vmlinuz-linux', 'initramfs-linux.img'):
+            PosixPath(self.path, init_file).write_text(init_file)
+
+        for reference_entry in reference_entries:
+            PosixPath(self.entries_dir, reference_entry).write_text(
+                "title Arch Linux\n"
+                "linux /vmlinuz-linux\n"
+                "initrd /initramfs-linux.img\n"
+                "options root=UUID=0000 rw rootflags=subvol=root\n")
+
+        boot_snapshot_name = None
+        for i, snapshot in enumerate(snapshots):
+            if i % boot_snapshot_interval == 0:
+                boot_snapshot_name = systemdboot_snapshot_name_format(snapshot.date)
+                boot_snapshot_dir = PosixPath(self.snapshots_dir, boot_snapshot_name)
+                boot_snapshot_dir.mkdir()
+                for init_file in ('vmlinuz-linux', 'initramfs-linux.img'):
+                    PosixPath(boot_snapshot_dir, init_file).write_text(init_file)
+            for reference_entry in reference_entries:
+                PosixPath(self.entries_dir, boot_entry_name_format(reference_entry, snapshot.name)).write_text(
+                    "title Snapshot - {0} - Arch Linux\n"
+                    "linux /snapshots/{1}/vmlinuz-linux\n"
+                    "initrd /snapshots/{1}/initramfs-linux.img\n"
+                    "options root=UUID=0000 rw rootflags=subvol=/root/.snapshots/{0}\n".format(snapshot.name, boot_snapshot_name))
+
+    def remove(self):
+        import shutil
+        shutil.rmtree(self.path, ignore_errors=True)
@@ -0,0 +1,210 @@
+#!/usr/bin/python3
+
+from tests.fakes import *
+from btrfssnapshotmanager.backups import *
+
+from unittest import mock
+import tempfile
+import unittest
+import uuid
+
+
+class BackupTestCase(unittest.TestCase):
+
+    # A remote btrfs backup of a fake subvolume, with its state kept in a
+    # temporary directory
+
+    def setUp(self):
+        self.subvol = fixture_subvolume(install_fakes(), '/subvolume', 48)
+        self.addCleanup(uninstall_fakes)
+        self.snapshots = self.subvol.snapshots.copy()
+
+        self.state_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.state_dir.cleanup)
+        for store, name in ((transfer_journal, transfer_journal_file_name), (target_state_store, target_state_dir_name)):
+            store.set_path(PosixPath(self.state_dir.name, name))
+            self.addCleanup(store.set_path, PosixPath(default_state_path, name))
+
+        self.backup = RemoteBtrfsBackup(self.subvol, 'backup-host', None, None, '/backups')
+        self.backup.retention = {PERIOD_NAME_MAP['hourly']: 6}
+        self.backup.inventory_max_age = None
+        self.subvol.retention.add_policy(self.backup, 'backup 0')
+
+    def target(self, snapshots, incomplete=[]):
+        target_snapshots = fixture_target_snapshots(self.subvol, snapshots)
+        target_snapshots += [SubvolumeInfo(name, readonly=False) for name in incomplete]
+        FakeCommandProcess.remote.add_target('/backups', target_snapshots)
+
+    def names(self, snapshots):
+        return [s.name for s in snapshots]
+
+
+class PlanSyncTest(BackupTestCase):
+
+    def test_sends_missing_snapshots_from_the_closest_common_snapshot(self):
+        self.target(self.snapshots[-8:-2])
+        sync = self.backup.plan_sync()
+        self.assertFalse(sync.in_sync)
+        self.assertEqual(sync.source_snapshot_names, self.names(self.snapshots[-6:]))
+        self.assertEqual(sync.transfers, [
+            (self.snapshots[-2], self.snapshots[-3], []),
+            (self.snapshots[-1], self.snapshots[-2], []),
+        ])
+        self.assertEqual(sync.deletes, self.names(self.snapshots[-8:-6]))
+
+    def test_clone_sources_are_the_next_closest_common_snapshots(self):
+        self.backup.clone_sources = 2
+        self.target(self.snapshots[-8:-1])
+        sync = self.backup.plan_sync()
+        self.assertEqual(sync.transfers, [(self.snapshots[-1], self.snapshots[-2], [self.snapshots[-3], self.snapshots[-4]])])
+
+    def test_target_snapshot_not_received_from_the_source_is_not_a_parent(self):
+        target_snapshots = fixture_target_snapshots(self.subvol, self.snapshots[-8:-1])
+        target_snapshots[-1].received_uuid = None
+        FakeCommandProcess.remote.add_target('/backups', target_snapshots)
+        sync = self.backup.plan_sync()
+        self.assertEqual(sync.transfers, [(self.snapshots[-1], self.snapshots[-3], [])])
+
+    def test_first_snapshot_is_sent_in_full_to_an_empty_target(self):
+        self.target([])
+        sync = self.backup.plan_sync()
+        self.assertEqual(sync.transfers[0], (self.snapshots[-6], None, []))
+        self.assertEqual(sync.transfers[1:], [(s, p, []) for p, s in zip(self.snapshots[-6:-1], self.snapshots[-5:])])
+        self.assertEqual(sync.deletes, [])
+
+    def test_incomplete_snapshots_are_deleted_and_sent_again(self):
+        self.target(self.snapshots[-8:-2], incomplete=self.names(self.snapshots[-2:-1]))
+        sync = self.backup.plan_sync()
+        self.assertEqual(sync.incomplete, self.names(self.snapshots[-2:-1]))
+        self.assertNotIn(self.snapshots[-2].name, sync.target_snapshots)
+        self.assertEqual([t[0] for t in sync.transfers], self.snapshots[-2:])
+        self.assertEqual(sync.deletes, self.names(self.snapshots[-8:-6]))
+
+    def test_catches_up_in_one_stream_when_enough_snapshots_are_missing(self):
+        self.backup.catch_up = 3
+        self.target(self.snapshots[-8:-4])
+        sync = self.backup.plan_sync()
+        self.assertEqual(sync.catch_up, self.snapshots[-4:])
+        self.assertEqual(sync.transfers, [])
+
+        self.target(self.snapshots[-8:-2])
+        sync = self.backup.plan_sync()
+        self.assertIsNone(sync.catch_up)
+        self.assertEqual([t[0] for t in sync.transfers], self.snapshots[-2:])
+
+    def test_minimum_retention_keeps_the_newest_target_snapshots(self):
+        self.backup.retention_minimum = 8
+        self.target(self.snapshots[-10:-1])
+        sync = self.backup.plan_sync()
+        self.assertEqual(sync.deletes, self.names(self.snapshots[-10:-8]))
+
+
+class InSyncTest(BackupTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.backup.inventory_max_age = timedelta(hours=1)
+
+    def test_inventory_cache_is_off_unless_configured(self):
+        self.assertIsNone(RemoteBtrfsBackup(self.subvol, 'backup-host', None, None, '/backups').inventory_max_age)
+
+    def test_remote_target_in_sync_is_skipped_without_contacting_it(self):
+        self.target(self.snapshots[-6:])
+        self.backup.apply_sync(self.backup.plan_sync())
+        count = FakeCommandProcess.count
+        sync = self.backup.plan_sync()
+        self.assertTrue(sync.in_sync)
+        self.backup.apply_sync(sync)
+        self.assertEqual(FakeCommandProcess.count, count)
+
+    def test_missing_local_target_in_sync_fails(self):
+        path = PosixPath(self.state_dir.name, 'backups')
+        path.mkdir()
+        backup = LocalBtrfsBackup(self.subvol, path)
+        backup.retention = self.backup.retention
+        backup.inventory_max_age = timedelta(hours=1)
+        self.subvol.retention.add_policy(backup, 'backup 1')
+        backup.save_target_state({}, self.names(self.snapshots[-6:]))
+        path.rmdir()
+        sync = backup.plan_sync()
+        self.assertTrue(sync.in_sync)
+        with self.assertRaises(SnapshotException):
+            backup.apply_sync(sync)
+        self.assertIsNone(backup.target_state())
+
+
+class SpooledTransferTest(BackupTestCase):
+
+    # Spooled transfers interrupted while uploading, then tried again
+
+    def setUp(self):
+        super().setUp()
+        self.backup.spool_path = PosixPath(self.state_dir.name, 'spool')
+        self.backup.transfer_pipeline = TransferPipeline()
+        self.spooled = []
+        def spool(send_argv, receive_argvs):
+            self.spooled.append(send_argv)
+            PosixPath(receive_argvs[0][1]).write_bytes(b'stream')
+        self.backup.transfer_pipeline.run = spool
+        self.source = self.snapshots[-1]
+        self.spool_file = self.backup.spool_file(self.source.name)
+
+        with mock.patch.object(self.backup, 'run_rsync', side_effect=CommandException('rsync', 1, 'interrupted')):
+            with self.assertRaises(CommandException):
+                self.backup.transfer(self.source, self.snapshots[-2])
+        self.assertEqual(self.entry()['stage'], 'uploading')
+
+    def entry(self):
+        return transfer_journal.get(self.subvol.name, self.backup.location(), self.source.name)
+
+    def retry(self):
+        with mock.patch.object(self.backup, 'run_rsync') as run_rsync:
+            self.backup.transfer(self.source, self.snapshots[-2])
+        self.assertIsNone(self.entry())
+        return run_rsync.call_args[0][0]
+
+    def test_upload_is_resumed(self):
+        self.assertIn('--append-verify', self.retry())
+        self.assertEqual(len(self.spooled), 1)
+
+    def test_missing_spool_is_spooled_again(self):
+        self.spool_file.unlink()
+        self.retry()
+        self.assertEqual(len(self.spooled), 2)
+
+    def test_recreated_snapshot_is_spooled_again(self):
+        self.source.info.uuid = str(uuid.uuid4())
+        self.retry()
+        self.assertEqual(len(self.spooled), 2)
+
+    def test_different_parent_is_spooled_again(self):
+        with mock.patch.object(self.backup, 'run_rsync'):
+            self.backup.transfer(self.source, self.snapshots[-3])
+        self.assertEqual(self.spooled[-1][0:4], ['btrfs', 'send', '-p', str(self.snapshots[-3].path)])
+
+    def test_entries_are_kept_per_subvolume(self):
+        self.assertIsNone(transfer_journal.get('/other', self.backup.location(), self.source.name))
+        self.assertEqual(list(transfer_journal.target_entries(self.subvol.name, self.backup.location()).keys()), [self.source.name])
+
+
+class TransferJournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        self.path = PosixPath(self.temp_dir.name, transfer_journal_file_name)
+
+    def test_journal_in_an_older_format_is_ignored(self):
+        self.path.write_text('{"host:/backups": {"2020-01-01_00-00-00_H": {"mechanism": "btrfs"}}}')
+        self.assertEqual(TransferJournal(self.path).entries, {})
+
+    def test_finishing_the_last_transfer_removes_its_subvolume(self):
+        journal = TransferJournal(self.path)
+        journal.start('/subvolume', 'host:/backups', 'a', stage='spooling')
+        journal.start('/other', 'host:/backups', 'a')
+        journal.finish('/subvolume', 'host:/backups', 'a')
+        self.assertEqual(list(TransferJournal(self.path).entries.keys()), ['/other'])
+
+
+if __name__ == '__main__':
+    unittest.main()
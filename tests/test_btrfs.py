@@ -0,0 +1,96 @@
+#!/usr/bin/python3
+
+from btrfssnapshotmanager.btrfs import *
+
+from unittest import mock
+import os
+import tempfile
+import unittest
+import uuid
+
+
+class IoctlStructTest(unittest.TestCase):
+
+    # Sizes and request numbers from linux/btrfs.h
+
+    def test_struct_sizes_match_the_kernel(self):
+        self.assertEqual(btrfs_vol_args.size, 4096)
+        self.assertEqual(btrfs_vol_args_v2.size, 4096)
+        self.assertEqual(btrfs_get_subvol_info_args.size, 504)
+
+    def test_request_numbers_match_the_kernel(self):
+        self.assertEqual(BTRFS_IOC_SUBVOL_CREATE, 0x5000940e)
+        self.assertEqual(BTRFS_IOC_SNAP_DESTROY, 0x5000940f)
+        self.assertEqual(BTRFS_IOC_WAIT_SYNC, 0x40089416)
+        self.assertEqual(BTRFS_IOC_SNAP_CREATE_V2, 0x50009417)
+        self.assertEqual(BTRFS_IOC_START_SYNC, 0x80089418)
+        self.assertEqual(BTRFS_IOC_GET_SUBVOL_INFO, 0x81f8943c)
+
+
+class IoctlBtrfsBackendTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        self.path = PosixPath(self.temp_dir.name)
+        self.backend = IoctlBtrfsBackend()
+        self.ioctls = []
+
+    def ioctl(self, results=None, error=None):
+        # Record the ioctls made, filling in the kernel's answer
+        def ioctl(fd, request, buffer):
+            self.ioctls.append((request, bytes(buffer)))
+            if error is not None:
+                raise OSError(error, os.strerror(error))
+            if results is not None and request in results:
+                buffer[:] = results[request]
+        patch = mock.patch('fcntl.ioctl', side_effect=ioctl)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_subvolume_show_unpacks_subvolume_info(self):
+        subvol_uuid = uuid.UUID('11111111-2222-3333-4444-555555555555')
+        received_uuid = uuid.UUID('66666666-7777-8888-9999-aaaaaaaaaaaa')
+        self.ioctl({BTRFS_IOC_GET_SUBVOL_INFO: btrfs_get_subvol_info_args.pack(
+            257, b'snapshot', 5, 256, 1234, BTRFS_ROOT_SUBVOL_RDONLY,
+            subvol_uuid.bytes, bytes(16), received_uuid.bytes,
+            0, 0, 0, 0, *([0] * 8), *([0] * 8))})
+        with mock.patch('os.fstat', return_value=mock.Mock(st_ino=BTRFS_FIRST_FREE_OBJECTID)):
+            details = self.backend.subvolume_show(self.path)
+        self.assertEqual((details.name, details.readonly, details.generation), (self.path.name, True, 1234))
+        self.assertEqual((details.uuid, details.parent_uuid, details.received_uuid), (str(subvol_uuid), None, str(received_uuid)))
+
+    def test_subvolume_show_of_a_directory_inside_a_subvolume(self):
+        self.ioctl({BTRFS_IOC_GET_SUBVOL_INFO: bytes(btrfs_get_subvol_info_args.size)})
+        self.assertIsNone(self.backend.subvolume_show(self.path))
+
+    def test_subvolume_show_falls_back_to_the_btrfs_command(self):
+        self.ioctl(error=errno.ENOTTY)
+        with mock.patch.object(CommandBtrfsBackend, 'subvolume_show', return_value='command') as subvolume_show:
+            self.assertEqual(self.backend.subvolume_show(self.path), 'command')
+        subvolume_show.assert_called_once_with(self.path)
+
+    def test_snapshot_packs_source_flags_and_name(self):
+        self.ioctl()
+        self.backend.subvolume_snapshot(self.path, PosixPath(self.path, 'snapshot'))
+        self.assertEqual(len(self.ioctls), 1)
+        request, buffer = self.ioctls[0]
+        fd, transid, flags, unused, name = btrfs_vol_args_v2.unpack(buffer)
+        self.assertEqual(request, BTRFS_IOC_SNAP_CREATE_V2)
+        self.assertEqual((flags, name.rstrip(b'\0')), (BTRFS_SUBVOL_RDONLY, b'snapshot'))
+        self.assertGreaterEqual(fd, 0)
+
+    def test_delete_destroys_each_subvolume_then_commits_once(self):
+        self.ioctl()
+        self.backend.subvolume_delete([PosixPath(self.path, 'a'), PosixPath(self.path, 'b')])
+        self.assertEqual([r for r, b in self.ioctls], [BTRFS_IOC_SNAP_DESTROY, BTRFS_IOC_SNAP_DESTROY, BTRFS_IOC_START_SYNC, BTRFS_IOC_WAIT_SYNC])
+        self.assertEqual([btrfs_vol_args.unpack(b)[1].rstrip(b'\0') for r, b in self.ioctls[0:2]], [b'a', b'b'])
+
+    def test_delete_error_is_reported(self):
+        self.ioctl(error=errno.EPERM)
+        with self.assertRaises(SnapshotException):
+            self.backend.subvolume_delete([PosixPath(self.path, 'a')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+#!/usr/bin/python3
+
+from tests.fakes import *
+from btrfssnapshotmanager.config import *
+
+from unittest import mock
+import tempfile
+import unittest
+import yaml
+
+
+class ConfigCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        install_fakes()
+        self.addCleanup(uninstall_fakes)
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        for name in ('config_file', 'config_cache_file'):
+            patch = mock.patch.object(Config, name, PosixPath(self.temp_dir.name, name))
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.write_config(4)
+
+    def write_config(self, hourly):
+        Config.config_file.write_text(
+            "state-path: {0}\n"
+            "subvolumes:\n"
+            "  - path: /subvolume\n"
+            "    retention:\n"
+            "      hourly: {1}\n".format(self.temp_dir.name, hourly))
+
+    def load(self):
+        # Whether the config file had to be parsed, and the config loaded
+        with mock.patch('yaml.load', wraps=yaml.load) as load:
+            config = Config(None)
+        return (load.called, config.retention['/subvolume'][PERIOD_NAME_MAP['hourly']])
+
+    def test_unchanged_config_is_loaded_from_the_cache(self):
+        self.assertEqual(self.load(), (True, 4))
+        self.assertTrue(Config.config_cache_file.is_file())
+        self.assertEqual(self.load(), (False, 4))
+
+    def test_changed_config_is_parsed_again(self):
+        self.load()
+        self.write_config(8)
+        self.assertEqual(self.load(), (True, 8))
+        self.assertEqual(self.load(), (False, 8))
+
+    def test_corrupt_cache_is_ignored(self):
+        self.load()
+        Config.config_cache_file.write_bytes(b'\x00not marshal data')
+        self.assertEqual(self.load(), (True, 4))
+        self.assertEqual(self.load(), (False, 4))
+
+    def test_invalid_config_is_not_cached(self):
+        Config.config_file.write_text("subvolumes:\n  - path: /subvolume\n")
+        with self.assertRaises(ConfigException):
+            Config(None)
+        self.assertFalse(Config.config_cache_file.exists())
+
+
+if __name__ == '__main__':
+    unittest.main()
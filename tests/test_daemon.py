@@ -0,0 +1,63 @@
+#!/usr/bin/python3
+
+from tests.fakes import *
+from btrfssnapshotmanager.daemon import *
+
+import btrfssnapshotmanager.daemon
+import tempfile
+import types
+import unittest
+
+
+class ScheduleTest(unittest.TestCase):
+
+    def setUp(self):
+        self.subvol = fixture_subvolume(install_fakes(), '/subvolume', 0)
+        self.addCleanup(uninstall_fakes)
+        self.manager = SubvolumeManager(None, self.subvol, {
+            PERIOD_NAME_MAP['hourly']: 0,
+            PERIOD_NAME_MAP['daily']: 1,
+        }, [])
+        self.daemon = SnapshotDaemon()
+        self.daemon.snapshot_manager = types.SimpleNamespace(managers={'/subvolume': self.manager})
+
+    def test_period_keeping_no_snapshots_is_never_due(self):
+        self.assertEqual(self.manager.periods_due(), [PERIOD_NAME_MAP['daily']])
+        self.subvol.create_snapshot(periods=[PERIOD_NAME_MAP['daily']])
+        self.assertEqual(self.manager.periods_due(), [])
+
+    def test_period_keeping_no_snapshots_is_not_scheduled(self):
+        self.subvol.create_snapshot(periods=[PERIOD_NAME_MAP['daily']])
+        self.daemon.schedule('/subvolume')
+        self.assertGreater(self.daemon.scheduler.next_due(), datetime.now())
+        self.assertEqual(self.daemon.scheduler.pop_due(datetime.now()), {})
+
+
+class QueryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.socket_path = PosixPath(self.temp_dir.name, 'daemon.sock')
+        self.daemon = SnapshotDaemon(self.socket_path, {'ping': lambda snapshot_manager, args: 'pong'})
+        self.daemon.snapshot_manager = types.SimpleNamespace(managers={})
+        self.daemon.start_server()
+
+    def tearDown(self):
+        self.daemon.stop_server()
+        self.temp_dir.cleanup()
+
+    def test_query(self):
+        self.assertEqual(query_daemon('ping', {}, str(self.socket_path)), 'pong')
+
+    def test_query_during_run_is_left_to_caller(self):
+        wait = btrfssnapshotmanager.daemon.daemon_query_wait
+        btrfssnapshotmanager.daemon.daemon_query_wait = 0.1
+        try:
+            with self.daemon.state_lock:
+                self.assertIsNone(query_daemon('ping', {}, str(self.socket_path)))
+        finally:
+            btrfssnapshotmanager.daemon.daemon_query_wait = wait
+
+
+if __name__ == '__main__':
+    unittest.main()
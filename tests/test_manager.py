@@ -0,0 +1,82 @@
+#!/usr/bin/python3
+
+from btrfssnapshotmanager.manager import *
+
+from unittest import mock
+import threading
+import types
+import unittest
+
+
+class ExecuteTest(unittest.TestCase):
+
+    # Runs subvolumes named after the device they're on, with running a
+    # subvolume replaced by recording it
+
+    def setUp(self):
+        patch = mock.patch('btrfssnapshotmanager.manager.filesystem_device', side_effect=lambda path: str(path)[1])
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.started = []
+        self.running = {}
+        self.most_running = {}
+        self.lock = threading.Lock()
+
+    def snapshot_manager(self, subvols, workers_per_device=None):
+        snapshot_manager = SnapshotManager.__new__(SnapshotManager)
+        snapshot_manager.config = types.SimpleNamespace(workers=1, workers_per_device=workers_per_device)
+        snapshot_manager.managers = dict([(s, types.SimpleNamespace(subvol=types.SimpleNamespace(path=s))) for s in subvols])
+        return snapshot_manager
+
+    def run_subvol(self, execute_subvol):
+        def run(subvol, manager):
+            device = subvol[1]
+            with self.lock:
+                self.started.append(subvol)
+                self.running[device] = self.running.get(device, 0) + 1
+                self.most_running[device] = max(self.most_running.get(device, 0), self.running[device])
+            try:
+                execute_subvol(subvol)
+            finally:
+                with self.lock:
+                    self.running[device] -= 1
+        return mock.patch.object(SnapshotManager, '_execute_subvol', side_effect=run)
+
+    def fail_some(self, subvol):
+        if subvol.endswith('-fail'):
+            raise SnapshotException("Subvolume {0} failed".format(subvol))
+
+    def test_serial_run_continues_past_failures(self):
+        snapshot_manager = self.snapshot_manager(['/a1-fail', '/a2', '/b1-fail'])
+        with self.run_subvol(self.fail_some):
+            with self.assertRaisesRegex(SnapshotException, '2 subvolume'):
+                snapshot_manager._execute(None, 1)
+        self.assertEqual(self.started, ['/a1-fail', '/a2', '/b1-fail'])
+
+    def test_parallel_run_continues_past_failures(self):
+        snapshot_manager = self.snapshot_manager(['/a1-fail', '/a2', '/b1-fail', '/b2'])
+        with self.run_subvol(self.fail_some):
+            with self.assertRaisesRegex(SnapshotException, '2 subvolume'):
+                snapshot_manager._execute(None, 2)
+        self.assertEqual(sorted(self.started), ['/a1-fail', '/a2', '/b1-fail', '/b2'])
+
+    def test_busy_device_does_not_hold_up_another(self):
+        # While the only slot on device a is taken, both of device b's
+        # subvolumes still run
+        snapshot_manager = self.snapshot_manager(['/a1', '/a2', '/a3', '/b1', '/b2'], workers_per_device=1)
+        b_done = threading.Event()
+        waited = []
+        def execute_subvol(subvol):
+            if subvol == '/a1':
+                waited.append(b_done.wait(5))
+            elif subvol == '/b2':
+                b_done.set()
+        with self.run_subvol(execute_subvol):
+            snapshot_manager._execute(None, 2)
+        self.assertEqual(waited, [True])
+        self.assertEqual(len(self.started), 5)
+        self.assertEqual(self.most_running, {'a': 1, 'b': 1})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+#!/usr/bin/python3
+
+from tests.fakes import *
+from btrfssnapshotmanager.config import *
+from btrfssnapshotmanager.manager import *
+
+from unittest import mock
+import tempfile
+import unittest
+
+
+class PeriodMinutesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.period = PeriodMinutes('quarter-hourly', 'Q', 15)
+
+    def test_next_period_lines_up_with_midnight(self):
+        self.assertEqual(self.period.next_period(datetime(2021, 1, 1, 10, 0)), datetime(2021, 1, 1, 10, 15))
+        self.assertEqual(self.period.next_period(datetime(2021, 1, 1, 10, 14, 59)), datetime(2021, 1, 1, 10, 15))
+        self.assertEqual(self.period.next_period(datetime(2021, 1, 1, 23, 50)), datetime(2021, 1, 2, 0, 0))
+        self.assertEqual(PeriodMinutes('ninety', 'N', 90).next_period(datetime(2021, 1, 1, 1, 45)), datetime(2021, 1, 1, 3, 0))
+
+    def test_equal_periods_are_interchangeable(self):
+        self.assertEqual(self.period, PeriodMinutes('quarter-hourly', 'Q', 15))
+        self.assertEqual({self.period: 1}[PeriodMinutes('quarter-hourly', 'Q', 15)], 1)
+        self.assertNotEqual(self.period, PeriodMinutes('quarter-hourly', 'Q', 30))
+
+
+class CustomPeriodsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.addCleanup(set_custom_periods, [])
+        self.period = PeriodMinutes('quarter-hourly', 'Q', 15)
+        set_custom_periods([self.period])
+
+    def test_periods_are_ordered_by_length(self):
+        self.assertEqual(PERIODS[0], self.period)
+        self.assertIs(PERIOD_TAG_MAP['Q'], self.period)
+        self.assertIs(PERIOD_NAME_MAP['quarter-hourly'], self.period)
+        set_custom_periods([])
+        self.assertNotIn('Q', PERIOD_TAG_MAP)
+
+    def test_snapshot_names_round_trip(self):
+        name = snapshot_name_format(datetime(2021, 1, 1), [PERIOD_NAME_MAP['hourly'], self.period])
+        self.assertEqual(name, '2021-01-01_00-00-00_QH')
+        self.assertEqual(snapshot_name_parse(name), {'date': datetime(2021, 1, 1), 'periods': [self.period, PERIOD_NAME_MAP['hourly']]})
+        set_custom_periods([])
+        self.assertIsNone(snapshot_name_parse(name))
+
+    def test_custom_period_is_due_and_retained(self):
+        subvol = fixture_subvolume(install_fakes(), '/subvolume', 0)
+        self.addCleanup(uninstall_fakes)
+        manager = SubvolumeManager(None, subvol, {self.period: 2}, [])
+        self.assertEqual(manager.periods_due(), [self.period])
+        for minutes in (0, 15, 30):
+            subvol.create_snapshot(date=datetime.now() - timedelta(minutes=45 - minutes), periods=[self.period])
+        self.assertEqual(manager.plan_cleanup(), [subvol.snapshots[0]])
+
+
+class CustomPeriodsConfigTest(unittest.TestCase):
+
+    def setUp(self):
+        install_fakes()
+        self.addCleanup(uninstall_fakes)
+        self.addCleanup(set_custom_periods, [])
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        for name in ('config_file', 'config_cache_file'):
+            patch = mock.patch.object(Config, name, PosixPath(self.temp_dir.name, name))
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def load(self, periods):
+        Config.config_file.write_text(
+            "state-path: {0}\n"
+            "periods:\n"
+            "  - name: {1}\n"
+            "    tag: {2}\n"
+            "    minutes: {3}\n"
+            "subvolumes:\n"
+            "  - path: /subvolume\n"
+            "    retention:\n"
+            "      {1}: 4\n".format(self.temp_dir.name, *periods))
+        return Config(None)
+
+    def test_custom_period_can_be_used_for_retention(self):
+        config = self.load(('quarter-hourly', 'Q', 15))
+        self.assertEqual(config.retention['/subvolume'], {PeriodMinutes('quarter-hourly', 'Q', 15): 4})
+
+    def test_invalid_custom_periods_are_refused(self):
+        for periods in (('hourly', 'Q', 15), ('quarter-hourly', 'H', 15), ('quarter-hourly', 'q', 15), ('quarter-hourly', 'Q', 7)):
+            with self.assertRaises(ConfigException):
+                self.load(periods)
+            self.assertEqual(get_custom_periods(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
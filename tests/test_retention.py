@@ -0,0 +1,77 @@
+#!/usr/bin/python3
+
+from tests.fakes import *
+from btrfssnapshotmanager.retention import *
+
+import unittest
+
+
+class Policy():
+
+    def __init__(self, retention):
+        self.retention = retention
+
+
+def latest_per_period(snapshots, retention):
+    # How retention was worked out before the engine - the newest snapshots of
+    # each period, searched for one period at a time
+    keep = set()
+    for period, count in retention.items():
+        if period is None:
+            continue
+        keep.update(snapshots.latest(period, count))
+    return keep
+
+
+class RetentionEngineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.subvol = fixture_subvolume(install_fakes(), '/subvolume', 24 * 60)
+        self.addCleanup(uninstall_fakes)
+        self.engine = RetentionEngine()
+        self.owners = [
+            Policy({
+                PERIOD_NAME_MAP['hourly']: 24,
+                PERIOD_NAME_MAP['daily']: 7,
+                PERIOD_NAME_MAP['weekly']: 4,
+                PERIOD_NAME_MAP['monthly']: 2,
+            }),
+            Policy({
+                PERIOD_NAME_MAP['daily']: 30,
+                PERIOD_NAME_MAP['monthly']: 0,
+            }),
+            Policy({
+                PERIOD_NAME_MAP['hourly']: 1000,
+                PERIOD_NAME_MAP['weekly']: 100,
+            }),
+        ]
+        for i, owner in enumerate(self.owners):
+            self.engine.add_policy(owner, 'policy{0}'.format(i))
+
+    def test_keeps_the_same_snapshots_as_searching_each_period(self):
+        snapshots = self.subvol.snapshots
+        for owner in self.owners:
+            self.assertEqual(self.engine.keep(snapshots, owner), latest_per_period(snapshots, owner.retention))
+
+    def test_result_is_worked_out_again_when_snapshots_change(self):
+        snapshots = self.subvol.snapshots
+        owner = self.owners[0]
+        kept = self.engine.keep(snapshots, owner)
+        snapshot = self.subvol.create_snapshot(periods=[PERIOD_NAME_MAP['hourly']])
+        self.assertNotEqual(self.engine.keep(snapshots, owner), kept)
+        self.assertIn(snapshot, self.engine.keep(snapshots, owner))
+        self.assertEqual(self.engine.keep(snapshots, owner), latest_per_period(snapshots, owner.retention))
+
+    def test_records_why_snapshots_are_kept(self):
+        snapshots = self.subvol.snapshots
+        newest = snapshots[-1]
+        self.assertIn(('policy0', PERIOD_NAME_MAP['hourly'], 1), self.engine.evaluate(snapshots).why(newest))
+        self.assertEqual(self.engine.evaluate(snapshots).why(snapshots[1]), [])
+
+    def test_unregistered_owner_is_refused(self):
+        with self.assertRaises(SnapshotException):
+            self.engine.keep(self.subvol.snapshots, Policy({}))
+
+
+if __name__ == '__main__':
+    unittest.main()
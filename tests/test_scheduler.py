@@ -0,0 +1,55 @@
+#!/usr/bin/python3
+
+from btrfssnapshotmanager.periods import *
+from btrfssnapshotmanager.scheduler import *
+
+from datetime import *
+import unittest
+
+
+start = datetime(2021, 1, 1)
+hourly = PERIOD_NAME_MAP['hourly']
+daily = PERIOD_NAME_MAP['daily']
+
+
+class SchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = Scheduler()
+
+    def test_pops_only_what_is_due(self):
+        self.scheduler.schedule('/a', [(start + timedelta(hours=1), hourly), (start + timedelta(days=1), daily)])
+        self.scheduler.schedule('/b', [(start + timedelta(minutes=30), hourly)])
+        self.assertEqual(self.scheduler.next_due(), start + timedelta(minutes=30))
+        self.assertEqual(self.scheduler.pop_due(start), {})
+        self.assertEqual(self.scheduler.pop_due(start + timedelta(hours=1)), {'/a': [hourly], '/b': [hourly]})
+        self.assertEqual(self.scheduler.next_due(), start + timedelta(days=1))
+        self.assertEqual(self.scheduler.pop_due(start + timedelta(days=2)), {'/a': [daily]})
+        self.assertIsNone(self.scheduler.next_due())
+
+    def test_collects_every_period_due_for_a_subvolume(self):
+        self.scheduler.schedule('/a', [(start, hourly), (start, daily), (start - timedelta(hours=1), None)])
+        self.assertEqual(self.scheduler.pop_due(start), {'/a': [hourly, daily]})
+
+    def test_rescheduling_replaces_earlier_times(self):
+        self.scheduler.schedule('/a', [(start, hourly)])
+        self.scheduler.schedule('/a', [(start + timedelta(hours=2), hourly)])
+        self.assertEqual(self.scheduler.next_due(), start + timedelta(hours=2))
+        self.assertEqual(self.scheduler.pop_due(start + timedelta(hours=1)), {})
+        self.assertEqual(self.scheduler.pop_due(start + timedelta(hours=2)), {'/a': [hourly]})
+
+    def test_unscheduled_subvolume_is_never_due(self):
+        self.scheduler.schedule('/a', [(start, hourly)])
+        self.scheduler.schedule('/b', [(start, daily)])
+        self.scheduler.unschedule('/a')
+        self.assertEqual(self.scheduler.pop_due(start), {'/b': [daily]})
+
+    def test_stale_entries_are_dropped(self):
+        for i in range(1000):
+            self.scheduler.schedule('/a', [(start + timedelta(minutes=i), hourly), (start + timedelta(days=1), daily)])
+        self.assertLess(len(self.scheduler.queue), 10)
+        self.assertEqual(self.scheduler.pop_due(start + timedelta(days=1)), {'/a': [hourly, daily]})
+
+
+if __name__ == '__main__':
+    unittest.main()
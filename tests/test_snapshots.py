@@ -0,0 +1,136 @@
+#!/usr/bin/python3
+
+from tests.fakes import *
+from btrfssnapshotmanager.snapshots import *
+
+from unittest import mock
+import random
+import unittest
+
+
+class SnapshotCollectionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.subvol = fixture_subvolume(install_fakes(), '/subvolume', 24 * 40)
+        self.addCleanup(uninstall_fakes)
+        self.snapshots = self.subvol.snapshots.copy()
+        shuffled = self.snapshots.copy()
+        random.Random(0).shuffle(shuffled)
+        self.collection = SnapshotCollection(shuffled)
+
+    def scan(self, snapshots, periods):
+        # What a linear search over every snapshot finds
+        return [s for s in snapshots if len(set(s.periods) & set(periods)) > 0]
+
+    def test_keeps_snapshots_in_date_order(self):
+        self.assertEqual(list(self.collection), self.snapshots)
+        self.assertEqual(list(reversed(self.collection)), list(reversed(self.snapshots)))
+
+    def test_search_matches_a_linear_scan(self):
+        for periods in ([PERIOD_NAME_MAP['daily']], [PERIOD_NAME_MAP['weekly'], PERIOD_NAME_MAP['monthly']], PERIODS):
+            self.assertEqual(self.collection.search(periods=periods), self.scan(self.snapshots, periods))
+        self.assertEqual(self.collection.search(periods=[PeriodMinutes('quarter-hourly', 'Q', 15)]), [])
+
+    def test_latest_and_last(self):
+        daily = self.scan(self.snapshots, [PERIOD_NAME_MAP['daily']])
+        self.assertEqual(self.collection.latest(PERIOD_NAME_MAP['daily'], 7), daily[-7:])
+        self.assertEqual(self.collection.latest(PERIOD_NAME_MAP['daily'], 0), [])
+        self.assertEqual(self.collection.last(PERIOD_NAME_MAP['daily']), daily[-1])
+        self.assertIsNone(self.collection.last(PeriodMinutes('quarter-hourly', 'Q', 15)))
+
+    def test_add_and_remove_keep_the_indexes_in_step(self):
+        removed = [s for s in self.snapshots if s.date.day == 2]
+        for snapshot in removed:
+            self.collection.remove(snapshot)
+        remaining = [s for s in self.snapshots if s not in removed]
+        self.assertEqual(list(self.collection), remaining)
+        self.assertEqual(self.collection.search(periods=[PERIOD_NAME_MAP['daily']]), self.scan(remaining, [PERIOD_NAME_MAP['daily']]))
+        self.assertIsNone(self.collection.find(removed[0].name))
+        self.assertNotIn(removed[0], self.collection)
+
+        for snapshot in reversed(removed):
+            self.collection.add(snapshot)
+        self.assertEqual(list(self.collection), self.snapshots)
+        self.assertEqual(self.collection.search(periods=[PERIOD_NAME_MAP['daily']]), self.scan(self.snapshots, [PERIOD_NAME_MAP['daily']]))
+        self.assertIs(self.collection.find(removed[0].name), removed[0])
+
+    def test_adding_a_snapshot_twice_is_refused(self):
+        with self.assertRaises(SnapshotException):
+            self.collection.add(self.snapshots[0])
+
+
+class SnapshotDeleteQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = install_fakes()
+        self.addCleanup(uninstall_fakes)
+        self.subvol = fixture_subvolume(self.backend, '/subvolume', 10)
+        self.snapshots = self.subvol.snapshots.copy()
+
+        # Record the deletes and syncs the queue makes, in order
+        self.calls = []
+        subvolume_delete = self.backend.subvolume_delete
+        def delete(paths):
+            self.calls.append(('delete', [PosixPath(p).name for p in paths]))
+            subvolume_delete(paths)
+        self.backend.subvolume_delete = delete
+        self.backend.subvolume_sync = lambda path: self.calls.append(('sync', str(path)))
+        sleep = mock.patch('time.sleep', side_effect=lambda seconds: self.calls.append(('sleep', seconds)))
+        sleep.start()
+        self.addCleanup(sleep.stop)
+
+    def queue(self, snapshots):
+        queue = SnapshotDeleteQueue(self.subvol)
+        for snapshot in snapshots:
+            queue.add(snapshot)
+        return queue
+
+    def test_deletes_in_batches_oldest_first_and_waits_between_them(self):
+        self.subvol.delete_batch_size = 3
+        self.subvol.delete_interval = 5
+        to_delete = self.snapshots[0:7]
+        self.assertEqual(self.queue(reversed(to_delete)).run(), 7)
+        names = [s.name for s in to_delete]
+        snapshots_dir = str(self.subvol.snapshots_dir)
+        self.assertEqual(self.calls, [
+            ('delete', names[0:3]),
+            ('sync', snapshots_dir),
+            ('sleep', 5),
+            ('delete', names[3:6]),
+            ('sync', snapshots_dir),
+            ('sleep', 5),
+            ('delete', names[6:7]),
+        ])
+        self.assertEqual(list(self.subvol.snapshots), self.snapshots[7:])
+
+    def test_deletes_everything_at_once_without_a_batch_size(self):
+        self.assertEqual(self.queue(self.snapshots[0:4] + self.snapshots[0:2]).run(), 4)
+        self.assertEqual(self.calls, [('delete', [s.name for s in self.snapshots[0:4]])])
+
+    def test_failed_batch_forgets_only_the_snapshots_deleted(self):
+        self.subvol.delete_batch_size = 3
+        # Deleted behind the manager's back, so the batch fails part way
+        self.backend.subvolumes.pop(str(self.snapshots[1].path))
+        with self.assertRaises(SnapshotException):
+            self.queue(self.snapshots[0:6]).run()
+        self.assertEqual(self.calls, [('delete', [s.name for s in self.snapshots[0:3]])])
+        self.assertNotIn(self.snapshots[0], self.subvol.snapshots)
+        self.assertNotIn(self.snapshots[1], self.subvol.snapshots)
+        self.assertEqual(list(self.subvol.snapshots), self.snapshots[2:])
+
+    def test_boot_snapshots_are_cleaned_up_after_a_failed_batch(self):
+        self.subvol.systemdboot_manager = mock.Mock()
+        self.subvol.delete_batch_size = 3
+        self.backend.subvolumes.pop(str(self.snapshots[4].path))
+        with self.assertRaises(SnapshotException):
+            self.queue(self.snapshots[0:6]).run()
+        self.subvol.systemdboot_manager.remove_unused_boot_snapshots.assert_called_once_with()
+
+    def test_snapshot_of_another_subvolume_is_refused(self):
+        other = fixture_subvolume(self.backend, '/other', 1)
+        with self.assertRaises(SnapshotException):
+            self.queue(other.snapshots)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+#!/usr/bin/python3
+
+from btrfssnapshotmanager.ssh import *
+
+from unittest import mock
+import os
+import tempfile
+import unittest
+
+
+class SSHConnectionTest(unittest.TestCase):
+
+    def setUp(self):
+        # An ssh on the path which only exits with the code it's given
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        self.ssh = PosixPath(self.temp_dir.name, 'ssh')
+        self.ssh.touch(mode=0o755)
+        path = mock.patch.dict(os.environ, {'PATH': "{0}:{1}".format(self.temp_dir.name, os.environ.get('PATH', ''))})
+        path.start()
+        self.addCleanup(path.stop)
+        self.pool = SSHConnectionPool()
+        self.addCleanup(self.pool.close)
+
+    def exits(self, code, error=''):
+        self.ssh.write_text("#!/bin/sh\necho '{0}' >&2\nexit {1}\n".format(error, code))
+
+    def test_master_connection_is_counted_with_other_commands(self):
+        self.exits(0)
+        count = command_stats.count
+        connection = self.pool.get('backup-host', None, None)
+        self.assertTrue(connection.master)
+        self.assertEqual(command_stats.count, count + 1)
+        self.assertIn('ControlMaster=no', connection.ssh_argv())
+
+    def test_failed_master_connection_is_counted_and_not_shared(self):
+        self.exits(255, 'connection refused')
+        count = command_stats.count
+        connection = self.pool.get('backup-host', 'root', None)
+        self.assertFalse(connection.master)
+        self.assertEqual(command_stats.count, count + 1)
+        self.assertEqual(connection.ssh_argv(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
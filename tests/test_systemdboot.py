@@ -0,0 +1,73 @@
+#!/usr/bin/python3
+
+from tests.fakes import *
+from btrfssnapshotmanager.systemdboot import *
+
+import os
+import unittest
+
+
+class RemoveUnusedObjectsTest(unittest.TestCase):
+
+    def setUp(self):
+        install_fakes()
+        self.addCleanup(uninstall_fakes)
+        self.boot_tree = FakeBootTree()
+        self.boot_tree.create([], 'linux.conf', 1)
+        self.systemdboot_manager = self.manager()
+        self.systemdboot_manager.create_boot_snapshot(datetime(2021, 1, 1))
+        self.manifest_path = PosixPath(self.systemdboot_manager.boot_snapshots[0].path(), systemdboot_manifest_file_name)
+
+    def tearDown(self):
+        self.boot_tree.remove()
+
+    def manager(self):
+        systemdboot_manager = SystemdBootManager()
+        systemdboot_manager.set_boot_path(self.boot_tree.path)
+        systemdboot_manager.deduplicate = True
+        return systemdboot_manager
+
+    def objects(self):
+        return sorted([c.name for c in self.systemdboot_manager.objects_dir.iterdir()])
+
+    def test_objects_in_use_are_kept(self):
+        objects = self.objects()
+        self.manager().remove_unused_objects()
+        self.assertEqual(self.objects(), objects)
+        self.assertEqual(len(objects), 2)
+
+    def test_corrupt_manifest_keeps_objects(self):
+        objects = self.objects()
+        self.manifest_path.write_text('{')
+        self.manager().remove_unused_objects()
+        self.assertEqual(self.objects(), objects)
+        self.assertEqual(self.manifest_path.read_text(), '{')
+
+    def test_missing_manifest_keeps_objects(self):
+        objects = self.objects()
+        self.manifest_path.unlink()
+        self.manager().remove_unused_objects()
+        self.assertEqual(self.objects(), objects)
+
+    def add_object(self, name, age):
+        path = PosixPath(self.systemdboot_manager.objects_dir, name)
+        path.write_text(name)
+        mtime = datetime.now().timestamp() - age
+        os.utime(path, (mtime, mtime))
+
+    def test_unused_objects_are_deleted(self):
+        objects = self.objects()
+        self.add_object('0' * 64, 60)
+        self.manager().remove_unused_objects()
+        self.assertEqual(self.objects(), objects)
+
+    def test_objects_being_stored_are_kept(self):
+        self.add_object('1' * 64 + '.tmp', 60)
+        self.add_object('2' * 64, -60)
+        objects = self.objects()
+        self.manager().remove_unused_objects()
+        self.assertEqual(self.objects(), objects)
+
+
+if __name__ == '__main__':
+    unittest.main()